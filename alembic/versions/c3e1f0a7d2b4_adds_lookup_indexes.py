@@ -0,0 +1,40 @@
+"""Adds lookup indexes
+
+Revision ID: c3e1f0a7d2b4
+Revises: 25b0aad777c6
+Create Date: 2026-10-18 19:18:18
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "c3e1f0a7d2b4"
+down_revision = "25b0aad777c6"
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_batches_reference", "batches", ["reference"]),
+    ("ix_batches_sku", "batches", ["sku"]),
+    ("ix_order_lines_order_id", "order_lines", ["order_id"]),
+    ("ix_allocations_id_orderline", "allocations", ["id_orderline"]),
+    ("ix_allocations_batch_id", "allocations", ["batch_id"]),
+    ("ix_allocations_view_id_orderline", "allocations_view", ["id_orderline"]),
+]
+
+
+def upgrade() -> None:
+    # CONCURRENTLY does not block writes while building the indexes, but
+    # cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name, table, columns, postgresql_concurrently=True
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table, postgresql_concurrently=True)
@@ -0,0 +1,29 @@
+"""Adds projector checkpoints
+
+Revision ID: d41a9c5e8b17
+Revises: c3e1f0a7d2b4
+Create Date: 2026-10-18 19:24:32
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d41a9c5e8b17"
+down_revision = "c3e1f0a7d2b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "projector_checkpoints",
+        sa.Column("name", sa.String(length=255), nullable=False),
+        sa.Column("position", sa.String(length=64), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("projector_checkpoints")
@@ -0,0 +1,87 @@
+"""Allocation benchmark: single-line path against `Product.allocate_many`
+
+Spreads a backlog of N order lines over a few SKUs, each with B batches
+of staggered ETAs, and times allocating it line by line and in bulk
+
+    python benchmarks/bench_allocate.py [N] [B]
+"""
+import random
+import sys
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, List
+
+from allocation.domain import model
+
+SKUS = ["BENCH-SKU-01", "BENCH-SKU-02", "BENCH-SKU-03", "BENCH-SKU-04"]
+
+
+def make_products(batches: int, lines: int) -> Dict[str, model.Product]:
+    qty = 2 * lines // (len(SKUS) * batches) + 1
+    today = date.today()
+    return {
+        sku: model.Product(
+            sku,
+            [
+                model.BatchOrder(
+                    f"{sku}-batch-{i}",
+                    sku,
+                    qty,
+                    eta=None if i == 0 else today + timedelta(days=i),
+                )
+                for i in range(batches)
+            ],
+        )
+        for sku in SKUS
+    }
+
+
+def make_backlog(lines: int) -> List[model.OrderLine]:
+    rng = random.Random(42)
+    return [
+        model.OrderLine(f"order-{i}", rng.choice(SKUS), rng.randint(1, 3))
+        for i in range(lines)
+    ]
+
+
+def line_by_line(
+    products: Dict[str, model.Product], backlog: List[model.OrderLine]
+) -> None:
+    for line in backlog:
+        products[line.sku].allocate(line)
+
+
+def in_bulk(
+    products: Dict[str, model.Product], backlog: List[model.OrderLine]
+) -> None:
+    per_sku: Dict[str, List[model.OrderLine]] = {sku: [] for sku in SKUS}
+    for line in backlog:
+        per_sku[line.sku].append(line)
+    for sku, lines in per_sku.items():
+        products[sku].allocate_many(lines)
+
+
+def timed(
+    run: Callable[[Dict[str, model.Product], List[model.OrderLine]], None],
+    lines: int,
+    batches: int,
+) -> float:
+    products, backlog = make_products(batches, lines), make_backlog(lines)
+    start = time.perf_counter()
+    run(products, backlog)
+    return time.perf_counter() - start
+
+
+def main(lines: int, batches: int) -> None:
+    print(f"{lines} lines over {len(SKUS)} skus with {batches} batches each")
+    for name, run in [("allocate", line_by_line), ("allocate_many", in_bulk)]:
+        elapsed = timed(run, lines, batches)
+        print(
+            f"  {name:<14} {elapsed:8.3f}s "
+            f"{lines / elapsed:12.0f} lines/s"
+        )
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [500_000, 1_000][len(args):]))
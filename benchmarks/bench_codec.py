@@ -0,0 +1,64 @@
+"""Codec benchmark: message encoding and decoding, and their size
+
+Encodes then decodes N Allocated events and N CreateBatch commands with
+every wire format: the `str(event)` path events used to be sent with
+(decoded with `ast.literal_eval`, which cannot read back dates at all),
+`codec`'s JSON fallback and `codec`'s binary encoding
+
+    python benchmarks/bench_codec.py [N]
+"""
+import ast
+import sys
+import time
+from datetime import date
+from typing import Any, Callable, List
+
+from allocation.adapters import codec
+from allocation.domain import commands, events
+
+
+def timed(function: Callable[[Any], Any], items: List[Any]) -> tuple:
+    start = time.perf_counter()
+    results = [function(item) for item in items]
+    return (time.perf_counter() - start) / len(items) * 1e6, results
+
+
+def main(count: int) -> None:
+    samples = {
+        "Allocated": [
+            events.Allocated(f"order-{i}", f"batch-{i}", "LAMP", i)
+            for i in range(count)
+        ],
+        "CreateBatch": [
+            commands.CreateBatch(f"batch-{i}", "LAMP", i, date(2020, 4, 1))
+            for i in range(count)
+        ],
+    }
+    formats = [
+        ("str", lambda m: str(m).encode(), ast.literal_eval, False),
+        ("json", lambda m: codec.encode(m, binary=False), codec.decode, True),
+        ("binary", lambda m: codec.encode(m, binary=True), codec.decode, True),
+    ]
+    print(f"{count} messages, microseconds per message")
+    for kind, messages in samples.items():
+        print(kind)
+        for name, encode, decode, typed in formats:
+            encoding, encoded = timed(encode, messages)
+            size = sum(len(e) for e in encoded) / len(encoded)
+            try:
+                decoding, decoded = timed(
+                    decode, [e.decode() if not typed else e for e in encoded]
+                )
+                read = f"decode {decoding:6.2f}us"
+                if typed:
+                    assert decoded == messages
+            except ValueError:
+                read = "decode   fails  "
+            print(
+                f"  {name:<7} encode {encoding:6.2f}us  {read}"
+                f"  {size:6.1f} bytes"
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
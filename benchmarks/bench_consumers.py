@@ -0,0 +1,127 @@
+"""Consumer throughput benchmark: external commands over 1 to 8 processes
+
+Appends M Allocate commands spread over S SKUs to a fresh commands stream,
+then times a `supervisor.Supervisor` of P consumer processes handling all
+of them, for every P. Scaling stops at the number of cores, or earlier if
+Postgres is the bottleneck. Needs Postgres at `config.get_postgres_uri()`
+and Redis
+
+Consumers run at READ COMMITTED unless DB_ISOLATION_LEVEL says otherwise:
+each SKU is handled by a single process, and at SERIALIZABLE commands on
+different SKUs abort each other (predicate locks on shared index pages)
+
+    python benchmarks/bench_consumers.py [M] [S] [P ...]
+"""
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from typing import List
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+
+from allocation import config
+from allocation.adapters import orm, redis
+from allocation.entrypoints import consumer, supervisor
+
+PREFIX = "BENCH-CONSUMERS"
+
+
+def clean(engine: Engine) -> None:
+    with engine.begin() as conn:
+        like = dict(like=f"{PREFIX}%")
+        conn.execute(
+            text(
+                "DELETE FROM allocations WHERE id_orderline IN "
+                "(SELECT id FROM order_lines WHERE sku LIKE :like)"
+            ),
+            like,
+        )
+        for table in ["order_lines", "allocations_view", "batches"]:
+            query = text(f"DELETE FROM {table} WHERE sku LIKE :like")
+            conn.execute(query, like)
+        conn.execute(text("DELETE FROM products WHERE sku LIKE :like"), like)
+
+
+def seed(engine: Engine, skus: List[str]) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            orm.products.insert(),
+            [dict(sku=sku, version_number=0) for sku in skus],
+        )
+        conn.execute(
+            orm.batches.insert(),
+            [
+                dict(reference=f"{sku}-batch", sku=sku, qty_purchase=10 ** 9)
+                for sku in skus
+            ],
+        )
+
+
+def allocated(engine: Engine) -> int:
+    with engine.connect() as conn:
+        return conn.execute(
+            text(
+                "SELECT count(*) FROM allocations JOIN order_lines "
+                "ON order_lines.id = allocations.id_orderline "
+                "WHERE order_lines.sku LIKE :like"
+            ),
+            dict(like=f"{PREFIX}%"),
+        ).scalar()
+
+
+def run(engine: Engine, messages: int, skus: int, processes: int) -> float:
+    names = [f"{PREFIX}-{i}" for i in range(skus)]
+    clean(engine)
+    seed(engine, names)
+    stream = f"{PREFIX}-{uuid.uuid4().hex[:8]}"
+    # inherited by the forked consumer processes
+    consumer.EXTERNAL_CHANNELS_HANDLERS = {
+        stream: consumer.handle_external_commands
+    }
+    with redis.buffered_publishing():
+        for i in range(messages):
+            command = dict(
+                name="Allocate", order_id=f"order-{i}", sku=names[i % skus]
+            )
+            redis.append_message(stream, json.dumps(dict(command, qty=1)))
+
+    stop = threading.Event()
+    pool = supervisor.Supervisor(processes)
+    thread = threading.Thread(target=pool.run, args=(stop,))
+    start = time.perf_counter()
+    thread.start()
+    while allocated(engine) < messages:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    thread.join()
+
+    client = redis.get_client()
+    client.delete(stream)
+    for index in range(processes):
+        client.delete(supervisor.partition_stream(stream, index))
+    return elapsed
+
+
+def main(messages: int, skus: int, processes: List[int]) -> None:
+    os.environ.setdefault("DB_ISOLATION_LEVEL", "READ COMMITTED")
+    engine = create_engine(config.get_postgres_uri())
+    orm.metadata.create_all(engine)
+    print(f"{messages} allocations over {skus} SKUs")
+    for count in processes:
+        elapsed = run(engine, messages, skus, count)
+        print(f"  {count} processes  {messages / elapsed:8.1f} commands/s")
+    clean(engine)
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(
+        args[0] if args else 2_000,
+        args[1] if len(args) > 1 else 64,
+        args[2:] or [1, 2, 4, 8],
+    )
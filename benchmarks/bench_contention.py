@@ -0,0 +1,123 @@
+"""Contention benchmark: concurrent allocations against a single SKU
+
+T threads each allocate N order lines to the same Product through the
+message bus, once per isolation level. Conflicting commits are retried by
+the bus (see `config.get_command_retry_settings`); commands still failing
+after the last attempt are counted as failures. Needs Postgres at
+`config.get_postgres_uri()`
+
+    python benchmarks/bench_contention.py [T] [N]
+"""
+import logging
+import sys
+import threading
+import time
+from typing import Dict, List
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import config
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service import message_bus, unit_of_work
+
+SKU = "BENCH-CONTENTION"
+ISOLATION_LEVELS = ["SERIALIZABLE", "READ COMMITTED"]
+
+
+def reset(engine) -> None:  # type: ignore
+    with engine.begin() as conn:
+        conn.execute(
+            "DELETE FROM allocations WHERE id_orderline IN "
+            "(SELECT id FROM order_lines WHERE sku = %s)",
+            SKU,
+        )
+        conn.execute("DELETE FROM order_lines WHERE sku = %s", SKU)
+        conn.execute("DELETE FROM batches WHERE sku = %s", SKU)
+        conn.execute("DELETE FROM products WHERE sku = %s", SKU)
+        conn.execute(
+            "INSERT INTO products (sku, version_number) VALUES (%s, 0)", SKU
+        )
+        conn.execute(
+            "INSERT INTO batches (reference, sku, qty_purchase) "
+            "VALUES (%s, %s, %s)",
+            f"{SKU}-batch",
+            SKU,
+            10 ** 9,
+        )
+
+
+def run(isolation_level: str, threads: int, lines: int) -> Dict[str, float]:
+    engine = create_engine(
+        config.get_postgres_uri(),
+        isolation_level=isolation_level,
+        pool_size=threads,
+    )
+    reset(engine)
+    session_factory = sessionmaker(bind=engine, autoflush=False)
+    failures: List[Exception] = []
+    retries = []
+    retry_delay = message_bus.retry_delay
+
+    def counting_retry_delay(attempt: int):  # type: ignore
+        delay = retry_delay(attempt)
+        if delay is not None:
+            retries.append(delay)
+        return delay
+
+    def allocate(worker: int) -> None:
+        for i in range(lines):
+            command = commands.Allocate(f"order-{worker}-{i}", SKU, 1)
+            uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+            try:
+                message_bus.handle(command, uow)
+            except unit_of_work.ConcurrentUpdate as ex:
+                failures.append(ex)
+
+    message_bus.retry_delay = counting_retry_delay  # type: ignore
+    workers = [
+        threading.Thread(target=allocate, args=(i,)) for i in range(threads)
+    ]
+    start = time.perf_counter()
+    [worker.start() for worker in workers]
+    [worker.join() for worker in workers]
+    elapsed = time.perf_counter() - start
+    message_bus.retry_delay = retry_delay  # type: ignore
+    engine.dispose()
+
+    committed = threads * lines - len(failures)
+    return dict(
+        elapsed=elapsed,
+        committed=committed,
+        retries=len(retries),
+        failures=len(failures),
+    )
+
+
+def main(threads: int, lines: int) -> None:
+    engine = create_engine(config.get_postgres_uri())
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    logging.disable(logging.CRITICAL)  # commands given up on are counted
+    # only the allocation itself is measured
+    message_bus.EVENTS_HANDLERS = {
+        event: [] for event in message_bus.EVENTS_HANDLERS
+    }
+
+    print(f"{threads} threads x {lines} allocations on one SKU")
+    for isolation_level in ISOLATION_LEVELS:
+        result = run(isolation_level, threads, lines)
+        print(
+            f"  {isolation_level:<15}"
+            f" {result['committed'] / result['elapsed']:8.1f} commits/s"
+            f" {result['retries']:6d} retries"
+            f" {result['failures']:6d} failed"
+        )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+    )
@@ -0,0 +1,90 @@
+"""Memory benchmark: bytes per allocation
+
+Allocates N order lines to a single Product and reports how many bytes
+each allocation keeps alive (order line, batch bookkeeping and the
+`Allocated` event waiting to be collected). The same workload is run with
+`__dict__`-backed replicas of the messages to compare against the slotted
+ones, and once more on an aggregate loaded by the ORM from SQLite
+
+    python benchmarks/bench_memory.py [N]
+"""
+import dataclasses
+import gc
+import sys
+import tracemalloc
+from typing import Any, Callable, Dict
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm
+from allocation.domain import events, model
+
+SKU = "BENCH-SKU"
+
+
+def dict_backed(cls: Any) -> Any:
+    "Plain dataclass with the same fields as the slotted `cls`"
+    return dataclasses.make_dataclass(
+        cls.__name__,
+        [(f.name, f.type) for f in dataclasses.fields(cls)],
+        bases=(events.Event,),
+    )
+
+
+def bytes_per_item(build: Callable[[], Any], n: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    kept = build()  # noqa: F841
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / n
+
+
+def allocate_lines(n: int) -> model.Product:
+    product = model.Product(SKU, [model.BatchOrder("batch", SKU, n)])
+    for i in range(n):
+        product.allocate(model.OrderLine(f"order-{i}", SKU, 1))
+    return product
+
+
+def load_allocated_product(n: int) -> Callable[[], Any]:
+    engine = create_engine("sqlite:///:memory:")
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    session.add(allocate_lines(n))
+    session.commit()
+    session.close()
+
+    def load() -> Any:
+        session = session_factory()
+        product = session.query(model.Product).filter_by(sku=SKU).one()
+        product.batches[0].allocated_quantity
+        return session, product
+
+    return load
+
+
+def main(n: int) -> None:
+    results: Dict[str, float] = {}
+    results["slotted events"] = bytes_per_item(lambda: allocate_lines(n), n)
+
+    slotted = events.Allocated
+    events.Allocated = dict_backed(slotted)  # type: ignore
+    try:
+        results["dict events"] = bytes_per_item(lambda: allocate_lines(n), n)
+    finally:
+        events.Allocated = slotted  # type: ignore
+
+    results["orm-loaded lines"] = bytes_per_item(load_allocated_product(n), n)
+    orm.clear_mappers()
+
+    print(f"{n} allocations")
+    for name, size in results.items():
+        print(f"  {name:<18} {size:8.1f} bytes/allocation")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,81 @@
+"""Message bus benchmark: draining N cascaded events
+
+A single command allocates a backlog of N lines, which records N
+`Allocated` events on the aggregate, and each of them is collected by the
+unit of work and handled by the message bus. The same workload is run
+through a replica of the previous list-based buffers (`list.pop(0)` both
+on the aggregate events and on the bus queue) for comparison
+
+    python benchmarks/bench_message_bus.py [N]
+"""
+import sys
+import time
+from typing import Any, Callable, Generator, List
+
+from allocation.domain import commands, events, model
+from allocation.service import message_bus, unit_of_work
+
+SKU = "BENCH-SKU"
+
+
+class ListUnitOfWork(unit_of_work.FakeUnitOfWork):
+    def collect_new_events(self) -> Generator:
+        for product in self.products.seen:
+            while product._events:
+                yield product._events.pop(0)
+
+
+def list_handle(message: Any, uow: unit_of_work.AbstractUnitOfWork) -> None:
+    queue: List = [message]
+    while queue:
+        message = queue.pop(0)
+        if isinstance(message, events.Event):
+            message_bus.handle_event(message, queue, uow)  # type: ignore
+        else:
+            message_bus.handle_command(message, queue, uow)  # type: ignore
+
+
+def allocate_backlog(lines: int, as_list: bool) -> Callable:
+    def handler(
+        command: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork
+    ) -> None:
+        with uow:
+            product = uow.products.get(command.sku)
+            if as_list:
+                product._events = []  # type: ignore
+            product.allocate_many(
+                model.OrderLine(f"order-{i}", SKU, command.qty)
+                for i in range(lines)
+            )
+            uow.commit()
+
+    return handler
+
+
+def timed(lines: int, as_list: bool) -> float:
+    uow = ListUnitOfWork() if as_list else unit_of_work.FakeUnitOfWork()
+    uow.products.add(
+        model.Product(SKU, [model.BatchOrder("batch", SKU, lines)])
+    )
+    message_bus.COMMAND_HANDLERS[commands.Allocate] = allocate_backlog(
+        lines, as_list
+    )
+    handle = list_handle if as_list else message_bus.handle
+
+    start = time.perf_counter()
+    handle(commands.Allocate("backlog", SKU, 1), uow)
+    return time.perf_counter() - start
+
+
+def main(lines: int) -> None:
+    # keeps handlers in memory: the bus itself is what is being measured
+    message_bus.EVENTS_HANDLERS[events.Allocated] = []
+
+    print(f"{lines} cascaded events")
+    for name, as_list in [("list.pop(0)", True), ("deque", False)]:
+        elapsed = timed(lines, as_list)
+        print(f"  {name:<12} {elapsed:8.3f}s {lines / elapsed:12.0f} events/s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
@@ -0,0 +1,208 @@
+"""Query benchmark: lookup latency and plans of repository and view queries
+
+Seeds P products of B batches, each with L allocated order lines (and
+their read model rows), then times every lookup the service does and
+prints the plan Postgres picks for it: a "Seq Scan" on a large table is a
+missing index. Seeded rows are deleted afterwards. Needs Postgres at
+`config.get_postgres_uri()`, migrated to head. Per-order lookups are also
+timed against the Redis read model when Redis is up
+
+    python benchmarks/bench_queries.py [P] [B] [L] [LOOKUPS]
+"""
+import random
+import statistics
+import sys
+import time
+from typing import Callable, List
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import config, views
+from allocation.adapters import redis
+from allocation.adapters import orm, repository
+from allocation.service import unit_of_work
+
+PREFIX = "BENCH-QUERIES"
+
+PLANS = {
+    "batches by reference": "SELECT * FROM batches WHERE reference = :ref",
+    "batches by sku": "SELECT * FROM batches WHERE sku = :sku",
+    "order lines by order id": (
+        "SELECT * FROM order_lines WHERE order_id = :order_id"
+    ),
+    "allocations by batch": (
+        "SELECT * FROM allocations WHERE batch_id = "
+        "(SELECT id FROM batches WHERE reference = :ref)"
+    ),
+    "allocations by order line": (
+        "SELECT * FROM allocations WHERE id_orderline IN "
+        "(SELECT id FROM order_lines WHERE order_id = :order_id)"
+    ),
+    "read model by order id": (
+        "SELECT * FROM allocations_view WHERE id_orderline = :order_id"
+    ),
+}
+
+
+def clean(engine: Engine) -> None:
+    with engine.begin() as conn:
+        like = dict(like=f"{PREFIX}%")
+        conn.execute(
+            text(
+                "DELETE FROM allocations WHERE id_orderline IN "
+                "(SELECT id FROM order_lines WHERE sku LIKE :like)"
+            ),
+            like,
+        )
+        for table in ["order_lines", "allocations_view", "batches"]:
+            query = text(f"DELETE FROM {table} WHERE sku LIKE :like")
+            conn.execute(query, like)
+        conn.execute(text("DELETE FROM products WHERE sku LIKE :like"), like)
+
+
+def seed(engine: Engine, products: int, batches: int, lines: int) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            orm.products.insert(),
+            [
+                dict(sku=f"{PREFIX}-{p}", version_number=0)
+                for p in range(products)
+            ],
+        )
+        conn.execute(
+            orm.batches.insert(),
+            [
+                dict(
+                    reference=f"{PREFIX}-{p}-{b}",
+                    sku=f"{PREFIX}-{p}",
+                    qty_purchase=lines * 10,
+                )
+                for p in range(products)
+                for b in range(batches)
+            ],
+        )
+        batch_ids = dict(
+            conn.execute(
+                text("SELECT reference, id FROM batches WHERE sku LIKE :like"),
+                dict(like=f"{PREFIX}%"),
+            ).fetchall()
+        )
+        conn.execute(
+            orm.order_lines.insert(),
+            [
+                dict(order_id=f"{ref}-{i}", sku=ref.rsplit("-", 1)[0], qty=1)
+                for ref in batch_ids
+                for i in range(lines)
+            ],
+        )
+        line_ids = conn.execute(
+            text("SELECT order_id, id FROM order_lines WHERE sku LIKE :like"),
+            dict(like=f"{PREFIX}%"),
+        ).fetchall()
+        conn.execute(
+            orm.allocations.insert(),
+            [
+                dict(
+                    id_orderline=line_id,
+                    batch_id=batch_ids[order_id.rsplit("-", 1)[0]],
+                )
+                for order_id, line_id in line_ids
+            ],
+        )
+        conn.execute(
+            orm.allocations_view.insert(),
+            [
+                dict(
+                    id_orderline=order_id,
+                    batchref=order_id.rsplit("-", 1)[0],
+                    sku=order_id.rsplit("-", 2)[0],
+                    qty=1,
+                )
+                for order_id, _ in line_ids
+            ],
+        )
+        conn.execute(text("ANALYZE"))
+
+
+def latency(lookup: Callable[[str], object], keys: List[str]) -> str:
+    timings = []
+    for key in keys:
+        start = time.perf_counter()
+        lookup(key)
+        timings.append((time.perf_counter() - start) * 1000)
+    return (
+        f"median {statistics.median(timings):7.2f}ms"
+        f"  max {max(timings):7.2f}ms"
+    )
+
+
+def main(products: int, batches: int, lines: int, lookups: int) -> None:
+    engine = create_engine(config.get_postgres_uri())
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    clean(engine)
+    seed(engine, products, batches, lines)
+    session_factory = sessionmaker(bind=engine, autoflush=False)
+    rng = random.Random(42)
+    pick = lambda: (rng.randrange(products), rng.randrange(batches))  # noqa
+    picks = [pick() for _ in range(lookups)]
+    skus = [f"{PREFIX}-{p}" for p, _ in picks]
+    refs = [f"{PREFIX}-{p}-{b}" for p, b in picks]
+    orders = [f"{ref}-{rng.randrange(lines)}" for ref in refs]
+
+    def get(sku: str) -> object:
+        session = session_factory()
+        try:
+            return repository.SqlAlchemyProductRepository(session).get(sku)
+        finally:
+            session.close()
+
+    def get_by_batchref(ref: str) -> object:
+        session = session_factory()
+        try:
+            repo = repository.SqlAlchemyProductRepository(session)
+            return repo.get_by_batchref(ref)
+        finally:
+            session.close()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    total = products * batches * lines
+    print(f"{products} products, {batches} batches, {total} allocations")
+    lookups = [
+        ("repository.get", get, skus),
+        ("repository.get_by_batchref", get_by_batchref, refs),
+        ("views.allocations", lambda o: views.allocations(o, uow), orders),
+    ]
+    try:
+        redis.get_client().ping()
+    except Exception:
+        print("  Redis is down, skipping its read model")
+    else:
+        redis.set_allocations(views.iter_allocations(uow))
+        in_redis = ("redis.get_allocations", redis.get_allocations, orders)
+        lookups.append(in_redis)
+    for name, lookup, keys in lookups:
+        print(f"  {name:<28} {latency(lookup, keys)}")
+
+    print("plans")
+    params = dict(ref=refs[0], sku=skus[0], order_id=orders[0])
+    with engine.connect() as conn:
+        for name, query in PLANS.items():
+            plan = conn.execute(text(f"EXPLAIN {query}"), params).fetchall()
+            scans = [
+                row[0].strip(" ->").split("  (")[0]
+                for row in plan
+                if "Scan" in row[0]
+            ]
+            print(f"  {name:<28} {'; '.join(scans)}")
+    clean(engine)
+    if len(lookups) > 3:
+        redis.clear_allocations(f"{PREFIX}*")
+
+
+if __name__ == "__main__":
+    defaults = [2_000, 5, 10, 200]
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args, *defaults[len(args):])  # type: ignore
@@ -0,0 +1,109 @@
+"""Repository benchmark: scanning fake repository against indexed in-memory
+
+Stores P products of B batches each, holding L allocated lines per
+product, then times looking every product up by sku and every batch up by
+reference, followed by allocating a line per product through the message
+bus on the in-memory Unit of Work, and by allocating one more that is
+rolled back
+
+    python benchmarks/bench_repository.py [P] [B] [L]
+"""
+import sys
+import time
+from typing import Callable, List
+
+from allocation.adapters import repository
+from allocation.domain import commands, model
+from allocation.service import message_bus, unit_of_work
+
+
+def make_products(
+    products: int, batches: int, lines: int = 0
+) -> List[model.Product]:
+    made = []
+    for p in range(products):
+        sku = f"SKU-{p}"
+        product = model.Product(
+            sku,
+            [
+                model.BatchOrder(f"{sku}-batch-{b}", sku, 100 + lines)
+                for b in range(batches)
+            ],
+        )
+        product.allocate_many(
+            model.OrderLine(f"{sku}-line-{n}", sku, 1) for n in range(lines)
+        )
+        product._events.clear()
+        made.append(product)
+    return made
+
+
+def timed(call: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    call()
+    return time.perf_counter() - start
+
+
+def lookups(
+    repo: repository.AbstractProductRepository,
+    products: List[model.Product],
+) -> List[float]:
+    skus = [product.sku for product in products]
+    refs = [
+        batch.reference for product in products for batch in product.batches
+    ]
+    return [
+        timed(lambda: [repo.get(sku) for sku in skus]) / len(skus),
+        timed(lambda: [repo.get_by_batchref(ref) for ref in refs]) / len(refs),
+    ]
+
+
+def rolled_back(uow: unit_of_work.AbstractUnitOfWork, sku: str) -> None:
+    with uow:
+        product = uow.products.get(sku)
+        product.allocate(model.OrderLine(f"{sku}-rolled-back", sku, 1))
+
+
+def main(products: int, batches: int, lines: int) -> None:
+    # keeps handlers in memory: the repository is what is being measured
+    message_bus.EVENTS_HANDLERS = {
+        event: [] for event in message_bus.EVENTS_HANDLERS
+    }
+    fake = repository.FakeProductRepository(
+        make_products(products, batches, lines)
+    )
+    stored = make_products(products, batches, lines)
+    store = repository.InMemoryStore(stored)
+    in_memory = repository.InMemoryProductRepository(store)
+
+    print(f"{products} products x {batches} batches, {lines} lines each")
+    for name, repo, items in [
+        ("fake", fake, list(fake._products)),
+        ("in-memory", in_memory, stored),
+    ]:
+        by_sku, by_ref = lookups(repo, items)
+        print(
+            f"  {name:<10} get {by_sku * 1e6:10.2f}us"
+            f"  get_by_batchref {by_ref * 1e6:10.2f}us"
+        )
+
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    elapsed = timed(
+        lambda: [
+            message_bus.handle(commands.Allocate(f"o-{p}", f"SKU-{p}", 1), uow)
+            for p in range(products)
+        ]
+    )
+    print(f"  allocate through the bus {products / elapsed:10.0f} commands/s")
+    elapsed = timed(
+        lambda: [rolled_back(uow, f"SKU-{p}") for p in range(products)]
+    )
+    print(f"  allocate rolled back     {products / elapsed:10.0f} per second")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 2_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 0,
+    )
@@ -0,0 +1,57 @@
+"""Startup benchmark: cold import of the web app and time to first request
+
+Each run is a fresh interpreter, so nothing is cached between runs. The
+first request to PATH (default `/`, which needs no database) pays for
+whatever the app left to be done lazily
+
+    python benchmarks/bench_startup.py [RUNS] [PATH]
+"""
+import json
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from allocation.entrypoints import app
+imported = time.perf_counter()
+with app.app.test_client() as client:
+    status = client.get(sys.argv[1]).status_code
+done = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "first_request": done - imported,
+    "status": status,
+}))
+"""
+
+
+def probe(path: str) -> Dict[str, float]:
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE, path],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def main(runs: int, path: str) -> None:
+    samples: List[Dict[str, float]] = [probe(path) for _ in range(runs)]
+    print(f"{runs} cold starts, first request to {path}")
+    for key in ["import", "first_request"]:
+        values = [sample[key] * 1000 for sample in samples]
+        print(
+            f"  {key:<14} median {statistics.median(values):8.1f}ms"
+            f"  max {max(values):8.1f}ms"
+        )
+    print(f"  status         {samples[-1]['status']}")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+        sys.argv[2] if len(sys.argv) > 2 else "/",
+    )
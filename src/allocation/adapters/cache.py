@@ -0,0 +1,109 @@
+"Product Aggregate cache"
+# Hot SKUs are touched by most requests: keeping their aggregates loaded
+# across Units of Work spares reloading the whole graph every time
+import threading
+import uuid
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from allocation.adapters import redis
+from allocation.domain import model
+
+INVALIDATION_CHANNEL = "product-cache-invalidation"
+
+
+class ProductCache:
+    """Least recently used Products, keyed by sku, at most `max_size`
+
+    A product is handed to one Unit of Work at a time: `checkout` takes it
+    out of the cache and `checkin` puts it back once committed, so the same
+    instance is never attached to two sessions. A checked out product is
+    only used if its version number still is the one in the database"""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.node = uuid.uuid4().hex
+        self._products: Dict[str, model.Product] = OrderedDict()
+        self._batchrefs: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def _pop(self, sku: str) -> Optional[model.Product]:
+        product = self._products.pop(sku, None)
+        if product is not None:
+            for batch in product.batches:
+                self._batchrefs.pop(batch.reference, None)
+        return product
+
+    def checkout(
+        self, sku: str, current_version: Callable[[], Optional[int]]
+    ) -> Optional[model.Product]:
+        with self._lock:
+            product = self._pop(sku)
+            if product is None:
+                self.misses += 1
+                return None
+        if product.version_number != current_version():
+            with self._lock:
+                self.stale += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return product
+
+    def checkin(self, product: model.Product) -> None:
+        with self._lock:
+            cached = self._products.get(product.sku)
+            if cached is not None:
+                if cached.version_number > product.version_number:
+                    return
+                self._pop(product.sku)
+            self._products[product.sku] = product
+            for batch in product.batches:
+                self._batchrefs[batch.reference] = product.sku
+            while len(self._products) > self.max_size:
+                self._pop(next(iter(self._products)))
+                self.evictions += 1
+
+    def sku_for(self, batchref: str) -> Optional[str]:
+        return self._batchrefs.get(batchref)
+
+    def invalidate(self, sku: str) -> None:
+        with self._lock:
+            if self._pop(sku) is not None:
+                self.invalidations += 1
+
+    def publish_invalidations(self, skus: Iterable[str]) -> None:
+        "Tells caches of other processes these products have changed"
+        for sku in skus:
+            redis.publish_message(INVALIDATION_CHANNEL, f"{self.node} {sku}")
+
+    def _receive_invalidation(self, message: Dict[str, Any]) -> None:
+        node, sku = message["data"].decode().split(" ", 1)
+        if node != self.node:
+            self.invalidate(sku)
+
+    def listen(self) -> threading.Thread:
+        "Invalidates products changed by other processes, from a thread"
+        pubsub = redis.get_client().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: self._receive_invalidation})
+        return pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def stats(self) -> dict:
+        return dict(
+            size=len(self._products),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            stale=self.stale,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
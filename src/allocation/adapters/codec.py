@@ -0,0 +1,243 @@
+"Messages' wire format"
+# Commands and Events leave the process as bytes: on Redis streams, in the
+# read model projection and from external producers. Two encodings share a
+# single `decode`, which tells them apart by their first byte:
+#
+# - binary, compact and the default: a header with a magic byte, the schema
+#   version, the message's registry code and its number of fields, followed
+#   by every field as a one byte tag and its value
+# - JSON, for producers that cannot link this module: an object of the
+#   message's fields plus its `name` and `schema` version, dates as ISO 8601
+#
+import json
+import struct
+import typing
+from dataclasses import fields
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
+
+from allocation import config
+from allocation.domain import commands, events
+
+Message = Union[commands.Command, events.Event]
+
+# bumped on incompatible changes; newer messages are refused, not misread
+SCHEMA_VERSION = 1
+MAGIC = 0xA7  # never the first byte of a JSON text
+
+HEADER = struct.Struct("!BBHB")  # magic, schema version, code, field count
+INT = struct.Struct("!q")
+FLOAT = struct.Struct("!d")
+SIZE = struct.Struct("!I")
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+NONE, FALSE, TRUE, INTEGER, REAL, STRING, DATE, DATETIME = range(8)
+
+
+class CodecError(Exception):
+    pass
+
+
+# Registry codes are part of the format: never reuse or renumber them
+REGISTRY: Dict[int, Type[Any]] = {
+    1: commands.Allocate,
+    2: commands.Deallocate,
+    3: commands.CreateBatch,
+    4: commands.ChangeBatchQuantity,
+    32: events.OutOfStock,
+    33: events.Allocated,
+    34: events.Deallocated,
+    35: events.BatchCreated,
+    36: events.OrderAlreadyAllocated,
+    37: events.OrderNotAllocated,
+    38: events.AllocationsEmpty,
+}
+CODES = {cls: code for code, cls in REGISTRY.items()}
+NAMES = {cls.__name__: cls for cls in REGISTRY.values()}
+# field names of each message type, in declaration (and encoding) order
+FIELDS = {cls: [f.name for f in fields(cls)] for cls in REGISTRY.values()}
+
+
+def encode(message: Message, binary: Optional[bool] = None) -> bytes:
+    "`binary` defaults to the configured MESSAGE_FORMAT"
+    if binary is None:
+        binary = config.get_message_format() == "binary"
+    if not binary:
+        return json.dumps(to_dict(message), default=json_default).encode()
+    cls = type(message)
+    if cls not in CODES:
+        raise CodecError(f"{cls.__name__} is not registered")
+    names = FIELDS[cls]
+    parts = [HEADER.pack(MAGIC, SCHEMA_VERSION, CODES[cls], len(names))]
+    for name in names:
+        value = getattr(message, name)
+        try:
+            parts.append(ENCODERS[type(value)](value))
+        except KeyError:
+            raise CodecError(f"Cannot encode {name}={value!r} of {cls}")
+    return b"".join(parts)
+
+
+def decode(data: bytes) -> Message:
+    "Decodes either encoding back into its Command or Event"
+    if not data:
+        raise CodecError("Empty message")
+    try:
+        if data[0] != MAGIC:
+            return from_dict(json.loads(data))
+        return _decode_binary(data)
+    except CodecError:
+        raise
+    except Exception as ex:
+        raise CodecError(f"Malformed message {data[:40]!r}: {ex}") from ex
+
+
+def _decode_binary(data: bytes) -> Message:
+    _, version, code, count = HEADER.unpack_from(data)
+    check_version(version)
+    cls = REGISTRY.get(code)
+    if cls is None:
+        raise CodecError(f"Unknown message code {code}")
+    offset = HEADER.size
+    values = []
+    for _ in range(count):
+        value, offset = DECODERS[data[offset]](data, offset + 1)
+        values.append(value)
+    # older producers may send fewer fields: the rest take their defaults
+    return cls(**coerce_dates(cls, dict(zip(FIELDS[cls], values))))
+
+
+def check_version(version: int) -> None:
+    if version > SCHEMA_VERSION:
+        raise CodecError(
+            f"Schema version {version} is newer than {SCHEMA_VERSION}"
+        )
+
+
+def to_dict(message: Message) -> Dict[str, Any]:
+    data = {name: getattr(message, name) for name in FIELDS[type(message)]}
+    data["name"] = type(message).__name__
+    data["schema"] = SCHEMA_VERSION
+    return data
+
+
+def from_dict(data: Dict[str, Any]) -> Message:
+    """Builds the message named by `data["name"]`. Strings in date fields
+    are parsed, and `schema` defaults to the current version"""
+    data = dict(data)
+    check_version(data.pop("schema", SCHEMA_VERSION))
+    cls = NAMES.get(data.pop("name", None))
+    if cls is None:
+        raise CodecError(f"Unknown message {data}")
+    return cls(**coerce_dates(cls, data))
+
+
+def json_default(value: Any) -> str:
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{value!r} is not JSON serializable")
+
+
+def coerce_dates(cls: type, values: Dict[str, Any]) -> Dict[str, Any]:
+    """Turns the values of `cls`' date and datetime fields into the type the
+    field declares, whichever encoding (or producer) they came from"""
+    for name, convert in date_fields(cls).items():
+        if values.get(name) is not None:
+            values[name] = convert(values[name])
+    return values
+
+
+_date_fields: Dict[type, Dict[str, Callable[[Any], Any]]] = {}
+
+
+def date_fields(cls: type) -> Dict[str, Callable[[Any], Any]]:
+    "Converters of the date and datetime fields of `cls`, by field name"
+    if cls not in _date_fields:
+        converters: Dict[str, Callable[[Any], Any]] = {}
+        for name, hint in typing.get_type_hints(cls).items():
+            args = getattr(hint, "__args__", ())
+            if hint is datetime or datetime in args:
+                converters[name] = to_datetime
+            elif hint is date or date in args:
+                converters[name] = to_date
+        _date_fields[cls] = converters
+    return _date_fields[cls]
+
+
+def to_date(value: Union[str, date]) -> date:
+    # tolerates producers sending a midnight datetime for a date
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.date() if isinstance(value, datetime) else value
+
+
+def to_datetime(value: Union[str, date]) -> datetime:
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        return value
+    return datetime(value.year, value.month, value.day)
+
+
+# Binary values: a tag byte, then the value itself
+def _string(value: str) -> bytes:
+    encoded = value.encode("utf-8")
+    return bytes((STRING,)) + SIZE.pack(len(encoded)) + encoded
+
+
+def _datetime(value: datetime) -> bytes:
+    if value.tzinfo is not None:
+        raise CodecError(f"Only naive datetimes are supported: {value!r}")
+    micros = (value - EPOCH) // MICROSECOND
+    return bytes((DATETIME,)) + INT.pack(micros)
+
+
+ENCODERS: Dict[type, Callable[[Any], bytes]] = {
+    type(None): lambda _: bytes((NONE,)),
+    bool: lambda value: bytes((TRUE if value else FALSE,)),
+    int: lambda value: bytes((INTEGER,)) + INT.pack(value),
+    float: lambda value: bytes((REAL,)) + FLOAT.pack(value),
+    str: _string,
+    date: lambda value: bytes((DATE,)) + SIZE.pack(value.toordinal()),
+    datetime: _datetime,
+}
+
+
+def _read_string(data: bytes, offset: int) -> Tuple[str, int]:
+    (size,) = SIZE.unpack_from(data, offset)
+    start = offset + SIZE.size
+    end = start + size
+    return data[start:end].decode("utf-8"), end
+
+
+def _read_struct(
+    packed: struct.Struct, convert: Callable[[Any], Any]
+) -> Callable[[bytes, int], Tuple[Any, int]]:
+    def read(data: bytes, offset: int) -> Tuple[Any, int]:
+        (value,) = packed.unpack_from(data, offset)
+        return convert(value), offset + packed.size
+
+    return read
+
+
+DECODERS: List[Callable[[bytes, int], Tuple[Any, int]]] = [
+    lambda data, offset: (None, offset),
+    lambda data, offset: (False, offset),
+    lambda data, offset: (True, offset),
+    _read_struct(INT, int),
+    _read_struct(FLOAT, float),
+    _read_string,
+    _read_struct(SIZE, date.fromordinal),
+    _read_struct(INT, lambda micros: EPOCH + micros * MICROSECOND),
+]
+
+
+def register(code: int, cls: type) -> None:
+    "Adds a message type to the registry under a code not taken yet"
+    if code in REGISTRY or cls in CODES:
+        raise CodecError(f"{cls.__name__} or code {code} already registered")
+    REGISTRY[code] = cls
+    CODES[cls] = code
+    NAMES[cls.__name__] = cls
+    FIELDS[cls] = [f.name for f in fields(cls)]
@@ -1,10 +1,16 @@
-from typing import Any, Optional
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, List, Optional
 
-from sqlalchemy import event
+from sqlalchemy import event, inspect
 from sqlalchemy import Column, DateTime, Integer, String, Table, ForeignKey
+from sqlalchemy import Index, LargeBinary
 from sqlalchemy import MetaData
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import mapper, relationship, clear_mappers  # noqa: F401
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.interfaces import MapperOption
 
 from allocation.domain import model
 
@@ -17,6 +23,7 @@ order_lines: Table = Table(
     Column("order_id", String(255)),
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
+    Index("ix_order_lines_order_id", "order_id"),
 )
 
 products = Table(
@@ -37,6 +44,8 @@ batches: Table = Table(
     Column("qty_purchase", Integer, nullable=False),
     Column("eta", DateTime, nullable=True),
     Column("created_at", DateTime),
+    Index("ix_batches_reference", "reference"),
+    Index("ix_batches_sku", "sku"),
 )
 
 # AssociationTable pattern
@@ -46,6 +55,8 @@ allocations: Table = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("id_orderline", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
+    Index("ix_allocations_id_orderline", "id_orderline"),
+    Index("ix_allocations_batch_id", "batch_id"),
 )
 
 allocations_view: Table = Table(
@@ -56,8 +67,38 @@ allocations_view: Table = Table(
     Column("batchref", String(255)),
     Column("sku", String(255)),
     Column("qty", Integer),
+    Index("ix_allocations_view_id_orderline", "id_orderline"),
 )
 
+# Last stream entry applied by each read model projector, written in the
+# same transaction as the rows it projected
+projector_checkpoints: Table = Table(
+    "projector_checkpoints",
+    metadata,
+    Column("name", String(255), primary_key=True),
+    Column("position", String(64), nullable=False),
+)
+
+
+# Events raised by committed transactions, written in those transactions
+# and sent to Redis by `service.relay`, which marks them `sent_at`
+outbox: Table = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("message", LargeBinary, nullable=False),
+    Column("created_at", DateTime, nullable=False, default=datetime.now),
+    Column("sent_at", DateTime, nullable=True),
+)
+# only the rows waiting for the relay, however many were sent already
+Index(
+    "ix_outbox_unsent",
+    outbox.c.id,
+    postgresql_where=outbox.c.sent_at.is_(None),
+)
+
+_mappers_lock = threading.Lock()
+
 
 def start_mappers(engine: Optional[Engine] = None) -> None:
     if engine:
@@ -80,13 +121,64 @@ def start_mappers(engine: Optional[Engine] = None) -> None:
         model.Product,
         products,
         properties={"batches": relationship(mapper_batches)},
+        # UPDATEs are compare-and-swap on the version the product was
+        # loaded with; the domain model is the one bumping it
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
     # mapper(model.Product, products, properties={
     #     "batches": relationship(mapper_batches)})
 
 
+def load_options(strategy: str) -> List[MapperOption]:
+    """Query options loading a Product with its batches and their
+    allocations in a fixed number of queries, however many batches it has
+
+    - "selectin": one query per level (products, batches, allocations)
+    - "joined": a single query, LEFT OUTER JOINing every level
+    - "lazy": each batch's allocations on first access (1 + 1 + B queries)
+    """
+    if strategy == "lazy":
+        return []
+    if strategy == "selectin":
+        return [selectinload("batches").selectinload("_allocations")]
+    if strategy == "joined":
+        return [joinedload("batches").joinedload("_allocations")]
+    raise ValueError(f"Unknown loading strategy {strategy!r}")
+
+
+def ensure_mappers() -> None:
+    "Maps the domain model, unless it already is"
+    with _mappers_lock:
+        if inspect(model.Product, raiseerr=False) is None:
+            start_mappers()
+
+
 # Event below refers to ORM Events'
 # Behavior describet at: https://docs.sqlalchemy.org/en/13/orm/events.html#sqlalchemy.orm.events.InstanceEvents.load  # noqa: E501
 @event.listens_for(model.Product, "load")
 def receive_events_on_loading(product: model.Product, _: Any) -> None:
-    product._events = []
+    product._events = deque()
+    # batches are lazily loaded, so the priority and orders indexes are
+    # only built once the aggregate is asked to (de)allocate
+    product._priority = None
+    product._orders = None
+
+
+@event.listens_for(model.BatchOrder, "load")
+@event.listens_for(model.BatchOrder, "refresh")
+def reset_allocated_quantity(batch: model.BatchOrder, *_: Any) -> None:
+    # `_allocations` is hydrated by the mapper without going through
+    # BatchOrder.allocate, so the running total is recomputed on first use
+    batch._allocated_quantity = None
+
+
+@event.listens_for(model.BatchOrder, "expire")
+def reset_allocated_quantity_on_expire(
+    batch: Optional[model.BatchOrder], attrs: Optional[Any]
+) -> None:
+    # instances may have already been garbage collected when expired
+    if batch is None:
+        return
+    if attrs is None or "_allocations" in attrs:
+        batch._allocated_quantity = None
@@ -0,0 +1,83 @@
+"Connection pool with usage counters"
+# Pool sizing should follow how many connections are really in use at the
+# same time, and how often requests end up waiting for one
+import os
+import threading
+import time
+
+from typing import Any
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that counts checkouts, checkouts that had to wait for a
+    connection to be returned (the pool and its overflow being exhausted),
+    and connections opened beyond `pool_size`. `waiting` is how many
+    checkouts are waiting right now"""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._counters_lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.waiting = 0
+        self.wait_time = 0.0
+        self.peak_overflow = 0
+
+    def _do_get(self) -> Any:
+        exhausted = self._pool.empty() and (
+            self._max_overflow > -1 and self._overflow >= self._max_overflow
+        )
+        if exhausted:
+            with self._counters_lock:
+                self.waiting += 1
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        finally:
+            if exhausted:
+                with self._counters_lock:
+                    self.waiting -= 1
+        elapsed = time.perf_counter() - start
+        with self._counters_lock:
+            self.checkouts += 1
+            if exhausted:
+                self.waits += 1
+                self.wait_time += elapsed
+            self.peak_overflow = max(self.peak_overflow, self._overflow)
+        return record
+
+    def stats(self) -> dict:
+        return dict(
+            size=self.size(),
+            checked_out=self.checkedout(),
+            overflow=max(self.overflow(), 0),
+            peak_overflow=self.peak_overflow,
+            checkouts=self.checkouts,
+            waits=self.waits,
+            waiting=self.waiting,
+            wait_time=round(self.wait_time, 6),
+        )
+
+
+# Connections opened by a process must not be used by the ones it forks:
+# both would be talking to the server over the same socket
+@event.listens_for(InstrumentedQueuePool, "connect")
+def record_pid(dbapi_connection: Any, connection_record: Any) -> None:
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(InstrumentedQueuePool, "checkout")
+def check_pid(
+    dbapi_connection: Any, connection_record: Any, connection_proxy: Any
+) -> None:
+    pid = os.getpid()
+    if connection_record.info["pid"] != pid:
+        # the pool then opens a new connection for this process
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f"Connection belongs to process {connection_record.info['pid']}"
+            f", not {pid}"
+        )
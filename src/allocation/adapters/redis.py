@@ -1,21 +1,348 @@
-# import redis
-import redis
 import json
+import logging
+import os
+import threading
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
-from typing import Any
 from allocation import config
+from allocation.adapters import codec
+
+if TYPE_CHECKING:
+    import redis
+
+logger = logging.getLogger(__name__)
+
+_client: Optional["redis.Redis"] = None
+_client_pid: Optional[int] = None
 
-r = redis.Redis(**config.get_redis_uri())
+
+def get_client() -> "redis.Redis":
+    """Client for the current process, created on first use. Forked
+    processes get their own instead of the one inherited from the parent"""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        # redis-py is imported here as it takes a good share of startup
+        import redis
+
+        _client = redis.Redis(**config.get_redis_uri())
+        _client_pid = os.getpid()
+    return _client
 
 
 def serialize(message: Any) -> bytes:
-    return json.dumps(message).encode("utf-8")
+    """JSON, dates as ISO 8601 strings. Commands and Events are encoded with
+    `codec` instead, which also decodes them back"""
+    return json.dumps(message, default=codec.json_default).encode("utf-8")
 
 
-def deserialize(message: Any) -> dict:
+def deserialize(message: Any) -> Any:
     return json.loads(message)
 
 
+class PublishBuffer:
+    """Messages published while handling a message, sent to Redis at once
+
+    Every message published or appended is sent, in order, even when equal
+    to another one: distinct events may well have the same content.
+    Messages are flushed in pipelines of at most `max_batch_size`, each of
+    them a single network round trip"""
+
+    def __init__(self, max_batch_size: Optional[int] = None) -> None:
+        self.max_batch_size = (
+            max_batch_size or config.get_redis_publish_batch_size()
+        )
+        # (channel or stream, message, PUBLISH or the stream's maxlen)
+        self._sends: List[Tuple[str, Any, Any]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sends)
+
+    def add(self, channel: str, message: Any) -> None:
+        with self._lock:
+            self._sends.append((channel, message, PUBLISH))
+
+    def append(
+        self, stream: str, message: Any, maxlen: Optional[int] = None
+    ) -> None:
+        with self._lock:
+            self._sends.append((stream, message, maxlen))
+
+    def flush(self, client: Optional["redis.Redis"] = None) -> None:
+        client = client or get_client()
+        with self._lock:
+            sends, self._sends = self._sends, []
+        for start in range(0, len(sends), self.max_batch_size):
+            end = start + self.max_batch_size
+            pipe = client.pipeline(transaction=False)
+            for key, message, maxlen in sends[start:end]:
+                if maxlen is PUBLISH:
+                    pipe.publish(key, message)
+                else:
+                    add_entry(pipe, key, message, maxlen)
+            pipe.execute()
+
+
+# marks messages sent with PUBLISH rather than XADD in a buffer's flush
+PUBLISH = object()
+
+
+def add_entry(
+    client: Any, stream: str, message: Any, maxlen: Optional[int] = None
+) -> Any:
+    """Appends `message` to `stream`, stored in the entry's "message" field.
+    With `maxlen`, the stream is trimmed to about that many entries"""
+    return client.xadd(
+        stream, {"message": message}, maxlen=maxlen, approximate=True
+    )
+
+
+_buffer: ContextVar[Optional[PublishBuffer]] = ContextVar(
+    "publish_buffer", default=None
+)
+
+
+@contextmanager
+def buffered_publishing(flush: bool = True) -> Iterator[PublishBuffer]:
+    """Holds messages published within the block and flushes them once it
+    exits without errors. Nested blocks share the outermost buffer
+
+    With `flush` unset, flushing is left to the caller (e.g. to run it off
+    an event loop)"""
+    buffer = _buffer.get()
+    if buffer is not None:
+        yield buffer
+        return
+
+    buffer = PublishBuffer()
+    token = _buffer.set(buffer)
+    try:
+        yield buffer
+        if flush:
+            buffer.flush()
+    finally:
+        _buffer.reset(token)
+
+
 def publish_message(channel: str, message: Any) -> None:
     # message = serialize(message)
-    r.publish(channel, message)
+    buffer = _buffer.get()
+    if buffer is None:
+        get_client().publish(channel, message)
+    else:
+        buffer.add(channel, message)
+
+
+def append_message(
+    stream: str, message: Any, maxlen: Optional[int] = None
+) -> None:
+    """Same as `publish_message`, appending `message` to a stream instead:
+    it waits there for consumers (see `StreamConsumer`) rather than being
+    lost when none is listening. `maxlen` defaults to the configured one"""
+    if maxlen is None:
+        maxlen = config.get_redis_stream_settings()["maxlen"]
+    buffer = _buffer.get()
+    if buffer is None:
+        add_entry(get_client(), stream, message, maxlen)
+    else:
+        buffer.append(stream, message, maxlen)
+
+
+# (stream, entry id, message) of an entry read by a StreamConsumer
+Entry = Tuple[str, bytes, Any]
+
+
+class StreamConsumer:
+    """Reads `streams` as `consumer`, a member of the consumer group `group`
+
+    Each entry is delivered to a single member of the group and stays
+    pending until acknowledged with `ack`. `read` hands out, in order:
+
+    1. entries this consumer read before restarting but did not ack
+    2. entries left pending for `claim_idle_ms`, by consumers that probably
+       died handling them or by handlers that failed; those delivered
+       `max_deliveries` times already are logged and dropped instead
+    3. new entries, up to `count` at a time, blocking up to `block_ms`
+
+    Settings default to `config.get_redis_stream_settings`"""
+
+    def __init__(
+        self,
+        group: str,
+        consumer: str,
+        streams: Iterable[str],
+        client: Optional["redis.Redis"] = None,
+        **settings: int,
+    ) -> None:
+        self.group = group
+        self.consumer = consumer
+        self.streams = list(streams)
+        self.client = client or get_client()
+        self.settings = {**config.get_redis_stream_settings(), **settings}
+        # own pending entries are read from these ids on, until none is left
+        self._recovered: Dict[str, Any] = {s: "0" for s in self.streams}
+        self._recovering = True
+        for stream in self.streams:
+            self._create_group(stream)
+
+    def _create_group(self, stream: str) -> None:
+        import redis
+
+        if self.client.exists(stream):
+            groups = self.client.xinfo_groups(stream)
+            if any(g["name"].decode() == self.group for g in groups):
+                return
+        try:
+            # from the start, so entries added before any consumer ran are
+            # delivered too
+            self.client.xgroup_create(stream, self.group, "0", mkstream=True)
+        except redis.ResponseError as ex:
+            if "BUSYGROUP" not in str(ex):
+                raise
+
+    def read(self) -> List[Entry]:
+        if self._recovering:
+            entries = self._read(dict(self._recovered), block=None)
+            for stream, entry_id, _ in entries:
+                self._recovered[stream] = entry_id
+            if entries:
+                return entries
+            self._recovering = False
+        entries = self.reclaim()
+        if entries:
+            return entries
+        new = {stream: ">" for stream in self.streams}
+        return self._read(new, block=self.settings["block_ms"])
+
+    def _read(self, streams: Dict[str, Any], block: Optional[int]) -> List:
+        found = self.client.xreadgroup(
+            self.group,
+            self.consumer,
+            streams,
+            count=self.settings["count"],
+            block=block,
+        )
+        entries: List[Entry] = []
+        for stream, read in found or []:
+            for entry_id, fields in read:
+                if fields:
+                    message = fields[b"message"]
+                    entries.append((stream.decode(), entry_id, message))
+                else:
+                    # trimmed while pending, there is nothing left to handle
+                    self.ack(stream.decode(), entry_id)
+        return entries
+
+    def retry(self, stream: str) -> None:
+        """Makes `read` hand out this consumer's pending entries of `stream`
+        again, oldest first, before any new entry"""
+        self._recovered[stream] = "0"
+        self._recovering = True
+
+    def reclaim(self) -> List[Entry]:
+        "Takes over entries left pending for too long"
+        idle = self.settings["claim_idle_ms"]
+        claimed: List[Entry] = []
+        for stream in self.streams:
+            pending = self.client.xpending_range(
+                stream, self.group, "-", "+", self.settings["count"]
+            )
+            stale = [e for e in pending if e["time_since_delivered"] >= idle]
+            dropped = [
+                entry["message_id"]
+                for entry in stale
+                if entry["times_delivered"] >= self.settings["max_deliveries"]
+            ]
+            if dropped:
+                logger.error("Dropping undeliverable %s %s", stream, dropped)
+                self.ack(stream, *dropped)
+            retried = [
+                entry["message_id"]
+                for entry in stale
+                if entry["message_id"] not in dropped
+            ]
+            if retried:
+                entries = self.client.xclaim(
+                    stream, self.group, self.consumer, idle, retried
+                )
+                claimed.extend(
+                    (stream, entry_id, fields[b"message"])
+                    for entry_id, fields in entries
+                    if fields
+                )
+        return claimed
+
+    def ack(self, stream: str, *entry_ids: bytes) -> None:
+        if entry_ids:
+            self.client.xack(stream, self.group, *entry_ids)
+
+
+# Allocations read model: one hash per order, `allocations:<order_id>`,
+# with a field per order line (its sku) holding the serialized allocation
+ALLOCATIONS_KEY = "allocations:{order_id}"
+
+
+def allocations_key(order_id: str) -> str:
+    return ALLOCATIONS_KEY.format(order_id=order_id)
+
+
+def get_allocations(order_id: str) -> List[dict]:
+    "Allocations of an order in a single round trip, empty when unknown"
+    found = get_client().hgetall(allocations_key(order_id))
+    return [deserialize(allocation) for allocation in found.values()]
+
+
+def set_allocations(
+    rows: Iterable[dict], client: Optional["redis.Redis"] = None
+) -> None:
+    """Stores rows shaped like `allocations_view`'s (`id_orderline`,
+    `batchref`, `sku`, `qty`), pipelined in batches"""
+    client = client or get_client()
+    batch_size = config.get_redis_publish_batch_size()
+    pipe = client.pipeline(transaction=False)
+    for i, row in enumerate(rows, 1):
+        allocation = dict(
+            batchref=row["batchref"], sku=row["sku"], qty=row["qty"]
+        )
+        key = allocations_key(row["id_orderline"])
+        pipe.hset(key, row["sku"], serialize(allocation))
+        if i % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def remove_allocations(
+    lines: Iterable[Tuple[str, str]], client: Optional["redis.Redis"] = None
+) -> None:
+    "Removes the allocations of (order_id, sku) lines in a single pipeline"
+    pipe = (client or get_client()).pipeline(transaction=False)
+    for order_id, sku in lines:
+        pipe.hdel(allocations_key(order_id), sku)
+    pipe.execute()
+
+
+def clear_allocations(
+    match: str = "*", client: Optional["redis.Redis"] = None
+) -> int:
+    """Deletes the allocations of orders whose id matches the glob-style
+    `match`, the whole read model by default. Returns how many were deleted"""
+    client = client or get_client()
+    pattern = ALLOCATIONS_KEY.format(order_id=match)
+    keys = list(client.scan_iter(match=pattern, count=1000))
+    batch_size = config.get_redis_publish_batch_size()
+    for start in range(0, len(keys), batch_size):
+        end = start + batch_size
+        client.delete(*keys[start:end])
+    return len(keys)
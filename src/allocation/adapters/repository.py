@@ -5,12 +5,17 @@
 # Aggregate Collection
 # Rui Conti, Apr 2020
 import abc
-from typing import List, Set
+import os
+import pickle
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.orm import Query, Session
 
-from allocation.adapters import orm
-from allocation.domain import model
+from allocation import config
+from allocation.adapters import cache as product_cache, orm
+from allocation.domain import events, model
 
 
 class AbstractProductRepository(abc.ABC):
@@ -56,19 +61,52 @@ class AbstractProductRepository(abc.ABC):
 
 
 class SqlAlchemyProductRepository(AbstractProductRepository):
-    def __init__(self, session: Session):
+    def __init__(
+        self,
+        session: Session,
+        load_strategy: Optional[str] = None,
+        cache: Optional[product_cache.ProductCache] = None,
+    ):
+        """`load_strategy` defaults to `config.get_product_load_strategy`.
+        Products found in `cache` are attached to `session` instead of
+        being loaded, as long as their version is up to date"""
         self.session = session
+        self.load_strategy = (
+            load_strategy or config.get_product_load_strategy()
+        )
+        self.cache = cache
         super().__init__()
 
+    def _query(self) -> Query:
+        return self.session.query(model.Product).options(
+            *orm.load_options(self.load_strategy)
+        )
+
     def _add(self, product: model.Product) -> None:
         self.session.add(product)
 
+    def _version(self, sku: str) -> Optional[int]:
+        return self.session.execute(
+            select([orm.products.c.version_number]).where(
+                orm.products.c.sku == sku
+            )
+        ).scalar()
+
     def _get(self, sku: str) -> model.Product:
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        key = self.session.identity_key(model.Product, sku)
+        if self.cache is not None and key not in self.session.identity_map:
+            product = self.cache.checkout(sku, lambda: self._version(sku))
+            if product is not None:
+                self.session.add(product)
+                return product
+        return self._query().filter_by(sku=sku).first()
 
     def _get_by_batchref(self, batchref: str) -> model.Product:
+        sku = self.cache and self.cache.sku_for(batchref)
+        if sku:
+            return self._get(sku)
         return (
-            self.session.query(model.Product)
+            self._query()
             .join(model.BatchOrder)
             .filter(orm.batches.c.reference == batchref,)
             # READ: Tables' `c` attribute makes reference to joined table columns
@@ -78,7 +116,7 @@ class SqlAlchemyProductRepository(AbstractProductRepository):
     # join(model.BatchOrder)
 
     def list(self) -> List[model.Product]:
-        return self.session.query(model.Product).all()
+        return self._query().all()
 
 
 class FakeProductRepository(AbstractProductRepository):
@@ -110,3 +148,191 @@ class FakeProductRepository(AbstractProductRepository):
     #     return list(self._batches)
     def list(self) -> list:
         return list(self._products)
+
+
+class InMemoryStore:
+    """Products kept in memory, with hash indexes by sku and by batch
+    reference. Units of Work sharing a store hold `lock` while entered
+
+    The store can be saved to (and loaded from) a file, on demand or
+    periodically (see `save_every`)"""
+
+    def __init__(self, products: Iterable[model.Product] = ()) -> None:
+        self.products: Dict[str, model.Product] = {}
+        self._batchrefs: Dict[str, str] = {}
+        # batches are only ever appended, so only the ones past the
+        # indexed count have to be indexed
+        self._indexed: Dict[str, int] = {}
+        self.lock = threading.RLock()
+        for product in products:
+            self.add(product)
+
+    def add(self, product: model.Product) -> None:
+        self.products[product.sku] = product
+        self.index(product)
+
+    def index(self, product: model.Product) -> None:
+        indexed = self._indexed.get(product.sku, 0)
+        for batch in product.batches[indexed:]:
+            self._batchrefs[batch.reference] = product.sku
+        self._indexed[product.sku] = len(product.batches)
+
+    def sku_of(self, batchref: str) -> Optional[str]:
+        return self._batchrefs.get(batchref)
+
+    def get_by_batchref(self, batchref: str) -> Optional[model.Product]:
+        sku = self.sku_of(batchref)
+        return self.products.get(sku) if sku is not None else None
+
+    def save(self, path: str) -> None:
+        """Writes the products to `path`, atomically: a reader (or a crash)
+        never sees half a snapshot"""
+        with self.lock:
+            snapshot = [_dump(product) for product in self.products.values()]
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> "InMemoryStore":
+        with open(path, "rb") as file:
+            return cls(_load(product) for product in pickle.load(file))
+
+    def save_every(self, path: str, interval: float) -> threading.Event:
+        "Saves to `path` every `interval` seconds, until the event is set"
+        stop = threading.Event()
+
+        def save() -> None:
+            while not stop.wait(interval):
+                self.save(path)
+
+        threading.Thread(target=save, name="snapshots", daemon=True).start()
+        return stop
+
+
+# Snapshots hold plain values rather than the aggregates themselves, so
+# they can be loaded by later versions of the domain model
+def _dump(product: model.Product) -> tuple:
+    return (
+        product.sku,
+        product.version_number,
+        [
+            (
+                batch.reference,
+                batch.sku,
+                batch.qty_purchase,
+                batch.eta,
+                [
+                    (line.order_id, line.sku, line.qty)
+                    for line in batch._allocations
+                ],
+            )
+            for batch in product.batches
+        ],
+    )
+
+
+def _load(dumped: Any) -> model.Product:
+    sku, version_number, dumped_batches = dumped
+    batches = []
+    for ref, batch_sku, qty, eta, lines in dumped_batches:
+        batch = model.BatchOrder(ref, batch_sku, qty, eta)
+        # as they were, even lines that would not be allocated anymore
+        batch._allocations.update(model.OrderLine(*line) for line in lines)
+        batch._allocated_quantity = None
+        batches.append(batch)
+    return model.Product(sku, batches, version_number)
+
+
+class InMemoryProductRepository(AbstractProductRepository):
+    """Repository over an InMemoryStore: lookups by sku and batch reference
+    are dictionary lookups instead of scans
+
+    Stored products are changed in place. Only a checkpoint of each product
+    looked up is kept (how many events, batches and which version it had),
+    and `rollback` undoes the changes recorded by the events raised since:
+    lookups stay O(1) whatever the number of lines, and only rollbacks pay
+    for what they undo"""
+
+    def __init__(self, store: InMemoryStore):
+        super().__init__()
+        self.store = store
+        self._new: Dict[str, model.Product] = {}
+        self._checkpoints: Dict[str, Tuple[int, int, int]] = {}
+
+    def _add(self, product: model.Product) -> None:
+        self._new[product.sku] = product
+
+    def _get(self, sku: str) -> model.Product:
+        if sku in self._new:
+            return self._new[sku]
+        product = self.store.products.get(sku)
+        if product is not None and sku not in self._checkpoints:
+            self._checkpoints[sku] = _checkpoint(product)
+        return product  # type: ignore
+
+    def _get_by_batchref(self, batchref: str) -> model.Product:
+        sku = self.store.sku_of(batchref)
+        if sku is not None:
+            return self._get(sku)
+        # batches added since the last commit are not indexed yet
+        for product in {*self.seen, *self._new.values()}:
+            if any(b.reference == batchref for b in product.batches):
+                return product
+        return None  # type: ignore
+
+    def commit(self) -> None:
+        for product in self._new.values():
+            self.store.add(product)
+        for product in self.seen:
+            self.store.index(product)
+        # later changes are undone back to the committed state
+        self._checkpoints = {p.sku: _checkpoint(p) for p in self.seen}
+        self._new.clear()
+
+    def rollback(self) -> None:
+        for sku, checkpoint in self._checkpoints.items():
+            _undo(self.store.products[sku], checkpoint)
+        self._checkpoints.clear()
+        self._new.clear()
+
+    def list(self) -> List[model.Product]:
+        return [*self.store.products.values(), *self._new.values()]
+
+
+def _checkpoint(product: model.Product) -> Tuple[int, int, int]:
+    return len(product._events), len(product.batches), product.version_number
+
+
+def _undo(product: model.Product, checkpoint: Tuple[int, int, int]) -> None:
+    """Reverts `product` to `checkpoint` by undoing, latest first, what the
+    events it raised since then record. Lines are put back or taken out of
+    the very batches they were in, so none is dropped nor moved"""
+    raised, batches, version_number = checkpoint
+    by_ref: Dict[str, model.BatchOrder] = {}
+    while len(product._events) > raised:
+        event = product._events.pop()
+        if not isinstance(event, (events.Allocated, events.Deallocated)):
+            continue
+        if not by_ref:
+            by_ref = {batch.reference: batch for batch in product.batches}
+        batch = by_ref[event.batch_ref]
+        line = model.OrderLine(event.order_id, event.sku, event.qty)
+        if isinstance(event, events.Allocated):
+            batch.deallocate(line)
+            if product._orders is not None:
+                del product._orders[line.order_id]
+        else:
+            batch.allocate(line)
+            if product._orders is not None:
+                product._orders[line.order_id] = (batch, line)
+        if product._priority is not None:
+            product._priority.touch(batch)
+    if len(product.batches) > batches:
+        del product.batches[batches:]
+        # rebuilt without the dropped batches on its next use
+        product._priority = None
+    product.version_number = version_number
@@ -15,8 +15,135 @@ def get_postgres_uri() -> str:
     return heroku_url if heroku_url else default_url
 
 
+def get_postgres_isolation_level() -> str:
+    """Products are only updated if their version number is the one they
+    were loaded with, so READ COMMITTED keeps allocations consistent too,
+    turning conflicting commits into retried commands"""
+    return os.environ.get("DB_ISOLATION_LEVEL", "SERIALIZABLE")
+
+
+def get_postgres_pool_settings() -> dict:
+    """Keyword arguments for the engine's connection pool. Defaults are
+    SQLAlchemy's own; a negative recycle never recycles connections"""
+    env = os.environ.get
+    return dict(
+        pool_size=int(env("DB_POOL_SIZE", 5)),
+        max_overflow=int(env("DB_POOL_MAX_OVERFLOW", 10)),
+        pool_timeout=float(env("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(env("DB_POOL_RECYCLE", -1)),
+        pool_pre_ping=env("DB_POOL_PRE_PING", "0").lower()
+        in ("1", "true", "yes"),
+    )
+
+
+def get_product_load_strategy() -> str:
+    "How products' batches and allocations are loaded, see `orm.load_options`"
+    return os.environ.get("PRODUCT_LOAD_STRATEGY", "selectin")
+
+
+def get_product_cache_size() -> int:
+    "Products kept loaded across Units of Work, zero disables the cache"
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+
+
 def get_redis_uri() -> dict:
     host = os.environ.get("REDIS_HOST", "localhost")
     port = os.environ.get("REDIS_PORT", 6379)
 
     return dict(host=host, port=port)
+
+
+def get_redis_publish_batch_size() -> int:
+    "Most messages sent to Redis in a single pipeline"
+    return int(os.environ.get("REDIS_PUBLISH_BATCH_SIZE", 500))
+
+
+def get_message_format() -> str:
+    """How Commands and Events are encoded when sent out: "binary" or
+    "json" (see `codec`). Both are always understood when received"""
+    return os.environ.get("MESSAGE_FORMAT", "binary")
+
+
+def get_redis_stream_settings() -> dict:
+    """Event streams are trimmed to about `maxlen` entries. Consumers read
+    up to `count` entries at a time, blocking up to `block_ms` for them, and
+    take over entries left unacknowledged by another consumer for
+    `claim_idle_ms`. Entries delivered `max_deliveries` times are dropped"""
+    env = os.environ.get
+    return dict(
+        maxlen=int(env("REDIS_STREAM_MAXLEN", 100_000)),
+        count=int(env("REDIS_STREAM_COUNT", 100)),
+        block_ms=int(env("REDIS_STREAM_BLOCK_MS", 1000)),
+        claim_idle_ms=int(env("REDIS_STREAM_CLAIM_IDLE_MS", 60_000)),
+        max_deliveries=int(env("REDIS_STREAM_MAX_DELIVERIES", 5)),
+    )
+
+
+def get_allocations_read_model() -> str:
+    """Where `GET /allocations/<order_id>` is answered from: "sql" reads
+    `allocations_view`, "redis" reads the per-order hashes first and falls
+    through to SQL when an order is not there"""
+    return os.environ.get("ALLOCATIONS_READ_MODEL", "sql")
+
+
+def get_read_model_projection_settings() -> dict:
+    """With `projection` "inline", `allocations_view` is written by the
+    event handlers; with "projector", allocation events are appended to
+    `stream` (trimmed to about `maxlen` entries) and applied by
+    `entrypoints.projector` in transactions of up to `batch_size` events"""
+    env = os.environ.get
+    return dict(
+        projection=env("READ_MODEL_PROJECTION", "inline"),
+        stream=env("READ_MODEL_STREAM", "allocations-read-model"),
+        maxlen=int(env("READ_MODEL_STREAM_MAXLEN", 1_000_000)),
+        batch_size=int(env("READ_MODEL_BATCH_SIZE", 500)),
+    )
+
+
+def get_outbox_settings() -> dict:
+    """With `publishing` "inline", handlers send events to Redis after the
+    command commits; with "outbox", events are written to the `outbox`
+    table in the command's transaction, and `entrypoints.relay` sends them
+    in batches of `batch_size`, polling every `poll_interval` seconds when
+    idle and deleting rows sent more than `retention` seconds ago"""
+    env = os.environ.get
+    return dict(
+        publishing=env("EVENT_PUBLISHING", "inline"),
+        batch_size=int(env("OUTBOX_BATCH_SIZE", 500)),
+        poll_interval=float(env("OUTBOX_POLL_INTERVAL", 0.5)),
+        retention=float(env("OUTBOX_RETENTION", 24 * 60 * 60)),
+    )
+
+
+def get_command_retry_settings() -> dict:
+    """Attempts at a command whose commit conflicts with a concurrent one,
+    waiting a random time up to `backoff` seconds, doubled at every retry"""
+    attempts = int(os.environ.get("COMMAND_RETRY_ATTEMPTS", 3))
+    backoff = float(os.environ.get("COMMAND_RETRY_BACKOFF", 0.01))
+
+    return dict(attempts=attempts, backoff=backoff)
+
+
+def get_command_executor_settings() -> dict:
+    "Zero partitions handles commands on the request's thread"
+    partitions = int(os.environ.get("COMMAND_PARTITIONS", 0))
+    max_queue = int(os.environ.get("COMMAND_QUEUE_SIZE", 1000))
+
+    return dict(partitions=partitions, max_queue=max_queue)
+
+
+def get_consumer_settings() -> dict:
+    """Consumer processes run by `entrypoints.supervisor`, and how long they
+    are given to finish the messages they hold when stopped"""
+    processes = int(os.environ.get("CONSUMER_PROCESSES", os.cpu_count() or 1))
+    drain_timeout = float(os.environ.get("CONSUMER_DRAIN_TIMEOUT", 30))
+
+    return dict(processes=processes, drain_timeout=drain_timeout)
+
+
+def get_event_dispatch_settings() -> dict:
+    "Zero workers keeps event handling inline, on the request's thread"
+    workers = int(os.environ.get("EVENT_DISPATCH_WORKERS", 0))
+    max_queue = int(os.environ.get("EVENT_DISPATCH_QUEUE_SIZE", 1000))
+
+    return dict(workers=workers, max_queue=max_queue)
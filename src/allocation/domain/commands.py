@@ -5,28 +5,30 @@
 # A command should modify a single aggregate and either succeed
 # or fail in totality. Any other bookeeping, cleanup and notification
 # happens with an Event
-from dataclasses import dataclass
 from datetime import date
 from typing import Optional
 
+from allocation.domain.messages import message
+
 
 class Command:
-    pass
+    __slots__ = ()
 
 
-@dataclass
+@message
 class Allocate(Command):
     order_id: str
     sku: str
     qty: int
 
 
-@dataclass
+@message
 class Deallocate(Command):
     sku: str
+    order_id: Optional[str] = None
 
 
-@dataclass
+@message
 class CreateBatch(Command):
     ref: str
     sku: str
@@ -34,7 +36,11 @@ class CreateBatch(Command):
     eta: Optional[date]
 
 
-@dataclass
+@message
 class ChangeBatchQuantity(Command):
+    """`sku` is that of the batch: consumer processes route commands by
+    SKU, and those without one are not ordered with the rest of theirs"""
+
     ref: str
     qty: int
+    sku: Optional[str] = None
@@ -3,25 +3,31 @@
 # identifiable by their meta-attributes
 # Semantics: Represents something that has happened
 from typing import Optional
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import fields
+from datetime import date, datetime
+
+from allocation.domain.messages import message
 
 
 class Event:
+    __slots__ = ()
     when: datetime = datetime.now()
 
     def __str__(self) -> str:
-        d = self.__dict__
+        d = {
+            f.name: getattr(self, f.name)
+            for f in fields(self)  # type: ignore
+        }
         d["name"] = self.__class__.__name__
         return str(d)
 
 
-@dataclass
+@message
 class OutOfStock(Event):
     sku: str
 
 
-@dataclass
+@message
 class Allocated(Event):
     order_id: str
     batch_ref: str
@@ -29,7 +35,7 @@ class Allocated(Event):
     qty: int
 
 
-@dataclass
+@message
 class Deallocated(Event):
     batch_ref: str
     order_id: str
@@ -37,19 +43,24 @@ class Deallocated(Event):
     qty: int
 
 
-@dataclass
+@message
 class BatchCreated(Event):
     batch_ref: str
     sku: str
     qty: int
-    eta: Optional[datetime]
+    eta: Optional[date]
 
 
-@dataclass
+@message
 class OrderAlreadyAllocated(Event):
     order_id: str
 
 
-@dataclass
+@message
+class OrderNotAllocated(Event):
+    order_id: str
+
+
+@message
 class AllocationsEmpty(Event):
     pass
@@ -0,0 +1,32 @@
+"Messages' representation"
+# Commands and Events are Value Objects that get created by the thousands
+# (one per allocated line on bulk operations) and are never extended with
+# new attributes, so they are stored in `__slots__` rather than in a
+# per-instance `__dict__`
+from dataclasses import dataclass, fields
+from typing import TYPE_CHECKING, Any, Set
+
+if TYPE_CHECKING:
+    # type checkers only understand `dataclasses.dataclass` itself
+    from dataclasses import dataclass as message  # noqa: F401
+else:
+
+    def message(cls: Any) -> Any:
+        """Turns `cls` into a dataclass whose fields live in `__slots__`
+
+        Equivalent to `dataclass(slots=True)`, which is only available from
+        Python 3.10 on. Defaults are kept by the generated `__init__`, so
+        they do not clash with the slot descriptors"""
+        cls = dataclass(cls)
+        names = [f.name for f in fields(cls)]
+        inherited: Set[str] = set()
+        for base in cls.__mro__[1:]:
+            inherited.update(getattr(base, "__slots__", ()))
+
+        namespace = dict(cls.__dict__)
+        for name in names:
+            namespace.pop(name, None)
+        namespace.pop("__dict__", None)
+        namespace.pop("__weakref__", None)
+        namespace["__slots__"] = tuple(n for n in names if n not in inherited)
+        return type(cls)(cls.__name__, cls.__bases__, namespace)
@@ -8,9 +8,12 @@
 #       of business transactions and services
 # Cleanest layer and no extenral dependencies are made
 # Rui Conti, Apr 2020
+import heapq
+import itertools
+from collections import deque
 from datetime import date
 
-from typing import Optional, List
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from allocation.domain import events
 
@@ -60,6 +63,7 @@ class BatchOrder:
         self.eta = eta
         self.qty_purchase = qty
         self._allocations: set = set()
+        self._allocated_quantity: Optional[int] = 0
 
     def __repr__(self) -> str:
         return f"<BatchOrder {self.reference}>"
@@ -94,7 +98,15 @@ class BatchOrder:
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        """Running total kept up to date by `allocate` and `deallocate`
+
+        It is `None` while unknown (e.g. when the ORM has just loaded or
+        expired `_allocations`) and then recomputed once from the lines"""
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(
+                line.qty for line in self._allocations
+            )
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -102,10 +114,25 @@ class BatchOrder:
 
     def allocate(self, line: OrderLine) -> None:
         if self.can_allocate(line):
+            allocated = self.allocated_quantity
             self._allocations.add(line)
-
-    def deallocate(self) -> OrderLine:
-        return self._allocations.pop()
+            self._allocated_quantity = allocated + line.qty
+
+    def deallocate(self, line: Optional[OrderLine] = None) -> OrderLine:
+        "Removes `line` or, when none is given, an arbitrary one"
+        allocated = self.allocated_quantity
+        if line is None:
+            line = self._allocations.pop()
+        else:
+            self._allocations.remove(line)
+        self._allocated_quantity = allocated - line.qty
+        return line
+
+    def is_consistent(self) -> bool:
+        "Whether the running total matches the allocated lines"
+        return self.allocated_quantity == sum(
+            line.qty for line in self._allocations
+        )
 
     def can_deallocate(self) -> bool:
         return len(self._allocations) > 0
@@ -123,6 +150,91 @@ class BatchOrder:
         return all([cond_qty, cond_idem, cond_sku])
 
 
+class _Descending:
+    "Inverts ordering of a priority key so `heapq` behaves as a max-heap"
+    __slots__ = ("key",)
+
+    def __init__(self, key: Tuple) -> None:
+        self.key = key
+
+    def __lt__(self, other: "_Descending") -> bool:
+        return other.key < self.key
+
+
+class BatchPriorityIndex:
+    """Keeps a Product's batches ordered by allocation priority
+
+    Batches in stock (no ETA) come first, then shipments by ascending ETA,
+    ties broken by the order in which batches were added. This is the same
+    order `sorted(batches)` yields through `BatchOrder.__gt__`, but it is
+    maintained incrementally with two heaps instead of re-sorted on every
+    allocation:
+        `_available`: batches that may still have capacity (min-heap)
+        `_allocated`: batches that may still hold lines (max-heap)
+
+    Entries are discarded lazily: a batch that ran out of capacity (or of
+    lines) is dropped when it reaches the top of its heap and pushed back
+    through `touch` once it changes again"""
+
+    def __init__(self, batches: List[BatchOrder]) -> None:
+        self._sequence: Iterator[int] = itertools.count()
+        self._keys: Dict[BatchOrder, Tuple] = {}
+        self._available: List[Tuple[Tuple, BatchOrder]] = []
+        self._allocated: List[Tuple[_Descending, BatchOrder]] = []
+        self._in_available: Set[BatchOrder] = set()
+        self._in_allocated: Set[BatchOrder] = set()
+        for batch in batches:
+            self.add(batch)
+
+    def add(self, batch: BatchOrder) -> None:
+        if batch in self._keys:
+            return
+        self._keys[batch] = (
+            batch.eta is not None,
+            batch.eta,
+            next(self._sequence),
+        )
+        self.touch(batch)
+
+    def touch(self, batch: BatchOrder) -> None:
+        "Requeues `batch` after its allocations have changed"
+        key = self._keys[batch]
+        if batch.available_quantity > 0 and batch not in self._in_available:
+            heapq.heappush(self._available, (key, batch))
+            self._in_available.add(batch)
+        if batch.can_deallocate() and batch not in self._in_allocated:
+            heapq.heappush(self._allocated, (_Descending(key), batch))
+            self._in_allocated.add(batch)
+
+    def first_fit(self, line: OrderLine) -> Optional[BatchOrder]:
+        "Most prioritized batch that is able to allocate `line`"
+        skipped: List[Tuple[Tuple, BatchOrder]] = []
+        try:
+            while self._available:
+                _, batch = self._available[0]
+                if batch.available_quantity <= 0:
+                    heapq.heappop(self._available)
+                    self._in_available.discard(batch)
+                elif batch.can_allocate(line):
+                    return batch
+                else:
+                    skipped.append(heapq.heappop(self._available))
+            return None
+        finally:
+            for entry in skipped:
+                heapq.heappush(self._available, entry)
+
+    def last_allocated(self) -> Optional[BatchOrder]:
+        "Least prioritized batch that holds at least one line"
+        while self._allocated:
+            _, batch = self._allocated[0]
+            if batch.can_deallocate():
+                return batch
+            heapq.heappop(self._allocated)
+            self._in_allocated.discard(batch)
+        return None
+
+
 class Product:
     def __init__(
         self, sku: str, batches: List[BatchOrder], version_number: int = 0,
@@ -130,7 +242,9 @@ class Product:
         self.sku: str = sku
         self.batches: List[BatchOrder] = batches
         self.version_number: int = version_number
-        self._events: List[events.Event] = []
+        self._events: Deque[events.Event] = deque()
+        self._priority: Optional[BatchPriorityIndex] = None
+        self._orders: Optional[Dict[str, Tuple[BatchOrder, OrderLine]]] = None
         # whenever we make a change to an instance of Product, we
         # increment version_number
 
@@ -141,58 +255,103 @@ class Product:
         except IndexError:
             return None
 
+    @property
+    def priority(self) -> BatchPriorityIndex:
+        """Built on first use, so aggregates loaded by the ORM (whose batches
+        are lazily loaded) only pay for it when they allocate"""
+        if self._priority is None:
+            self._priority = BatchPriorityIndex(self.batches)
+        return self._priority
+
+    @property
+    def orders(self) -> Dict[str, Tuple[BatchOrder, OrderLine]]:
+        "Allocated lines (and the batch holding them) by `order_id`"
+        if self._orders is None:
+            self._orders = {}
+            for batch in self.batches:
+                self._index_lines(batch)
+        return self._orders
+
+    def _index_lines(self, batch: BatchOrder) -> None:
+        assert self._orders is not None
+        for line in batch._allocations:
+            self._orders[line.order_id] = (batch, line)
+
     def add_batch(self, batch: BatchOrder) -> None:
         self.batches.append(batch)
+        if self._priority is not None:
+            self._priority.add(batch)
+        if self._orders is not None:
+            self._index_lines(batch)
+        self.version_number += 1
         self._events.append(
             events.BatchCreated(
                 batch.reference, batch.sku, batch.qty_purchase, batch.eta
             )
         )
 
-    def allocate(self, line: OrderLine) -> None:
+    def _allocate(self, line: OrderLine) -> events.Event:
+        "Allocates `line` and returns the event that records the outcome"
         try:
-            # I can use sorted the way I want by defining __gt__
-            batch = next(
-                b for b in sorted(self.batches) if b.can_allocate(line)
-            )
-            batch.allocate(line)
-            self._events.append(
-                events.Allocated(
-                    order_id=line.order_id,
-                    batch_ref=batch.reference,
-                    sku=line.sku,
-                    qty=line.qty,
+            if line.order_id in self.orders:
+                raise BatchIdempotency(
+                    f"Order {line.order_id} already allocated to {self.sku}"
                 )
-            )
-            self.version_number += 1  # here
-            # return batch.reference
-        except StopIteration:
-            # raise OutOfStock(f"Out of stock for SKU {line.sku}")
-            self._events.append(events.OutOfStock(sku=line.sku))
+            batch = self.priority.first_fit(line)
         except BatchIdempotency:
-            self._events.append(
-                events.OrderAlreadyAllocated(order_id=line.order_id)
-            )
-        # return None
+            return events.OrderAlreadyAllocated(order_id=line.order_id)
 
-    def deallocate(self) -> None:
-        try:
-            batch = next(
-                b
-                for b in sorted(self.batches, reverse=True)
-                if b.can_deallocate()
-            )
+        if batch is None:
+            # raise OutOfStock(f"Out of stock for SKU {line.sku}")
+            return events.OutOfStock(sku=line.sku)
+
+        batch.allocate(line)
+        self.priority.touch(batch)
+        self.orders[line.order_id] = (batch, line)
+        self.version_number += 1  # here
+        return events.Allocated(
+            order_id=line.order_id,
+            batch_ref=batch.reference,
+            sku=line.sku,
+            qty=line.qty,
+        )
+
+    def allocate(self, line: OrderLine) -> None:
+        self._events.append(self._allocate(line))
+
+    def allocate_many(self, lines: Iterable[OrderLine]) -> None:
+        """Allocates a backlog of lines, in order, with the same outcome as
+        calling `allocate` for each of them
+
+        Events are recorded in a single step at the end"""
+        self._events.extend([self._allocate(line) for line in lines])
+
+    def deallocate(self, order_id: Optional[str] = None) -> None:
+        """Deallocates the line of `order_id` or, when none is given, a line
+        from the least prioritized batch"""
+        # built before any batch drops the line, which it must index
+        orders = self.orders
+        if order_id is None:
+            batch = self.priority.last_allocated()
+            if batch is None:
+                self._events.append(events.AllocationsEmpty())
+                return
             line = batch.deallocate()
-            self._events.append(
-                events.Deallocated(
-                    batch_ref=batch.reference,
-                    order_id=line.order_id,
-                    sku=line.sku,
-                    qty=line.qty,
-                )
+        elif order_id in orders:
+            batch, line = orders[order_id]
+            batch.deallocate(line)
+        else:
+            self._events.append(events.OrderNotAllocated(order_id=order_id))
+            return
+
+        del orders[line.order_id]
+        self.priority.touch(batch)
+        self._events.append(
+            events.Deallocated(
+                batch_ref=batch.reference,
+                order_id=line.order_id,
+                sku=line.sku,
+                qty=line.qty,
             )
-            self.version_number += 1
-        except KeyError:
-            self._events.append(events.AllocationsEmpty())
-            # return None
-            # raise OutOfStock(f"There are no stock left")
+        )
+        self.version_number += 1
@@ -1,20 +1,67 @@
-from flask import Flask, jsonify, request
+import atexit
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from allocation.domain import commands
+from flask import Blueprint, Flask, Response, jsonify, request
+
+from allocation.domain import commands, events
 from allocation.service import handlers, unit_of_work, message_bus
-from allocation import views
+from allocation.service.dispatcher import EventDispatcher
+from allocation.service.executor import PartitionedExecutor
+from allocation.service.projector import Projector
+from allocation.service.relay import Relay
+from allocation import config, views
 from allocation.adapters import orm
 
-orm.start_mappers()
-app = Flask(__name__)
+api = Blueprint("allocation", __name__)
+dispatcher: Optional[EventDispatcher] = None
+dispatcher_lock = threading.Lock()
+executor: Optional[PartitionedExecutor] = None
+executor_lock = threading.Lock()
+# the read model lag and the outbox backlog are queries: scrapes reuse
+# their last value for this many seconds instead of running them every time
+QUERIED_METRICS_TTL = 10.0
+queried_metrics: Dict[str, Tuple[float, Any]] = {}
+
+
+def get_dispatch() -> Optional[Callable[[events.Event], None]]:
+    """Events are dispatched in the background when EVENT_DISPATCH_WORKERS
+    is set, so responses do not wait for downstream handlers"""
+    global dispatcher
+    settings = config.get_event_dispatch_settings()
+    if not settings["workers"]:
+        return None
+    with dispatcher_lock:
+        if dispatcher is None:
+            dispatcher = EventDispatcher(
+                unit_of_work.SqlAlchemyUnitOfWork, **settings
+            )
+            atexit.register(dispatcher.shutdown)
+    return dispatcher.submit
 
 
-@app.route("/", methods=["GET"])  # type: ignore
+def get_handle() -> Callable[..., List[Any]]:
+    """Commands are handled one at a time per SKU by a partitioned executor
+    when COMMAND_PARTITIONS is set, instead of racing each other to commit"""
+    global executor
+    settings = config.get_command_executor_settings()
+    if not settings["partitions"]:
+        return message_bus.handle
+    with executor_lock:
+        if executor is None:
+            executor = PartitionedExecutor(**settings)
+            atexit.register(executor.shutdown)
+    return executor.handle
+
+
+@api.route("/", methods=["GET"])  # type: ignore
 def default() -> tuple:
     return jsonify({"status": "on-line"}), 200
 
 
-@app.route("/allocate", methods=["POST"])  # type: ignore
+@api.route("/allocate", methods=["POST"])  # type: ignore
 def allocate_endpoint() -> tuple:
     # batches = repository.SqlAlchemyRepository(session).list()
     # line = model.OrderLine()
@@ -25,14 +72,16 @@ def allocate_endpoint() -> tuple:
             qty=request.json["qty"],
         )
         uow = unit_of_work.SqlAlchemyUnitOfWork()
-        message_bus.handle(command, uow)
+        get_handle()(command, uow, dispatch=get_dispatch())
     except handlers.InvalidSku as ex:
         return jsonify({"message": ex.message}), 400
+    except unit_of_work.ConcurrentUpdate:
+        return jsonify({"message": "conflicting allocation, retry"}), 409
     return jsonify({"status": "ok"}), 202
 
 
-@app.route("/allocations", methods=["GET"])  # type: ignore
-@app.route("/allocations/<order_id>")
+@api.route("/allocations", methods=["GET"])  # type: ignore
+@api.route("/allocations/<order_id>")
 def fetch_allocations(order_id: str = None) -> tuple:
     uow = unit_of_work.SqlAlchemyUnitOfWork()
     if order_id:
@@ -40,11 +89,48 @@ def fetch_allocations(order_id: str = None) -> tuple:
         if result:
             return jsonify(result), 200
         return jsonify({"message": "not found"}), 404
-    result = views.all_allocations(uow)
-    return jsonify(result), 200
+    if "limit" in request.args or "after" in request.args:
+        return fetch_allocations_page(uow)
+    rows = views.iter_allocations(uow)
+    if request.args.get("format") == "ndjson" or (
+        request.accept_mimetypes.best == "application/x-ndjson"
+    ):
+        return Response(ndjson(rows), mimetype="application/x-ndjson"), 200
+    return Response(json_array(rows), mimetype="application/json"), 200
+
+
+def fetch_allocations_page(uow: unit_of_work.AbstractUnitOfWork) -> tuple:
+    """`?limit=N&after=CURSOR`: the cursor of the next page, if any, is in
+    the X-Next-Cursor header"""
+    try:
+        limit = int(request.args.get("limit", views.MAX_PAGE_SIZE))
+        after = int(request.args.get("after", 0))
+    except ValueError:
+        return jsonify({"message": "limit and after must be integers"}), 400
+    if not 0 < limit <= views.MAX_PAGE_SIZE:
+        return (
+            jsonify({"message": f"limit must be 1 to {views.MAX_PAGE_SIZE}"}),
+            400,
+        )
+    page, cursor = views.allocations_page(uow, limit, after)
+    headers = {"X-Next-Cursor": str(cursor)} if cursor is not None else {}
+    return jsonify(page), 200, headers
+
+
+# Streamed bodies, written row by row as the view is read
+def ndjson(rows: Iterator[Dict]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
 
+def json_array(rows: Iterator[Dict]) -> Iterator[str]:
+    yield "["
+    for i, row in enumerate(rows):
+        yield ("," if i else "") + json.dumps(row)
+    yield "]"
 
-@app.route("/batch", methods=["POST"])  # type: ignore
+
+@api.route("/batch", methods=["POST"])  # type: ignore
 def post_endpoint() -> tuple:
     # session = get_session()
     # repo = repository.SqlAlchemyRepository(session)
@@ -56,5 +142,53 @@ def post_endpoint() -> tuple:
         eta=request.json["eta"],
     )
     uow = unit_of_work.SqlAlchemyUnitOfWork()
-    message_bus.handle(command, uow)
+    get_handle()(command, uow, dispatch=get_dispatch())
     return jsonify({"status": "ok"}), 201
+
+
+def queried_metric(name: str, query: Callable[[], Any]) -> Any:
+    "The last value `query` returned, run again once QUERIED_METRICS_TTL old"
+    now = time.monotonic()
+    found = queried_metrics.get(name)
+    if found is None or now - found[0] >= QUERIED_METRICS_TTL:
+        found = queried_metrics[name] = (now, query())
+    return found[1]
+
+
+@api.route("/metrics", methods=["GET"])  # type: ignore
+def metrics_endpoint() -> tuple:
+    metrics = {}
+    pool = unit_of_work.DEFAULT_SESSION_FACTORY.stats()
+    if pool:
+        metrics["db_pool"] = pool
+    product_cache = unit_of_work.get_product_cache()
+    if product_cache is not None:
+        metrics["product_cache"] = product_cache.stats()
+    if executor is not None:
+        metrics["command_executor"] = executor.stats()
+    if dispatcher is not None:
+        metrics["event_dispatcher"] = dispatcher.stats()
+    projection = config.get_read_model_projection_settings()["projection"]
+    if projection == "projector":
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+        lag = Projector(uow).lag
+        metrics["read_model_lag"] = queried_metric("read_model_lag", lag)
+    if config.get_outbox_settings()["publishing"] == "outbox":
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+        backlog = Relay(uow).backlog
+        metrics["outbox_backlog"] = queried_metric("outbox_backlog", backlog)
+    return jsonify(metrics), 200
+
+
+def create_app() -> Flask:
+    """Nothing is connected nor mapped when the app is created: mappers
+    are started by the first request, and database and Redis connections
+    are opened by whoever needs them first. Pre-forking servers can then
+    load the app in the parent and let each worker connect on its own"""
+    app = Flask(__name__)
+    app.before_request(orm.ensure_mappers)
+    app.register_blueprint(api)
+    return app
+
+
+app = create_app()
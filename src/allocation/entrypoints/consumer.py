@@ -1,44 +1,114 @@
 import logging
-import json
+import os
+import signal
+import socket
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 from allocation.domain import commands
-from allocation.adapters import redis
+from allocation.adapters import codec, orm, redis
 from allocation.service import message_bus, unit_of_work
 
 
 logger = logging.getLogger(__name__)
 
+CONSUMER_GROUP = "allocation"
+# seconds to wait before handling a stream again after a handler failed
+RETRY_DELAY = 1.0
 
-def parse_encoded_message(message: bytes) -> dict:
+
+def decode_message(message: bytes) -> Optional[codec.Message]:
     try:
-        return json.loads(message)
-    except Exception as ex:
-        logger.exception(f"Failed to parse message '{message!r}': {ex}")
-        return dict()
+        return codec.decode(message)
+    except codec.CodecError as ex:
+        # retrying would not make it any more readable
+        logger.error(f"Dropping undecodable message: {ex}")
+        return None
 
 
 def handle_allocation_commands(message: bytes) -> None:
-    data = parse_encoded_message(message)
+    event = decode_message(message)
     # if not data:
     #     return
-    logger.info(f"Received external message '{data}'")
+    logger.info(f"Received external message '{event}'")
     # cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
     # message_bus.handle(cmd, unit_of_work.SqlAlchemyUnitOfWork())
 
 
-EXTERNAL_CHANNELS_HANDLERS = {"allocation-events": handle_allocation_commands}
+def handle_external_commands(message: bytes) -> None:
+    "Messages are Commands in either of `codec`'s encodings"
+    command = decode_message(message)
+    if not isinstance(command, commands.Command):
+        logger.error(f"Dropping {command}, it is not a command")
+        return
+    message_bus.handle(command, unit_of_work.SqlAlchemyUnitOfWork())
+
+
+EXTERNAL_CHANNELS_HANDLERS: Dict[str, Callable[[bytes], None]] = {
+    "allocation-events": handle_allocation_commands,
+    "allocation-commands": handle_external_commands,
+}
+
+
+def consumer_name() -> str:
+    """Set CONSUMER_NAME to keep it across restarts: a restarted consumer
+    then handles the entries it had read but not acked first"""
+    return os.environ.get(
+        "CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}"
+    )
+
 
+def worker(
+    stop: Optional[threading.Event] = None,
+    name: Optional[str] = None,
+    handlers: Optional[Dict[str, Callable[[bytes], None]]] = None,
+) -> None:
+    """Handles entries of the streams in `handlers` (by default
+    EXTERNAL_CHANNELS_HANDLERS) as a member of CONSUMER_GROUP, until `stop`
+    is set. Entries are acked once handled, a batch at a time
 
-def worker() -> None:
-    pb = redis.r.pubsub(ignore_subscribe_messages=True)
-    # We can map channels to specific handlers on the future
-    pb.subscribe(EXTERNAL_CHANNELS_HANDLERS)
-    while True:
-        message = pb.get_message()
-        channel = message["channel"].decode()
-        handler = EXTERNAL_CHANNELS_HANDLERS[channel]
-        handler(message)
+    Entries of a stream are handled in order: once a handler raises, the
+    stream's later entries are left pending and the failed one is retried
+    first, after RETRY_DELAY. Entries failing `max_deliveries` times are
+    logged and dropped (see `redis.StreamConsumer`)"""
+    orm.ensure_mappers()
+    stop = stop or threading.Event()
+    handlers = handlers or EXTERNAL_CHANNELS_HANDLERS
+    consumer = redis.StreamConsumer(
+        CONSUMER_GROUP, name or consumer_name(), handlers
+    )
+    max_deliveries = consumer.settings["max_deliveries"]
+    failures: Dict[Tuple[str, bytes], int] = {}
+    while not stop.is_set():
+        handled: Dict[str, List[bytes]] = {stream: [] for stream in handlers}
+        failed: Set[str] = set()
+        for stream, entry_id, message in consumer.read():
+            if stream in failed:
+                # handled once the failed entry before it is
+                continue
+            try:
+                handlers[stream](message)
+            except Exception as ex:
+                key = (stream, entry_id)
+                failures[key] = failures.get(key, 0) + 1
+                if failures[key] < max_deliveries:
+                    logger.exception(f"Failed handling {entry_id!r}: {ex}")
+                    failed.add(stream)
+                    continue
+                logger.exception(f"Dropping {entry_id!r}, failed: {ex}")
+            failures.pop((stream, entry_id), None)
+            handled[stream].append(entry_id)
+        for stream, entry_ids in handled.items():
+            consumer.ack(stream, *entry_ids)
+        for stream in failed:
+            consumer.retry(stream)
+        if failed:
+            stop.wait(RETRY_DELAY)
 
 
 if __name__ == "__main__":
-    worker()
+    logging.basicConfig(level=logging.INFO)
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    worker(stop)
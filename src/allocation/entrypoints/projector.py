@@ -0,0 +1,29 @@
+"""Read model projector process
+
+    python -m allocation.entrypoints.projector
+
+Applies the allocation events appended to the read model stream by command
+handlers to `allocations_view`, logging its lag every minute. The API must
+run with READ_MODEL_PROJECTION=projector as well. SIGTERM and SIGINT stop it
+once the batch in flight is committed. It exits by itself, with an error
+logged, when events it had not applied were trimmed from the stream"""
+import logging
+import signal
+import threading
+
+from allocation.adapters import orm
+from allocation.service import unit_of_work
+from allocation.service.projector import Projector
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    orm.ensure_mappers()
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    Projector(unit_of_work.SqlAlchemyUnitOfWork()).run(stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Rebuilds the Redis allocations read model from the write model
+
+    python -m allocation.entrypoints.rebuild_read_model
+
+Every `allocations:*` hash is deleted, then rewritten from the
+`allocations` table, read in chunks through a server-side cursor. Run it
+when first switching ALLOCATIONS_READ_MODEL to "redis", or after Redis lost
+its data. Allocations handled while it runs may need another rebuild"""
+import logging
+from typing import Dict, Iterator
+
+from allocation.adapters import orm, redis
+from allocation.service import unit_of_work
+from allocation import views
+
+
+logger = logging.getLogger(__name__)
+
+ALLOCATED_LINES = (
+    "SELECT order_lines.order_id AS id_orderline, "
+    "batches.reference AS batchref, order_lines.sku, order_lines.qty "
+    "FROM allocations "
+    "JOIN order_lines ON order_lines.id = allocations.id_orderline "
+    "JOIN batches ON batches.id = allocations.batch_id"
+)
+
+
+def allocated_lines(
+    uow: unit_of_work.AbstractUnitOfWork,
+    chunk_size: int = views.STREAM_CHUNK_SIZE,
+) -> Iterator[Dict]:
+    with uow:
+        connection = uow.session.connection(  # type: ignore
+            execution_options=dict(stream_results=True)
+        )
+        results = connection.execute(ALLOCATED_LINES)
+        rows = results.fetchmany(chunk_size)
+        while rows:
+            yield from (dict(r) for r in rows)
+            rows = results.fetchmany(chunk_size)
+
+
+def rebuild(uow: unit_of_work.AbstractUnitOfWork) -> None:
+    cleared = redis.clear_allocations()
+    logger.info("Cleared %d orders from the read model", cleared)
+    redis.set_allocations(allocated_lines(uow))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    orm.ensure_mappers()
+    rebuild(unit_of_work.SqlAlchemyUnitOfWork())
@@ -0,0 +1,28 @@
+"""Outbox relay process
+
+    python -m allocation.entrypoints.relay
+
+Sends the events committed to the outbox to Redis, purging sent ones and
+logging the backlog every minute. The API and consumers must run with
+EVENT_PUBLISHING=outbox as well. SIGTERM and SIGINT stop it once the batch
+in flight is marked sent"""
+import logging
+import signal
+import threading
+
+from allocation.adapters import orm
+from allocation.service import unit_of_work
+from allocation.service.relay import Relay
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    orm.ensure_mappers()
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    Relay(unit_of_work.SqlAlchemyUnitOfWork(outbox=False)).run(stop)
+
+
+if __name__ == "__main__":
+    main()
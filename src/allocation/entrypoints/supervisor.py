@@ -0,0 +1,172 @@
+"""Consumer processes supervisor
+
+    python -m allocation.entrypoints.supervisor [PROCESSES]
+
+Runs PROCESSES (CONSUMER_PROCESSES by default) `consumer.worker` processes,
+handling EXTERNAL_CHANNELS_HANDLERS' streams on as many cores. Entries are
+routed to one partition stream per process, `<stream>:<partition>`, by the
+hash of their `sku`: messages about the same SKU are handled in order, by a
+single process. Messages without one (e.g. a ChangeBatchQuantity sent with
+its batch reference only) all go to the first partition, and are not
+ordered with the messages about their SKU. Crashed processes are
+restarted, and resume with the entries they held. SIGTERM and SIGINT stop
+routing and let every process finish its batch in flight before exiting
+
+Drain partition streams before changing the number of processes: a SKU's
+older messages would be left in its previous partition"""
+import logging
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from allocation import config
+from allocation.adapters import codec, redis
+from allocation.entrypoints import consumer
+from allocation.service import executor
+
+
+logger = logging.getLogger(__name__)
+
+# the supervisor's own group on EXTERNAL_CHANNELS_HANDLERS' streams
+ROUTER_GROUP = "allocation-router"
+
+
+def partition_stream(stream: str, index: int) -> str:
+    return f"{stream}:{index}"
+
+
+def partition_handlers(index: int) -> Dict[str, Callable[[bytes], None]]:
+    return {
+        partition_stream(stream, index): handler
+        for stream, handler in consumer.EXTERNAL_CHANNELS_HANDLERS.items()
+    }
+
+
+def partition(message: bytes, partitions: int) -> int:
+    """Messages without a `sku` all go to the same partition: the router
+    does not look batch references up"""
+    try:
+        sku = getattr(codec.decode(message), "sku", None)
+    except codec.CodecError:
+        sku = None
+    return executor.partition(sku or "", partitions)
+
+
+def work(index: int) -> None:
+    "A consumer process, handling partition `index` until SIGTERM"
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    # Ctrl-C reaches the whole process group: the supervisor drains us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    consumer.worker(stop, f"partition-{index}", partition_handlers(index))
+
+
+class Supervisor:
+    """Routes entries to partition streams and keeps a consumer process
+    running for each of them
+
+    Routing an entry appends it to its partition and acks it in a single
+    MULTI/EXEC transaction, so entries are neither lost nor routed twice"""
+
+    def __init__(
+        self,
+        processes: Optional[int] = None,
+        drain_timeout: Optional[float] = None,
+        restart_delay: float = 1.0,
+    ) -> None:
+        settings = config.get_consumer_settings()
+        self.processes = processes or settings["processes"]
+        self.drain_timeout = drain_timeout or settings["drain_timeout"]
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        self._workers: List[Optional[multiprocessing.Process]] = [
+            None for _ in range(self.processes)
+        ]
+        self._router = redis.StreamConsumer(
+            ROUTER_GROUP, "router", consumer.EXTERNAL_CHANNELS_HANDLERS
+        )
+
+    def route(self) -> int:
+        "Routes the next batch of entries, returns how many"
+        entries = self._router.read()
+        if not entries:
+            return 0
+        maxlen = config.get_redis_stream_settings()["maxlen"]
+        pipe = self._router.client.pipeline(transaction=True)
+        for stream, entry_id, message in entries:
+            target = partition_stream(
+                stream, partition(message, self.processes)
+            )
+            redis.add_entry(pipe, target, message, maxlen)
+            pipe.xack(stream, ROUTER_GROUP, entry_id)
+        pipe.execute()
+        return len(entries)
+
+    def supervise(self) -> None:
+        "Starts consumer processes that are not running"
+        for index, worker in enumerate(self._workers):
+            if worker is not None and worker.is_alive():
+                continue
+            if worker is not None:
+                logger.error(
+                    "Consumer %d exited with %s, restarting it",
+                    index,
+                    worker.exitcode,
+                )
+                self.restarts += 1
+                # do not spin on processes crashing at start up
+                time.sleep(self.restart_delay)
+            worker = multiprocessing.Process(
+                target=work, args=(index,), name=f"consumer-{index}"
+            )
+            worker.start()
+            self._workers[index] = worker
+
+    def run(self, stop: threading.Event) -> None:
+        "Routes and supervises until `stop` is set, then drains"
+        try:
+            while not stop.is_set():
+                self.supervise()
+                try:
+                    self.route()
+                except Exception as ex:
+                    # nothing was routed nor acked: the next read hands the
+                    # same entries out again, before any newer one
+                    logger.exception("Failed to route entries: %s", ex)
+                    for stream in self._router.streams:
+                        self._router.retry(stream)
+                    stop.wait(1)
+        finally:
+            self.drain()
+
+    def drain(self) -> None:
+        """Asks every process to stop after its batch in flight, killing
+        those still running after `drain_timeout`; entries they did not ack
+        are handled once they are started again"""
+        running = [w for w in self._workers if w is not None]
+        for worker in running:
+            worker.terminate()  # SIGTERM
+        deadline = time.monotonic() + self.drain_timeout
+        for worker in running:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                logger.error("Killing consumer %s", worker.name)
+                worker.kill()
+                worker.join()
+        self._workers = [None for _ in range(self.processes)]
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    Supervisor(processes).run(stop)
+
+
+if __name__ == "__main__":
+    main()
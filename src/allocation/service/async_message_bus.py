@@ -0,0 +1,141 @@
+"Asynchronous Message Bus"
+# Same mapping of messages to handlers as `message_bus`, awaited from an
+# event loop. Commands are still handled one after the other, but the
+# handlers reacting to the same event are independent from each other, so
+# they run concurrently (each one with its own Unit of Work) up to a bound
+from collections import deque
+from contextvars import copy_context
+from typing import Any, Awaitable, Callable, Deque, List, Optional
+
+import asyncio
+import logging
+
+from allocation.adapters import redis
+from allocation.domain import commands, events
+from allocation.service import message_bus, unit_of_work
+from allocation.service.message_bus import Message
+
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_HANDLERS = 8
+
+
+async def run_handler(
+    handler: Callable, message: Any, uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Message]:
+    """Runs `handler` without blocking the event loop and returns the events
+    raised while handling `message`"""
+    if asyncio.iscoroutinefunction(handler):
+        await handler(message, uow=uow)
+        return list(uow.collect_new_events())
+
+    def call() -> List[Message]:
+        handler(message, uow=uow)
+        return list(uow.collect_new_events())
+
+    # executor threads do not inherit the context (and its publish buffer)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, copy_context().run, call
+    )
+
+
+async def handle_event(
+    event: events.Event,
+    queue: Deque[Message],
+    uow: unit_of_work.AbstractUnitOfWork,
+    limit: Optional[asyncio.Semaphore] = None,
+) -> None:
+    await handle_events([event], queue, uow, limit)
+
+
+async def handle_events(
+    batch: List[events.Event],
+    queue: Deque[Message],
+    uow: unit_of_work.AbstractUnitOfWork,
+    limit: Optional[asyncio.Semaphore] = None,
+) -> None:
+    limit = limit or asyncio.Semaphore(MAX_CONCURRENT_HANDLERS)
+    calls: List[tuple] = []
+    for handler in message_bus.EVENTS_HANDLERS[type(batch[0])]:
+        if isinstance(handler, message_bus.Batched):
+            calls.append((handler.handler, batch))
+        else:
+            calls.extend((handler, event) for event in batch)
+
+    async def guarded(handler: Callable, message: Any) -> List[Message]:
+        async with limit:  # type: ignore
+            try:
+                logger.info(
+                    "Handling event %s with handler %s", message, handler
+                )
+                return await run_handler(handler, message, uow.fork())
+            except Exception as ex:
+                logger.exception(
+                    "Exception handling event %s: %s", message, ex
+                )
+                return []
+
+    pending: List[Awaitable] = [guarded(*call) for call in calls]
+    # results come back in the order handlers were registered
+    for raised in await asyncio.gather(*pending):
+        queue.extend(raised)
+
+
+async def handle_command(
+    command: commands.Command,
+    queue: Deque[Message],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> Optional[Any]:
+    logger.info("Handling command %s", command)
+    attempt = 1
+    while True:
+        try:
+            handler = message_bus.COMMAND_HANDLERS[type(command)]
+            result: Any = await asyncio.get_running_loop().run_in_executor(
+                None, copy_context().run, handler, command, uow
+            )
+            queue.extend(uow.collect_new_events())
+            return result
+        except unit_of_work.ConcurrentUpdate as ex:
+            delay = message_bus.retry_delay(attempt)
+            if delay is None:
+                logger.exception("Giving up on command %s: %s", command, ex)
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+        except Exception as ex:
+            logger.exception("Exception handling command %s: %s", command, ex)
+            raise
+
+
+async def handle(
+    message: Message,
+    uow: unit_of_work.AbstractUnitOfWork,
+    coalesce: bool = False,
+    max_concurrency: int = MAX_CONCURRENT_HANDLERS,
+) -> List:
+    "At most `max_concurrency` event handlers run at the same time"
+    limit = asyncio.Semaphore(max_concurrency)
+    results: List = []
+    queue: Deque[Message] = deque([message])
+    with redis.buffered_publishing(flush=False) as published:
+        while queue:
+            message = queue.popleft()
+            if isinstance(message, events.Event):
+                if coalesce:
+                    batch = message_bus.next_batch(message, queue)
+                else:
+                    batch = [message]
+                await handle_events(batch, queue, uow, limit)
+            elif isinstance(message, commands.Command):
+                cmd_result = await handle_command(message, queue, uow)
+                results.append(cmd_result)
+            else:
+                raise Exception(
+                    f"{message} is neither a Command nor an Event"
+                )
+        await asyncio.get_running_loop().run_in_executor(
+            None, published.flush
+        )
+    return results
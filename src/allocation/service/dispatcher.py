@@ -0,0 +1,131 @@
+"Event Dispatcher"
+# Takes events raised by commands off the request path: the command (and
+# the commit of its aggregate) still runs inline, but the events it raised
+# are handed to a bounded pool of worker threads, each of them handling an
+# event through the Message Bus with its own Unit of Work
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from allocation.domain import events
+from allocation.service import message_bus, unit_of_work
+
+
+logger = logging.getLogger(__name__)
+
+
+class DispatcherClosed(Exception):
+    pass
+
+
+class EventDispatcher:
+    """Bounded, multi-threaded dispatch of events
+
+    Backpressure: when the queue is full, `submit` blocks for up to
+    `put_timeout` seconds and then handles the event itself on the caller's
+    thread, so events are delayed but never dropped"""
+
+    def __init__(
+        self,
+        uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+        workers: int = 4,
+        max_queue: int = 1000,
+        put_timeout: float = 1.0,
+    ) -> None:
+        self.uow_factory = uow_factory
+        self.put_timeout = put_timeout
+        self._queue: "queue.Queue[Optional[Tuple[events.Event, float]]]" = (
+            queue.Queue(maxsize=max_queue)
+        )
+        self._lock = threading.Lock()
+        self._closed = False
+        self._counters: Dict[str, float] = dict(
+            submitted=0,
+            completed=0,
+            failed=0,
+            handled_inline=0,
+            max_queue_depth=0,
+            total_latency=0.0,
+            max_latency=0.0,
+        )
+        self._workers: List[threading.Thread] = [
+            threading.Thread(
+                target=self._work, name=f"event-dispatcher-{i}", daemon=True
+            )
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, event: events.Event) -> None:
+        if self._closed:
+            raise DispatcherClosed(f"Cannot dispatch {event} after shutdown")
+        with self._lock:
+            self._counters["submitted"] += 1
+        try:
+            self._queue.put(
+                (event, time.monotonic()), timeout=self.put_timeout
+            )
+        except queue.Full:
+            logger.warning("Dispatch queue is full, handling %s inline", event)
+            with self._lock:
+                self._counters["handled_inline"] += 1
+            self._handle(event, time.monotonic())
+            return
+        with self._lock:
+            self._counters["max_queue_depth"] = max(
+                self._counters["max_queue_depth"], self._queue.qsize()
+            )
+
+    def flush(self) -> None:
+        "Blocks until every queued event has been handled"
+        self._queue.join()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops accepting events. Workers drain what is already queued
+        before exiting"""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._counters)
+        stats["queue_depth"] = self._queue.qsize()
+        finished = stats["completed"] + stats["failed"]
+        stats["avg_latency"] = (
+            stats["total_latency"] / finished if finished else 0.0
+        )
+        return stats
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._handle(*item)
+            finally:
+                self._queue.task_done()
+
+    def _handle(self, event: events.Event, submitted_at: float) -> None:
+        try:
+            message_bus.handle(event, self.uow_factory())
+            outcome = "completed"
+        except Exception as ex:
+            logger.exception("Exception dispatching event %s: %s", event, ex)
+            outcome = "failed"
+        latency = time.monotonic() - submitted_at
+        with self._lock:
+            self._counters[outcome] += 1
+            self._counters["total_latency"] += latency
+            self._counters["max_latency"] = max(
+                self._counters["max_latency"], latency
+            )
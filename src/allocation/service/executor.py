@@ -0,0 +1,120 @@
+"SKU-partitioned Command Executor"
+# Commands on the same Product conflict in the database when run at the
+# same time, while commands on different ones never interact. Routing each
+# SKU to a single worker thread turns those conflicts into a queue
+import logging
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+from allocation.service import message_bus, unit_of_work
+from allocation.service.message_bus import Message
+
+
+logger = logging.getLogger(__name__)
+
+Job = Tuple[Future, Message, unit_of_work.AbstractUnitOfWork, Dict[str, Any]]
+
+
+class ExecutorClosed(Exception):
+    pass
+
+
+def partition(sku: str, partitions: int) -> int:
+    # crc32 rather than hash(): stable across processes and restarts
+    return zlib.crc32(sku.encode("utf-8")) % partitions
+
+
+class PartitionedExecutor:
+    """Handles messages through the Message Bus, one at a time per SKU
+
+    Messages are hash-partitioned by `sku` over `partitions` worker threads,
+    each with a queue of up to `max_queue` messages (`submit` blocks when it
+    is full). Messages for the same SKU are handled in the order they were
+    submitted; messages without a `sku` are handled on the caller's thread"""
+
+    def __init__(self, partitions: int = 8, max_queue: int = 1000) -> None:
+        self._queues: List["queue.Queue[Optional[Job]]"] = [
+            queue.Queue(maxsize=max_queue) for _ in range(partitions)
+        ]
+        self._handled = [0] * partitions
+        self._closed = False
+        self._workers = [
+            threading.Thread(
+                target=self._work,
+                args=(i,),
+                name=f"command-executor-{i}",
+                daemon=True,
+            )
+            for i in range(partitions)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def partition(self, sku: str) -> int:
+        return partition(sku, len(self._queues))
+
+    def submit(
+        self,
+        message: Message,
+        uow: unit_of_work.AbstractUnitOfWork,
+        **kwargs: Any,
+    ) -> Future:
+        "`kwargs` are passed on to `message_bus.handle`"
+        if self._closed:
+            raise ExecutorClosed(f"Cannot handle {message} after shutdown")
+        future: Future = Future()
+        job = (future, message, uow, kwargs)
+        sku = getattr(message, "sku", None)
+        if sku is None:
+            self._run(job)
+        else:
+            self._queues[self.partition(sku)].put(job)
+        return future
+
+    def handle(
+        self,
+        message: Message,
+        uow: unit_of_work.AbstractUnitOfWork,
+        **kwargs: Any,
+    ) -> List:
+        "Same as `message_bus.handle`, waiting for the message's turn"
+        return self.submit(message, uow, **kwargs).result()
+
+    def shutdown(self, wait: bool = True) -> None:
+        "Stops accepting messages; queued ones are handled before exiting"
+        if self._closed:
+            return
+        self._closed = True
+        for partition in self._queues:
+            partition.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def stats(self) -> Dict[str, List[int]]:
+        return dict(
+            queue_depth=[partition.qsize() for partition in self._queues],
+            handled=list(self._handled),
+        )
+
+    def _work(self, index: int) -> None:
+        partition = self._queues[index]
+        while True:
+            job = partition.get()
+            if job is None:
+                return
+            self._run(job)
+            self._handled[index] += 1
+
+    def _run(self, job: Job) -> None:
+        future, message, uow, kwargs = job
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(message_bus.handle(message, uow, **kwargs))
+        except Exception as ex:
+            # message_bus.handle already logged it
+            future.set_exception(ex)
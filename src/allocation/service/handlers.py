@@ -9,9 +9,14 @@
 from typing import List
 
 # from allocation.adapters.repository import AbstractRepository
-from allocation.adapters import redis
+from allocation import config
+from allocation.adapters import codec, redis
 from allocation.domain import events, commands, model
-from allocation.service import unit_of_work
+from allocation.service import projector, unit_of_work
+
+
+# every event is appended to it, for other services to consume
+EVENTS_STREAM = "allocation-events"
 
 
 # Exceptions belong to where they are raised
@@ -52,26 +57,51 @@ def change_batch_qty(
 def publish_to_log_channel(
     event: events.Event, uow: unit_of_work.AbstractUnitOfWork
 ) -> None:
-    redis.publish_message("allocation-events", str(event))
+    # with an outbox, the Redis side of handlers is left to the relay
+    if uow.uses_outbox:
+        return
+    redis.append_message(EVENTS_STREAM, codec.encode(event))
 
 
-def add_allocation_to_read_model(
-    event: events.Allocated, uow: unit_of_work.AbstractUnitOfWork
+def update_read_model(
+    projected: List[projector.Projected],
+    uow: unit_of_work.AbstractUnitOfWork,
 ) -> None:
+    """Applies allocation events to `allocations_view` right away, or hands
+    them to the projector process when READ_MODEL_PROJECTION is set so"""
+    settings = config.get_read_model_projection_settings()
+    if settings["projection"] == "projector":
+        if uow.uses_outbox:
+            return
+        for event in projected:
+            redis.append_message(
+                settings["stream"], codec.encode(event), settings["maxlen"]
+            )
+        return
     with uow:
-        uow.session.execute(
-            "INSERT INTO allocations_view (id_orderline, batchref, sku, qty) "
-            "VALUES (:order_id, :batchref, :sku, :qty)",
-            dict(
-                order_id=event.order_id,
-                batchref=event.batch_ref,
-                sku=event.sku,
-                qty=event.qty,
-            ),
-        )
+        projector.apply(projected, uow.session)  # type: ignore
         uow.commit()
 
 
+def add_allocations_to_redis_read_model(
+    allocated: List[events.Allocated], uow: unit_of_work.AbstractUnitOfWork
+) -> None:
+    if uow.uses_outbox:
+        return
+    redis.set_allocations(projector.row(event) for event in allocated)
+
+
+def remove_allocations_from_redis_read_model(
+    deallocated: List[events.Deallocated],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> None:
+    if uow.uses_outbox:
+        return
+    redis.remove_allocations(
+        (event.order_id, event.sku) for event in deallocated
+    )
+
+
 def allocate(
     command: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork,
 ) -> None:
@@ -95,9 +125,8 @@ def deallocate(
         if not product:
             raise InvalidSku(f"Invalid sku {command.sku}")
 
-        orderid = product.deallocate()
+        product.deallocate(command.order_id)
         uow.commit()
-        return orderid
 
 
 def add_batch(
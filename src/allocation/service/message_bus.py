@@ -1,30 +1,70 @@
 "Message Bus"
 # A message bus is a simple mapper of Events to Handlers
 # For a given event, what handler should I run?
-from typing import List, Optional, Any, Union
+from collections import deque
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
 
+from allocation import config
+from allocation.adapters import redis
 from allocation.service import unit_of_work, handlers
 from allocation.domain import events, commands
 
 import logging
+import random
+import time
 
 
 logger = logging.getLogger(__name__)
 
 
-EVENTS_HANDLERS = {
-    events.OutOfStock: [handlers.send_out_of_stock_notification],
-    events.OrderAlreadyAllocated: [handlers.log_to_sentry],
+class Batched(NamedTuple):
+    """Registers a handler that takes a list of events of the same type
+    at once instead of being called once per event"""
+
+    handler: Callable[..., None]
+
+
+EVENTS_HANDLERS: Dict[Type[events.Event], List[Any]] = {
+    events.OutOfStock: [
+        handlers.send_out_of_stock_notification,
+        handlers.publish_to_log_channel,
+    ],
+    events.OrderAlreadyAllocated: [
+        handlers.log_to_sentry,
+        handlers.publish_to_log_channel,
+    ],
     events.BatchCreated: [handlers.publish_to_log_channel],
     events.Allocated: [
-        handlers.add_allocation_to_read_model,
+        Batched(handlers.update_read_model),
+        Batched(handlers.add_allocations_to_redis_read_model),
         handlers.publish_to_log_channel,
     ],
-    events.Deallocated: [],
+    events.Deallocated: [
+        Batched(handlers.update_read_model),
+        Batched(handlers.remove_allocations_from_redis_read_model),
+        handlers.publish_to_log_channel,
+    ],
+    events.OrderNotAllocated: [
+        handlers.log_to_sentry,
+        handlers.publish_to_log_channel,
+    ],
+    events.AllocationsEmpty: [handlers.publish_to_log_channel],
 }
 
-COMMAND_HANDLERS = {
+COMMAND_HANDLERS: Dict[Type[commands.Command], Callable] = {
     commands.Allocate: handlers.allocate,
+    commands.Deallocate: handlers.deallocate,
     commands.ChangeBatchQuantity: handlers.change_batch_qty,
     commands.CreateBatch: handlers.add_batch,
 }
@@ -34,51 +74,122 @@ Message = Union[events.Event, commands.Command]
 
 def handle_event(
     event: events.Event,
-    queue: List[Message],
+    queue: Deque[Message],
     uow: unit_of_work.AbstractUnitOfWork,
 ) -> None:
-    handlers.publish_to_log_channel(event, uow)
-    for handler in EVENTS_HANDLERS[type(event)]:
-        try:
-            logger.info("Handling event %s with handler %s", event, handler)
-            handler(event, uow=uow)
-            queue.extend(uow.collect_new_events())
-        except Exception as ex:
-            logger.exception("Exception handling event %s: %s", event, ex)
-            continue
+    handle_events([event], queue, uow)
+
+
+def handle_events(
+    batch: List[events.Event],
+    queue: Deque[Message],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> None:
+    """Handles events of a single type. `Batched` handlers are called once
+    with the whole batch, every other handler once per event"""
+    for handler in EVENTS_HANDLERS[type(batch[0])]:
+        calls: List[Tuple[Callable, Any]]
+        if isinstance(handler, Batched):
+            calls = [(handler.handler, batch)]
+        else:
+            calls = [(handler, event) for event in batch]
+        for call, message in calls:
+            try:
+                logger.info(
+                    "Handling event %s with handler %s", message, call
+                )
+                call(message, uow=uow)
+                queue.extend(uow.collect_new_events())
+            except Exception as ex:
+                logger.exception(
+                    "Exception handling event %s: %s", message, ex
+                )
+                continue
 
 
 def handle_command(
     command: commands.Command,
-    queue: List[Message],
+    queue: Deque[Message],
     uow: unit_of_work.AbstractUnitOfWork,
 ) -> Optional[Any]:
+    """Commands conflicting with a concurrent update of their product are
+    retried, see `config.get_command_retry_settings`"""
     logger.info("Handling command %s", command)
-    try:
-        handler = COMMAND_HANDLERS[type(command)]
-        result = handler(command, uow)
-        queue.extend(uow.collect_new_events())
-        return result
-    except Exception as ex:
-        logger.exception("Exception handling command %s: %s", command, ex)
-        raise
+    attempt = 1
+    while True:
+        try:
+            handler = COMMAND_HANDLERS[type(command)]
+            result = handler(command, uow)
+            queue.extend(uow.collect_new_events())
+            return result
+        except unit_of_work.ConcurrentUpdate as ex:
+            delay = retry_delay(attempt)
+            if delay is None:
+                logger.exception("Giving up on command %s: %s", command, ex)
+                raise
+            logger.info("Retrying command %s in %.3fs", command, delay)
+            time.sleep(delay)
+            attempt += 1
+        except Exception as ex:
+            logger.exception("Exception handling command %s: %s", command, ex)
+            raise
+
+
+def retry_delay(attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying a command that failed `attempt`
+    times, None once out of attempts. Random ("full jitter"), so commands
+    that conflicted once are unlikely to conflict again"""
+    settings = config.get_command_retry_settings()
+    if attempt >= settings["attempts"]:
+        return None
+    return random.uniform(0, settings["backoff"] * 2 ** (attempt - 1))
+
+
+def next_batch(message: events.Event, queue: Deque[Message]) -> List:
+    "Takes the run of events of the same type as `message` off the queue"
+    batch: List[Message] = [message]
+    while queue and type(queue[0]) is type(message):
+        batch.append(queue.popleft())
+    return batch
 
 
 # def handle(event: events.Event) -> None:
 #     for handler in HANDLERS[type(event)]:
 #         handler(event)
-def handle(message: Message, uow: unit_of_work.AbstractUnitOfWork) -> List:
+def handle(
+    message: Message,
+    uow: unit_of_work.AbstractUnitOfWork,
+    coalesce: bool = False,
+    dispatch: Optional[Callable[[events.Event], None]] = None,
+) -> List:
+    """When `coalesce` is set, consecutive queued events of the same type are
+    handled together, so `Batched` handlers see them in a single call
+
+    When `dispatch` is given, events raised by commands are handed to it
+    (see `dispatcher.EventDispatcher.submit`) instead of being handled
+    before returning
+
+    Messages published to Redis by handlers are buffered and sent in a
+    pipeline once every handler is done (and has committed)"""
     results: List = []
-    queue: List[Message] = [message]
+    queue: Deque[Message] = deque([message])
     # a Queue is used to handle events that might raise from executing
     # a command
-    while queue:
-        message = queue.pop(0)
-        if isinstance(message, events.Event):
-            handle_event(message, queue, uow)
-        elif isinstance(message, commands.Command):
-            cmd_result = handle_command(message, queue, uow)
-            results.append(cmd_result)
-        else:
-            raise Exception(f"{message} is neither a Command nor an Event")
+    with redis.buffered_publishing():
+        while queue:
+            message = queue.popleft()
+            if isinstance(message, events.Event):
+                if coalesce:
+                    handle_events(next_batch(message, queue), queue, uow)
+                else:
+                    handle_event(message, queue, uow)
+            elif isinstance(message, commands.Command):
+                cmd_result = handle_command(message, queue, uow)
+                results.append(cmd_result)
+                while dispatch is not None and queue:
+                    dispatch(queue.popleft())  # type: ignore
+            else:
+                raise Exception(
+                    f"{message} is neither a Command nor an Event"
+                )
     return results
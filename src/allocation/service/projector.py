@@ -0,0 +1,227 @@
+"Read Model Projector"
+# Keeps `allocations_view` up to date with Allocated and Deallocated
+# events. Inline, handlers write it after every command; with a projector,
+# handlers only append the events to a Redis stream and a separate process
+# applies them in batches, off the command path
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+from sqlalchemy import and_, bindparam
+
+from allocation import config
+from allocation.adapters import codec, orm, redis
+from allocation.domain import events
+from allocation.service import unit_of_work
+
+
+logger = logging.getLogger(__name__)
+
+Projected = Union[events.Allocated, events.Deallocated]
+
+# keeps multi-row INSERTs below the bound parameters limit of drivers
+INSERT_ROWS = 500
+
+DELETE_ALLOCATION = orm.allocations_view.delete().where(
+    and_(
+        orm.allocations_view.c.id_orderline == bindparam("_order_id"),
+        orm.allocations_view.c.batchref == bindparam("_batchref"),
+        orm.allocations_view.c.sku == bindparam("_sku"),
+    )
+)
+
+GET_CHECKPOINT = (
+    "SELECT position FROM projector_checkpoints WHERE name = :name"
+)
+SET_CHECKPOINT = (
+    "INSERT INTO projector_checkpoints (name, position) "
+    "VALUES (:name, :position) "
+    "ON CONFLICT (name) DO UPDATE SET position = excluded.position"
+)
+
+# position of a projector that has not applied anything yet
+START = "0-0"
+
+
+class ProjectionGap(Exception):
+    "Events not applied yet were trimmed from the projector's stream"
+
+
+def row(event: Projected) -> Dict[str, Any]:
+    "The `allocations_view` row of the line an event is about"
+    return dict(
+        id_orderline=event.order_id,
+        batchref=event.batch_ref,
+        sku=event.sku,
+        qty=event.qty,
+    )
+
+
+def apply(projected: Sequence[Projected], session: Any) -> None:
+    """Inserts allocated lines and deletes deallocated ones, in the order
+    the events happened. Each run of events of the same type is written
+    with a single statement (an INSERT per `INSERT_ROWS` rows)"""
+    for kind, run in itertools.groupby(projected, key=type):
+        if kind is events.Allocated:
+            rows = [row(event) for event in run]
+            for start in range(0, len(rows), INSERT_ROWS):
+                end = start + INSERT_ROWS
+                insert = orm.allocations_view.insert().values(rows[start:end])
+                session.execute(insert)
+        else:
+            lines = [
+                dict(_order_id=e.order_id, _batchref=e.batch_ref, _sku=e.sku)
+                for e in run
+            ]
+            session.execute(DELETE_ALLOCATION, lines)
+
+
+def stream_time(entry_id: bytes) -> float:
+    "Seconds since the epoch at which a stream entry was added"
+    return int(entry_id.split(b"-")[0]) / 1000
+
+
+def stream_order(entry_id: Union[str, bytes]) -> Tuple[int, int]:
+    "Sortable form of a stream entry id"
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    milliseconds, _, sequence = entry_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+class Projector:
+    """Applies events appended to the read model stream to
+    `allocations_view`, in transactions of up to `batch_size` events
+
+    Each transaction also records the projector's checkpoint, the id of the
+    last stream entry it applied. A projector that crashed resumes after
+    its last committed batch: no event is applied twice, and none is lost
+    as long as the stream still holds it
+
+    The stream is trimmed to about READ_MODEL_STREAM_MAXLEN entries, and
+    trimming does not wait for the projector: one stopped (or falling
+    behind) for longer than it takes to append that many events misses
+    those trimmed. It then logs an error, reports the gap in its `lag` and
+    stops, rather than carry on with a read model missing lines, until
+    `allocations_view` is rebuilt from the write model and the checkpoint
+    moved to the stream's end. One exactly that many entries behind (the
+    entry at its checkpoint trimmed, the following one kept) is reported
+    as well, on the safe side"""
+
+    def __init__(
+        self,
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        name: str = "allocations_view",
+        stream: Optional[str] = None,
+        batch_size: Optional[int] = None,
+    ) -> None:
+        settings = config.get_read_model_projection_settings()
+        self.uow = uow
+        self.name = name
+        self.stream = stream or settings["stream"]
+        self.batch_size = batch_size or settings["batch_size"]
+        self.position: Optional[str] = None
+        self.applied = 0
+
+    def checkpoint(self) -> str:
+        "Last committed position"
+        with self.uow:
+            found = self.uow.session.execute(
+                GET_CHECKPOINT, dict(name=self.name)
+            ).scalar()
+        return found or START
+
+    def run_once(self, block_ms: Optional[int] = None) -> int:
+        """Applies the next batch of events, waiting up to `block_ms` for
+        one when the projection is up to date. Returns how many it applied
+
+        Raises ProjectionGap when events it has not applied were trimmed"""
+        if self.position is None:
+            self.position = self.checkpoint()
+        if self.trimmed(self.position):
+            logger.error(
+                "Projection %s missed events trimmed from %s after %s",
+                self.name,
+                self.stream,
+                self.position,
+            )
+            raise ProjectionGap(f"{self.stream} trimmed after {self.position}")
+        found = redis.get_client().xread(
+            {self.stream: self.position}, count=self.batch_size, block=block_ms
+        )
+        if not found:
+            return 0
+        [(_, entries)] = found
+        position = entries[-1][0].decode()
+        # the stream only carries Projected events, see `update_read_model`
+        projected = [codec.decode(fields[b"message"]) for _, fields in entries]
+        with self.uow:
+            apply(projected, self.uow.session)  # type: ignore
+            self.uow.session.execute(
+                SET_CHECKPOINT, dict(name=self.name, position=position)
+            )
+            self.uow.commit()
+        self.position = position
+        self.applied += len(entries)
+        return len(entries)
+
+    def run(
+        self,
+        stop: threading.Event,
+        block_ms: int = 1000,
+        report_every: float = 60,
+    ) -> None:
+        """Projects until `stop` is set, or until it finds a gap, logging the
+        lag every `report_every`s"""
+        reported = time.monotonic()
+        while not stop.is_set():
+            try:
+                self.run_once(block_ms)
+            except ProjectionGap:
+                return
+            except Exception as ex:
+                # the batch is read again from the last checkpoint
+                logger.exception("Failed to project events: %s", ex)
+                self.position = None
+                stop.wait(1)
+            if time.monotonic() - reported >= report_every:
+                logger.info("Projection %s: %s", self.name, self.stats())
+                reported = time.monotonic()
+
+    def trimmed(self, position: str) -> bool:
+        """Whether entries following `position` were trimmed from the stream
+        before being applied, comparing it with the stream's first entry"""
+        client = redis.get_client()
+        if not client.exists(self.stream):
+            return False
+        info = client.xinfo_stream(self.stream)
+        if info["first-entry"] is None:
+            last = info["last-generated-id"]
+            return stream_order(last) > stream_order(position)
+        if position == START:
+            # any entry gone was never applied (Redis 7 counts them)
+            return info.get("entries-added", 0) > info["length"]
+        return stream_order(info["first-entry"][0]) > stream_order(position)
+
+    def lag(self) -> Dict[str, Any]:
+        """`seconds`: age of the oldest event not applied yet, zero when
+        the projection is up to date. `gap`: whether some were trimmed
+        before being applied (see `Projector`)"""
+        position = self.checkpoint()
+        following = redis.get_client().xrange(self.stream, position, count=2)
+        pending = [
+            entry_id
+            for entry_id, _ in following
+            if entry_id.decode() != position
+        ]
+        seconds = time.time() - stream_time(pending[0]) if pending else 0.0
+        return dict(
+            position=position,
+            seconds=round(max(seconds, 0), 3),
+            gap=self.trimmed(position),
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(applied=self.applied, lag=self.lag())
@@ -0,0 +1,164 @@
+"Outbox Relay"
+# With EVENT_PUBLISHING=outbox, commands never talk to Redis: Units of Work
+# write the events they raised to the `outbox` table, in the transaction
+# that raised them, and the relay sends those to Redis afterwards. Events
+# of rolled back transactions are never sent, and events of committed ones
+# are not lost when the process dies right after committing
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import func, select
+
+from allocation import config
+from allocation.adapters import codec, redis
+from allocation.adapters.orm import outbox
+from allocation.domain import events
+from allocation.service import handlers, projector, unit_of_work
+
+
+logger = logging.getLogger(__name__)
+
+UNSENT = (
+    select([outbox.c.id, outbox.c.message])
+    .where(outbox.c.sent_at.is_(None))
+    .order_by(outbox.c.id)
+)
+# events also sent to the read model projector's stream
+PROJECTED = (events.Allocated, events.Deallocated)
+
+
+def publish(messages: Sequence[bytes]) -> None:
+    """Sends encoded events where their handlers would have, had they run
+    inline: every event to the events stream, allocation events also to
+    the Redis read model and, when it is used, to the projector's stream.
+    Stream entries are sent in pipelines (see `redis.buffered_publishing`)
+
+    Messages that cannot be decoded are still appended to the events
+    stream, whose consumers might know better"""
+    settings = config.get_read_model_projection_settings()
+    projection = settings["projection"] == "projector"
+    decoded: List[codec.Message] = []
+    with redis.buffered_publishing():
+        for message in messages:
+            redis.append_message(handlers.EVENTS_STREAM, message)
+            try:
+                event = codec.decode(message)
+            except codec.CodecError as ex:
+                logger.error("Relaying undecodable event: %s", ex)
+                continue
+            decoded.append(event)
+            if projection and isinstance(event, PROJECTED):
+                redis.append_message(
+                    settings["stream"], message, settings["maxlen"]
+                )
+    # in order, as an order line may be deallocated and allocated again
+    for kind, run in itertools.groupby(decoded, key=type):
+        lines: List[Any] = list(run)
+        if kind is events.Allocated:
+            redis.set_allocations(projector.row(event) for event in lines)
+        elif kind is events.Deallocated:
+            redis.remove_allocations((e.order_id, e.sku) for e in lines)
+
+
+class Relay:
+    """Sends the outbox' rows to Redis in batches of up to `batch_size`,
+    marking each batch sent in a single transaction
+
+    Rows are sent in id order, and ids are taken when rows are inserted,
+    not when they commit: a transaction committing late may have its events
+    sent after later ones of other products. A product's events stay in
+    order, as transactions changing the same product cannot both commit
+
+    Rows are locked while being sent (FOR UPDATE SKIP LOCKED), so relays
+    running side by side never send the same row, though only a single one
+    keeps a product's events in order. Events are sent at least once: those
+    a relay sent but did not mark before dying are sent again"""
+
+    def __init__(
+        self,
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        batch_size: Optional[int] = None,
+        retention: Optional[float] = None,
+    ) -> None:
+        settings = config.get_outbox_settings()
+        self.uow = uow
+        self.batch_size = batch_size or settings["batch_size"]
+        self.retention = timedelta(
+            seconds=settings["retention"] if retention is None else retention
+        )
+        self.sent = 0
+
+    def run_once(self) -> int:
+        "Sends the next batch of events, returns how many"
+        with self.uow:
+            session = self.uow.session
+            query = UNSENT.limit(self.batch_size).with_for_update(
+                skip_locked=True
+            )
+            rows = session.execute(query).fetchall()
+            if not rows:
+                return 0
+            publish([bytes(row.message) for row in rows])
+            session.execute(
+                outbox.update()
+                .where(outbox.c.id.in_([row.id for row in rows]))
+                .values(sent_at=datetime.now())
+            )
+            self.uow.commit()
+        self.sent += len(rows)
+        return len(rows)
+
+    def purge(self) -> int:
+        "Deletes rows sent more than `retention` ago, returns how many"
+        before = datetime.now() - self.retention
+        with self.uow:
+            deleted = self.uow.session.execute(
+                outbox.delete().where(outbox.c.sent_at < before)
+            ).rowcount
+            self.uow.commit()
+        return deleted
+
+    def run(
+        self,
+        stop: threading.Event,
+        poll_interval: Optional[float] = None,
+        report_every: float = 60,
+    ) -> None:
+        """Relays until `stop` is set, polling every `poll_interval`s once
+        the outbox is empty. Every `report_every`s, purges sent rows and
+        logs the backlog"""
+        if poll_interval is None:
+            poll_interval = config.get_outbox_settings()["poll_interval"]
+        reported = time.monotonic()
+        while not stop.is_set():
+            try:
+                if not self.run_once():
+                    stop.wait(poll_interval)
+                if time.monotonic() - reported >= report_every:
+                    reported = time.monotonic()
+                    purged = self.purge()
+                    logger.info("Relay: %s, purged %d", self.stats(), purged)
+            except Exception as ex:
+                # the batch was not marked sent, it is read again
+                logger.exception("Failed to relay events: %s", ex)
+                stop.wait(1)
+
+    def backlog(self) -> Dict[str, Any]:
+        """`events` waiting to be sent, and `seconds` since the oldest of
+        them was committed"""
+        with self.uow:
+            unsent = outbox.c.sent_at.is_(None)
+            count, oldest = self.uow.session.execute(
+                select([func.count(), func.min(outbox.c.created_at)]).where(
+                    unsent
+                )
+            ).first()
+        seconds = (datetime.now() - oldest).total_seconds() if count else 0.0
+        return dict(events=count, seconds=round(max(seconds, 0), 3))
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(sent=self.sent, backlog=self.backlog())
@@ -4,26 +4,119 @@
 # about consistency issues because of concurrent transactions
 # Rui Conti, Apr 2020
 import abc
+import os
+import threading
 
-from typing import Callable, Generator
+from collections import deque
+from typing import Callable, Deque, Dict, Generator, List, Optional, Set
 
 from sqlalchemy import create_engine
+from sqlalchemy import exc
 from sqlalchemy import orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.exc import StaleDataError
 
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import cache, codec, pool, repository
+from allocation.adapters.orm import outbox
+from allocation.domain import events
 
 
-DEFAULT_SESSION_FACTORY = orm.sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(), isolation_level="SERIALIZABLE",
-    ),
-    autoflush=False,
-)
+class LazySessionFactory:
+    """Session factory whose engine is only created once a session is asked
+    for, so importing this module does not connect to (or configure) the
+    database
+
+    A process forked after the engine was created builds its own, so
+    pre-forking servers never share pooled connections between workers.
+    Pool settings come from `config.get_postgres_pool_settings`"""
+
+    def __init__(self) -> None:
+        self._sessionmaker: Optional[orm.sessionmaker] = None
+        self._engine: Optional[Engine] = None
+        self._inherited: Optional[Engine] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # the lock might have been held by another thread of the parent
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self) -> Engine:
+        self._setup()
+        return self._engine  # type: ignore
+
+    def _setup(self) -> None:
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # the parent's engine stays referenced: garbage collecting it
+            # would close connections the parent is still using
+            self._inherited = self._engine
+            self._engine = create_engine(
+                config.get_postgres_uri(),
+                isolation_level=config.get_postgres_isolation_level(),
+                poolclass=pool.InstrumentedQueuePool,
+                **config.get_postgres_pool_settings(),
+            )
+            self._sessionmaker = orm.sessionmaker(
+                bind=self._engine, autoflush=False
+            )
+            self._pid = pid
+
+    def __call__(self) -> orm.Session:
+        self._setup()
+        return self._sessionmaker()  # type: ignore
+
+    def stats(self) -> dict:
+        "Pool counters, empty until the engine is created"
+        if self._engine is None or self._pid != os.getpid():
+            return {}
+        return self._engine.pool.stats()  # type: ignore
+
+
+DEFAULT_SESSION_FACTORY = LazySessionFactory()
+
+_product_cache: Optional[cache.ProductCache] = None
+_product_cache_pid: Optional[int] = None
+_product_cache_lock = threading.Lock()
+
+
+def get_product_cache() -> Optional[cache.ProductCache]:
+    """Cache shared by this process' Units of Work, when
+    `config.get_product_cache_size` is set. It listens to invalidations
+    published by other processes from a background thread"""
+    global _product_cache, _product_cache_pid
+    size = config.get_product_cache_size()
+    if not size:
+        return None
+    with _product_cache_lock:
+        if _product_cache is None or _product_cache_pid != os.getpid():
+            _product_cache = cache.ProductCache(size)
+            _product_cache.listen()
+            _product_cache_pid = os.getpid()
+    return _product_cache
+
+
+# serialization_failure and deadlock_detected
+RETRYABLE_PGCODES = {"40001", "40P01"}
+
+
+class ConcurrentUpdate(Exception):
+    """Another transaction committed changes to the same product first.
+    The whole unit of work can be retried"""
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractProductRepository
+    # events are committed to an outbox, handlers must not send them
+    uses_outbox: bool = False
 
     def __enter__(self):  # type: ignore
         return self
@@ -40,9 +133,12 @@ class AbstractUnitOfWork(abc.ABC):
 
         Message Bus calls this method to handle any new event that might have been
         raised after some command was ran"""
+        if not hasattr(self, "products"):
+            # never entered, so no aggregate could have raised events
+            return
         for product in self.products.seen:
             while product._events:
-                yield product._events.pop(0)
+                yield product._events.popleft()
 
     # def publish_events(self) -> None:
     #     """Unit of Work is responsible for connecting events raised on Domain layer
@@ -52,6 +148,12 @@ class AbstractUnitOfWork(abc.ABC):
     #             event = product.events.pop()
     #             message_bus.handle(event)
 
+    @abc.abstractmethod
+    def fork(self) -> "AbstractUnitOfWork":
+        """Unit of Work bound to the same storage, for handlers that run
+        concurrently with the ones using this instance"""
+        raise NotImplementedError
+
     def commit(self) -> None:
         """Every time a commit is made, we try to commit current database transaction"""
         self._commit()
@@ -71,6 +173,9 @@ class FakeUnitOfWork(AbstractUnitOfWork):
         self.products = repository.FakeProductRepository([])
         self.commited = False
 
+    def fork(self) -> AbstractUnitOfWork:
+        return self
+
     def _commit(self) -> None:
         self.commited = True
 
@@ -78,21 +183,142 @@ class FakeUnitOfWork(AbstractUnitOfWork):
         pass
 
 
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    """Unit of Work over an InMemoryStore, for running the service on a
+    single node without a database. Units of Work sharing a store run one
+    at a time, as the store's lock is held while entered
+
+    Stored products are changed in place: `rollback` undoes the changes
+    made since they were looked up (see `InMemoryProductRepository`)"""
+
+    def __init__(self, store: Optional[repository.InMemoryStore] = None):
+        self.store = store if store is not None else repository.InMemoryStore()
+
+    def __enter__(self) -> AbstractUnitOfWork:
+        self.store.lock.acquire()
+        self._repository = repository.InMemoryProductRepository(self.store)
+        self.products = self._repository
+        return super().__enter__()
+
+    def __exit__(self, *args):  # type: ignore
+        try:
+            super().__exit__(*args)
+        finally:
+            self.store.lock.release()
+
+    def fork(self) -> AbstractUnitOfWork:
+        return InMemoryUnitOfWork(self.store)
+
+    def _commit(self) -> None:
+        self._repository.commit()
+
+    def rollback(self) -> None:
+        self._repository.rollback()
+
+
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory: Callable = DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory: Callable = DEFAULT_SESSION_FACTORY,
+        cache: Optional[cache.ProductCache] = None,
+        outbox: Optional[bool] = None,
+    ):
+        """Without a `cache`, the default session factory uses the process'
+        one (see `get_product_cache`). With `outbox` (by default, when
+        `config.get_outbox_settings` says so), every commit also writes the
+        events raised since the previous one to the `outbox` table"""
         self.session_factory: Callable = session_factory
+        if cache is None and session_factory is DEFAULT_SESSION_FACTORY:
+            cache = get_product_cache()
+        self.cache = cache
+        if outbox is None:
+            outbox = config.get_outbox_settings()["publishing"] == "outbox"
+        self.uses_outbox = outbox
+        self._events: Deque[events.Event] = deque()
+        self._changed: Set[str] = set()
+        # events of each product already written to the outbox
+        self._outboxed: Dict[str, int] = {}
 
     def __enter__(self) -> AbstractUnitOfWork:
         self.session: orm.Session = self.session_factory()
-        self.products = repository.SqlAlchemyProductRepository(self.session)
+        self._changed = set()
+        self._outboxed = {}
+        if self.cache is not None:
+            # committed products stay loaded so they can be cached
+            self.session.expire_on_commit = False
+        self.products = repository.SqlAlchemyProductRepository(
+            self.session, cache=self.cache
+        )
         return super().__enter__()
 
     def __exit__(self, *args):  # type: ignore
+        session = self.session
+        pending = session.new or session.dirty or session.deleted
+        if self.cache is not None and args[0] is None and not pending:
+            # closing without rolling back keeps products' committed state
+            session.close()
+            self._cache_products()
+            return
         super().__exit__(*args)
         self.session.close()
 
+    def _cache_products(self) -> None:
+        assert self.cache is not None
+        for product in self.products.seen:
+            # once cached, another Unit of Work may check the product out
+            # before the message bus collects its events
+            self._events.extend(product._events)
+            product._events.clear()
+            self.cache.checkin(product)
+        self.cache.publish_invalidations(self._changed)
+
+    def collect_new_events(self) -> Generator:
+        while self._events:
+            yield self._events.popleft()
+        yield from super().collect_new_events()
+
+    def fork(self) -> AbstractUnitOfWork:
+        return SqlAlchemyUnitOfWork(
+            self.session_factory, self.cache, self.uses_outbox
+        )
+
+    def _write_outbox(self) -> Dict[str, int]:
+        """Adds the events raised since the last commit to the transaction.
+        Returns how many events of each product are written once it commits
+
+        Events stay on their product for the message bus to collect: within
+        a Unit of Work, they are only added to, never taken from"""
+        outboxed = dict(self._outboxed)
+        rows: List[dict] = []
+        for product in self.products.seen:
+            raised = list(product._events)
+            written = outboxed.get(product.sku, 0)
+            rows.extend(
+                dict(message=codec.encode(event)) for event in raised[written:]
+            )
+            outboxed[product.sku] = len(raised)
+        if rows:
+            self.session.execute(outbox.insert(), rows)
+        return outboxed
+
     def _commit(self) -> None:
-        self.session.commit()
+        changed = {
+            product.sku
+            for product in self.products.seen
+            if product in self.session.dirty or product in self.session.new
+        }
+        outboxed = self._write_outbox() if self.uses_outbox else {}
+        try:
+            self.session.commit()
+        except StaleDataError as ex:
+            raise ConcurrentUpdate(str(ex)) from ex
+        except exc.DBAPIError as ex:
+            if getattr(ex.orig, "pgcode", None) in RETRYABLE_PGCODES:
+                raise ConcurrentUpdate(str(ex.orig)) from ex
+            raise
+        self._changed |= changed
+        self._outboxed.update(outboxed)
 
     def rollback(self) -> None:
+        self._changed = set()
         self.session.rollback()
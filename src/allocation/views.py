@@ -1,19 +1,73 @@
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
 
+from allocation import config
+from allocation.adapters import redis
 from allocation.service import unit_of_work
 
+# rows fetched at a time from the server-side cursor when streaming
+STREAM_CHUNK_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+
 
 def all_allocations(uow: unit_of_work.AbstractUnitOfWork) -> List[Dict]:
+    return list(iter_allocations(uow))
+
+
+def iter_allocations(
+    uow: unit_of_work.AbstractUnitOfWork, chunk_size: int = STREAM_CHUNK_SIZE
+) -> Iterator[Dict]:
+    """Every allocation, read through a server-side cursor `chunk_size` rows
+    at a time, so memory use does not depend on the size of the table. The
+    Unit of Work stays open until the iterator is exhausted or closed"""
     with uow:
-        results = uow.session.execute(
-            "SELECT id_orderline, batchref, sku, qty FROM allocations_view"
+        connection = uow.session.connection(  # type: ignore
+            execution_options=dict(stream_results=True)
         )
-    return [dict(r) for r in results]
+        results = connection.execute(
+            "SELECT id_orderline, batchref, sku, qty FROM allocations_view "
+            "ORDER BY id"
+        )
+        rows = results.fetchmany(chunk_size)
+        while rows:
+            yield from (dict(r) for r in rows)
+            rows = results.fetchmany(chunk_size)
+
+
+def allocations_page(
+    uow: unit_of_work.AbstractUnitOfWork,
+    limit: int,
+    after: Optional[int] = None,
+) -> Tuple[List[Dict], Optional[int]]:
+    """Up to `limit` allocations following the cursor `after` (keyset
+    pagination on `allocations_view.id`: every page is an index range scan,
+    however deep it is) and the cursor of the next page, None on the last"""
+    with uow:
+        results = uow.session.execute(  # type: ignore
+            "SELECT id, id_orderline, batchref, sku, qty "
+            "FROM allocations_view "
+            "WHERE id > :after "
+            "ORDER BY id "
+            "LIMIT :limit",
+            dict(after=after or 0, limit=limit + 1),
+        ).fetchall()
+    page = [dict(r) for r in results[:limit]]
+    cursor = page[-1].pop("id") if len(results) > limit else None
+    for row in page:
+        row.pop("id", None)
+    return page, cursor
 
 
 def allocations(
     order_id: str, uow: unit_of_work.AbstractUnitOfWork
 ) -> List[Dict]:
+    """Read from Redis first when it is the configured read model (see
+    `config.get_allocations_read_model`). Orders not found there are read
+    from `allocations_view`, without being copied over: the Redis model is
+    only written by event handlers and `entrypoints.rebuild_read_model`"""
+    if config.get_allocations_read_model() == "redis":
+        found = redis.get_allocations(order_id)
+        if found:
+            return found
     with uow:
         results = uow.session.execute(
             "SELECT batchref, sku, qty "
@@ -1,4 +1,5 @@
 import time
+import uuid
 import requests
 import pytest  # type: ignore
 
@@ -11,6 +12,7 @@ from tenacity import retry, stop_after_delay  # type: ignore
 
 
 from allocation import config  # type: ignore
+from allocation.adapters.redis import StreamConsumer
 from allocation.entrypoints import app, consumer
 from allocation.adapters.orm import start_mappers, clear_mappers, metadata  # type: ignore
 
@@ -106,8 +108,14 @@ def redis_client():
 
 
 @pytest.fixture
-def redis_log_events_pubsub(redis_client):
-    pb = redis_client.pubsub(ignore_subscribe_messages=True)
-    pb.subscribe(consumer.EXTERNAL_CHANNELS_HANDLERS)
-    yield pb
-    pb.close()
+def redis_log_events_consumer(redis_client):
+    group = f"test-{uuid.uuid4().hex[:6]}"
+    streams = list(consumer.EXTERNAL_CHANNELS_HANDLERS)
+    for stream in streams:
+        # only entries added from now on
+        redis_client.xgroup_create(stream, group, "$", mkstream=True)
+    yield StreamConsumer(
+        group, "test", streams, client=redis_client, block_ms=100
+    )
+    for stream in streams:
+        redis_client.xgroup_destroy(stream, group)
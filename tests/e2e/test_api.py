@@ -2,6 +2,7 @@
 # Expected behaviors on API requests and responses exclusively
 # No usage of domain, services nor any adaptor
 # Rui Conti, Apr 2020
+import json
 from typing import Any, List
 
 from tests.helpers import random_sku, random_batchref, random_orderid
@@ -11,6 +12,7 @@ from tests.helpers import random_sku, random_batchref, random_orderid
 # 0.0.11 Wait, we didn't verify if changes are commited to db
 # 0.0.12 What if I try to allocate an SKU that's out of stock?
 # 0.0.13 What if I try to allocate an SKU that has no stock?
+# 0.0.14 Can I page through (or stream) every allocation?
 
 
 def post_stock(client: Any, batches: List) -> None:
@@ -78,3 +80,29 @@ def test_allocation_and_query_responsibility(client_api) -> None:
 
     r = client_api.get(f"/allocations/{orderid}")
     assert r.json[0] == {"batchref": earlybatch, "sku": sku, "qty": 90}
+
+
+def test_allocations_paginated_and_streamed(client_api) -> None:
+    sku, batchref = random_sku(), random_batchref()
+    post_stock(client_api, [(batchref, sku, 100, None)])
+    for i in range(3):
+        data = {"order_id": random_orderid(str(i)), "sku": sku, "qty": 1}
+        assert client_api.post("/allocate", json=data).status_code == 202
+
+    r = client_api.get("/allocations?limit=1000")
+    assert r.status_code == 200
+    rows, cursor = list(r.json), r.headers.get("X-Next-Cursor")
+    while cursor:
+        r = client_api.get(f"/allocations?limit=1000&after={cursor}")
+        rows.extend(r.json)
+        cursor = r.headers.get("X-Next-Cursor")
+    assert [row for row in rows if row["sku"] == sku] == [
+        row for row in client_api.get("/allocations").json if row["sku"] == sku
+    ]
+
+    r = client_api.get("/allocations?format=ndjson")
+    assert r.mimetype == "application/x-ndjson"
+    streamed = [json.loads(line) for line in r.data.splitlines()]
+    assert len([row for row in streamed if row["sku"] == sku]) == 3
+
+    assert client_api.get("/allocations?limit=0").status_code == 400
@@ -0,0 +1,81 @@
+import time
+
+from allocation.adapters import cache
+from allocation.domain import commands, model
+from allocation.service import handlers, message_bus, unit_of_work
+
+
+def allocate(session_factory, product_cache, order_id: str) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache)
+    message_bus.handle(commands.Allocate(order_id, "LAMP", 10), uow)
+
+
+def test_reuses_cached_product_while_its_version_is_current(
+    sqlite_session_factory,
+):
+    product_cache = cache.ProductCache(max_size=10)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, product_cache
+    )
+    handlers.add_batch(commands.CreateBatch("b1", "LAMP", 100, None), uow)
+    allocate(sqlite_session_factory, product_cache, "o1")
+    allocate(sqlite_session_factory, product_cache, "o2")
+    assert product_cache.stats()["hits"] == 2
+
+    session = sqlite_session_factory()
+    session.execute("UPDATE products SET version_number = 99")
+    session.commit()
+    allocate(sqlite_session_factory, product_cache, "o3")
+    assert product_cache.stats()["stale"] == 1
+
+    [[allocated]] = session.execute("SELECT count(*) FROM allocations")
+    assert allocated == 3
+    [[version]] = session.execute("SELECT version_number FROM products")
+    assert version == 100
+    assert len(product_cache) == 1
+
+
+def test_failed_unit_of_work_does_not_cache_product(sqlite_session_factory):
+    product_cache = cache.ProductCache(max_size=10)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, product_cache
+    )
+    handlers.add_batch(commands.CreateBatch("b1", "LAMP", 100, None), uow)
+    try:
+        with uow:
+            uow.products.get("LAMP").allocate(model.OrderLine("o1", "LAMP", 1))
+            raise ValueError()
+    except ValueError:
+        pass
+    assert len(product_cache) == 0
+
+    with uow:
+        [batch] = uow.products.get("LAMP").batches
+        assert batch.available_quantity == 100
+
+
+def test_evicts_least_recently_used_products() -> None:
+    product_cache = cache.ProductCache(max_size=2)
+    for sku in ["A", "B", "C"]:
+        product_cache.checkin(model.Product(sku, []))
+
+    assert product_cache.checkout("A", lambda: 0) is None
+    assert product_cache.checkout("C", lambda: 0) is not None
+    assert product_cache.stats()["evictions"] == 1
+
+
+def test_invalidations_from_other_processes(redis_client) -> None:
+    product_cache = cache.ProductCache(max_size=2)
+    product_cache.checkin(model.Product("A", [model.BatchOrder("b", "A", 1)]))
+    thread = product_cache.listen()
+    try:
+        product_cache.publish_invalidations(["A"])  # its own: ignored
+        cache.ProductCache(max_size=2).publish_invalidations(["A"])
+        for _ in range(50):
+            if not len(product_cache):
+                break
+            time.sleep(0.05)
+    finally:
+        thread.stop()
+    assert product_cache.stats()["invalidations"] == 1
+    assert product_cache.sku_for("b") is None
@@ -0,0 +1,53 @@
+import threading
+import time
+
+from sqlalchemy import create_engine
+
+from allocation import config
+from allocation.adapters import pool
+
+
+def make_engine(**kwargs):
+    return create_engine(
+        config.get_postgres_uri(),
+        poolclass=pool.InstrumentedQueuePool,
+        **kwargs,
+    )
+
+
+def test_counts_checkouts_waits_and_overflow(postgres_db):
+    engine = make_engine(pool_size=1, max_overflow=1, pool_timeout=5)
+    first, second = engine.connect(), engine.connect()
+    assert engine.pool.stats()["overflow"] == 1
+
+    waited = threading.Thread(target=lambda: engine.connect().close())
+    waited.start()
+    deadline = time.monotonic() + 5
+    while engine.pool.stats()["waiting"] == 0:
+        assert time.monotonic() < deadline, "checkout never waited"
+        time.sleep(0.01)
+    first.close()
+    waited.join()
+    second.close()
+
+    stats = engine.pool.stats()
+    assert stats["checkouts"] == 3
+    assert stats["waits"] == 1
+    assert stats["waiting"] == 0
+    assert stats["peak_overflow"] == 1
+    assert stats["checked_out"] == 0
+    engine.dispose()
+
+
+def test_connections_are_not_reused_across_processes(
+    postgres_db, monkeypatch
+):
+    engine = make_engine(pool_size=1, max_overflow=0)
+    with engine.connect() as conn:
+        inherited = conn.connection.connection
+
+    monkeypatch.setattr(pool.os, "getpid", lambda: -1)  # forked
+    with engine.connect() as conn:
+        assert conn.connection.connection is not inherited
+        assert conn.scalar("SELECT 1") == 1
+    engine.dispose()
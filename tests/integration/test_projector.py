@@ -0,0 +1,94 @@
+import threading
+
+import pytest  # type: ignore
+
+from allocation import views
+from allocation.adapters import orm, redis
+from allocation.domain import commands
+from allocation.service import message_bus, unit_of_work
+from allocation.service.projector import ProjectionGap, Projector
+from tests import helpers
+
+
+def use_projector(monkeypatch) -> None:
+    monkeypatch.setenv("READ_MODEL_PROJECTION", "projector")
+    monkeypatch.setenv("READ_MODEL_STREAM", f"stream-{helpers.random_sku()}")
+
+
+def allocate_and_deallocate(uow: unit_of_work.AbstractUnitOfWork) -> tuple:
+    sku, batchref = helpers.random_sku(), helpers.random_batchref()
+    kept, dropped = helpers.random_orderid(), helpers.random_orderid()
+    message_bus.handle(commands.CreateBatch(batchref, sku, 100, None), uow)
+    message_bus.handle(commands.Allocate(dropped, sku, 10), uow)
+    message_bus.handle(commands.Allocate(kept, sku, 20), uow)
+    message_bus.handle(commands.Deallocate(sku, order_id=dropped), uow)
+    return batchref, sku, kept, dropped
+
+
+def view_rows(session_factory) -> int:
+    session = session_factory()
+    count = orm.allocations_view.count()
+    rows = session.execute(count).scalar()
+    session.close()
+    return rows
+
+
+def test_projects_allocation_events_off_the_command_path(
+    sqlite_session_factory, monkeypatch
+):
+    use_projector(monkeypatch)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    batchref, sku, kept, dropped = allocate_and_deallocate(uow)
+    assert views.allocations(kept, uow) == []
+    projector = Projector(uow)
+    assert projector.lag()["seconds"] > 0
+
+    assert projector.run_once() == 3
+
+    expected = [dict(batchref=batchref, sku=sku, qty=20)]
+    assert views.allocations(kept, uow) == expected
+    assert views.allocations(dropped, uow) == []
+    assert projector.lag()["seconds"] == 0
+    assert projector.run_once() == 0
+
+
+def test_resumes_from_its_checkpoint(sqlite_session_factory, monkeypatch):
+    use_projector(monkeypatch)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    allocate_and_deallocate(uow)
+    assert Projector(uow, batch_size=1).run_once() == 1
+    assert view_rows(sqlite_session_factory) == 1
+
+    # as if the first projector crashed
+    restarted = Projector(uow)
+    assert restarted.run_once() == 2
+    assert view_rows(sqlite_session_factory) == 1
+    assert restarted.checkpoint() == restarted.position
+
+
+def test_stops_on_events_trimmed_before_being_applied(
+    sqlite_session_factory, monkeypatch
+):
+    use_projector(monkeypatch)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    allocate_and_deallocate(uow)
+    projector = Projector(uow, batch_size=1)
+    assert projector.run_once() == 1
+    assert projector.lag()["gap"] is False
+
+    stream = projector.stream
+    redis.get_client().xtrim(stream, maxlen=1, approximate=False)
+    assert projector.lag()["gap"] is True
+    with pytest.raises(ProjectionGap):
+        projector.run_once()
+    projector.run(threading.Event(), block_ms=1)  # returns, not retries
+    assert view_rows(sqlite_session_factory) == 1
+
+
+def test_deallocations_are_projected_inline(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    batchref, sku, kept, dropped = allocate_and_deallocate(uow)
+
+    assert views.allocations(dropped, uow) == []
+    [allocation] = views.allocations(kept, uow)
+    assert allocation["qty"] == 20
@@ -0,0 +1,186 @@
+from allocation import views
+from allocation.adapters import codec, redis
+from allocation.domain import commands, events
+from allocation.entrypoints import rebuild_read_model
+from allocation.service import handlers, message_bus, unit_of_work
+from tests.helpers import random_batchref, random_orderid, random_sku
+
+
+def subscribe(redis_client):
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("allocation-events")
+    pubsub.get_message(timeout=1)  # subscription confirmation
+    return pubsub
+
+
+def received(pubsub) -> list:
+    messages = []
+    msg = pubsub.get_message(timeout=1)
+    while msg:
+        messages.append(msg["data"])
+        msg = pubsub.get_message(timeout=0.1)
+    return messages
+
+
+def test_buffer_sends_every_message_only_on_flush(redis_client):
+    pubsub = subscribe(redis_client)
+    buffer = redis.PublishBuffer(max_batch_size=2)
+    for message in ["a", "b", "a", "c"]:
+        buffer.add("allocation-events", message)
+    assert len(buffer) == 4
+    assert received(pubsub) == []
+
+    buffer.flush()
+    assert received(pubsub) == [b"a", b"b", b"a", b"c"]
+    assert len(buffer) == 0
+    pubsub.close()
+
+
+def test_equal_events_are_all_appended(redis_log_events_consumer):
+    uow = unit_of_work.FakeUnitOfWork()
+    sku = random_sku()
+    with redis.buffered_publishing():
+        for _ in range(2):
+            handlers.publish_to_log_channel(events.OutOfStock(sku), uow)
+
+    entries = redis_log_events_consumer.read()
+    assert [codec.decode(m) for _, _, m in entries] == [
+        events.OutOfStock(sku),
+        events.OutOfStock(sku),
+    ]
+
+
+def test_publishes_nothing_when_handling_fails(redis_client):
+    pubsub = subscribe(redis_client)
+    try:
+        with redis.buffered_publishing():
+            redis.publish_message("allocation-events", "lost")
+            raise ValueError()
+    except ValueError:
+        pass
+    assert received(pubsub) == []
+    pubsub.close()
+
+
+def test_message_bus_appends_events_once_handled(redis_client):
+    sku, batchref = random_sku(), random_batchref()
+    uow = unit_of_work.FakeUnitOfWork()
+    message_bus.handle(commands.CreateBatch(batchref, sku, 10, None), uow)
+
+    [(_, fields)] = redis_client.xrevrange("allocation-events", count=1)
+    assert batchref.encode() in fields[b"message"]
+
+
+def consumers(redis_client, *names, **settings) -> list:
+    stream = f"stream-{random_sku()}"
+    group = "group"
+    return [
+        redis.StreamConsumer(group, name, [stream], redis_client, **settings)
+        for name in names
+    ]
+
+
+def test_consumers_in_a_group_share_entries(redis_client):
+    first, second = consumers(redis_client, "c1", "c2", count=2, block_ms=10)
+    [stream] = first.streams
+    for message in ["a", "b", "c"]:
+        redis.append_message(stream, message)
+
+    read = first.read() + second.read()
+    assert sorted(message for _, _, message in read) == [b"a", b"b", b"c"]
+    assert second.read() == []
+
+
+def test_restarted_consumer_gets_its_unacked_entries(redis_client):
+    [consumer] = consumers(redis_client, "c1", block_ms=10)
+    [stream] = consumer.streams
+    redis.append_message(stream, "a")
+    redis.append_message(stream, "b")
+    [(_, first_id, _), (_, second_id, _)] = consumer.read()
+    consumer.ack(stream, first_id)
+
+    restarted = redis.StreamConsumer("group", "c1", [stream], redis_client)
+    assert restarted.read() == [(stream, second_id, b"b")]
+    assert restarted.read() == []
+
+
+def test_reclaims_entries_of_dead_consumers(redis_client):
+    dead, alive = consumers(
+        redis_client, "c1", "c2", claim_idle_ms=0, max_deliveries=3
+    )
+    [stream] = dead.streams
+    redis.append_message(stream, "a")
+    [(_, entry_id, _)] = dead.read()
+
+    assert alive.reclaim() == [(stream, entry_id, b"a")]
+    # delivered twice, dropped on the third attempt
+    assert dead.reclaim() == [(stream, entry_id, b"a")]
+    assert alive.reclaim() == []
+    assert redis_client.xpending(stream, "group")["pending"] == 0
+
+
+def test_streams_are_trimmed(redis_client):
+    stream = f"stream-{random_sku()}"
+    for i in range(500):
+        redis.append_message(stream, i, maxlen=10)
+    # trimming is approximate, whole nodes of entries at a time
+    assert redis_client.xlen(stream) < 500
+
+
+def allocate(uow: unit_of_work.AbstractUnitOfWork) -> tuple:
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+    message_bus.handle(commands.CreateBatch(batchref, sku, 10, None), uow)
+    message_bus.handle(commands.Allocate(orderid, sku, 3), uow)
+    return sku, batchref, orderid
+
+
+def test_read_model_follows_allocations(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    sku, batchref, orderid = allocate(uow)
+    expected = [dict(batchref=batchref, sku=sku, qty=3)]
+    assert redis.get_allocations(orderid) == expected
+
+    message_bus.handle(commands.Deallocate(sku, order_id=orderid), uow)
+    assert redis.get_allocations(orderid) == []
+
+
+def test_views_fall_through_to_sql_on_miss(
+    sqlite_session_factory, redis_client, monkeypatch
+):
+    monkeypatch.setenv("ALLOCATIONS_READ_MODEL", "redis")
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    sku, batchref, orderid = allocate(uow)
+    redis_client.delete(redis.allocations_key(orderid))
+
+    expected = [dict(batchref=batchref, sku=sku, qty=3)]
+    assert views.allocations(orderid, uow) == expected
+    assert redis.get_allocations(orderid) == []
+
+
+def test_rebuilds_read_model_from_allocations(
+    sqlite_session_factory, redis_client
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    sku, batchref, orderid = allocate(uow)
+    stale = redis.allocations_key(random_orderid())
+    redis_client.hset(stale, sku, redis.serialize({}))
+    redis_client.delete(redis.allocations_key(orderid))
+
+    rebuild_read_model.rebuild(uow)
+
+    expected = [dict(batchref=batchref, sku=sku, qty=3)]
+    assert redis.get_allocations(orderid) == expected
+    assert not redis_client.exists(stale)
+
+
+def test_buffer_appends_every_stream_entry(redis_client):
+    stream = f"stream-{random_sku()}"
+    buffer = redis.PublishBuffer(max_batch_size=2)
+    for message in ["a", "b", "a"]:
+        buffer.append(stream, message)
+    assert redis_client.xlen(stream) == 0
+
+    buffer.flush()
+    entries = redis_client.xrange(stream)
+    assert [fields[b"message"] for _, fields in entries] == [b"a", b"b", b"a"]
+    redis_client.delete(stream)
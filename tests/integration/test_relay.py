@@ -0,0 +1,110 @@
+import pytest  # type: ignore
+
+from allocation import views
+from allocation.adapters import codec, orm, redis
+from allocation.entrypoints import app
+from allocation.domain import commands, model
+from allocation.service import message_bus, unit_of_work
+from allocation.service.relay import Relay
+from tests import helpers
+
+
+def outbox_rows(session_factory, sent: bool) -> list:
+    session = session_factory()
+    sent_at = orm.outbox.c.sent_at
+    query = orm.outbox.select().where(
+        sent_at.isnot(None) if sent else sent_at.is_(None)
+    )
+    rows = session.execute(query.order_by(orm.outbox.c.id)).fetchall()
+    session.close()
+    return rows
+
+
+def names(entries) -> list:
+    return [type(codec.decode(message)).__name__ for _, _, message in entries]
+
+
+def test_events_are_sent_by_the_relay_only(
+    sqlite_session_factory, redis_log_events_consumer
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, outbox=True
+    )
+    sku, orderid = helpers.random_sku(), helpers.random_orderid()
+    message_bus.handle(
+        commands.CreateBatch(helpers.random_batchref(), sku, 100, None), uow
+    )
+    message_bus.handle(commands.Allocate(orderid, sku, 10), uow)
+
+    assert redis_log_events_consumer.read() == []
+    assert redis.get_allocations(orderid) == []
+    assert len(outbox_rows(sqlite_session_factory, sent=False)) == 2
+
+    relay = Relay(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory))
+    assert relay.run_once() == 2
+    assert relay.run_once() == 0
+
+    sent = names(redis_log_events_consumer.read())
+    assert sent == ["BatchCreated", "Allocated"]
+    assert redis.get_allocations(orderid) == views.allocations(orderid, uow)
+    assert outbox_rows(sqlite_session_factory, sent=False) == []
+    assert relay.backlog() == dict(events=0, seconds=0.0)
+
+
+def test_events_of_conflicting_commits_are_not_written(
+    postgres_session_factory,
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        postgres_session_factory, outbox=True
+    )
+    sku, batchref = helpers.random_sku(), helpers.random_batchref()
+    message_bus.handle(commands.CreateBatch(batchref, sku, 100, None), uow)
+    first, second = uow.fork(), uow.fork()
+
+    with first, second:
+        for concurrent in (first, second):
+            product = concurrent.products.get(sku=sku)
+            product.allocate(model.OrderLine(helpers.random_orderid(), sku, 1))
+        first.commit()
+        with pytest.raises(unit_of_work.ConcurrentUpdate):
+            second.commit()
+
+    rows = outbox_rows(postgres_session_factory, sent=False)
+    written = [codec.decode(row.message) for row in rows]
+    about_sku = [e for e in written if getattr(e, "sku", None) == sku]
+    assert [type(e).__name__ for e in about_sku] == [
+        "BatchCreated",
+        "Allocated",
+    ]
+
+
+def test_sent_events_are_purged_after_retention(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, outbox=True
+    )
+    batch = commands.CreateBatch(
+        helpers.random_batchref(), helpers.random_sku(), 100, None
+    )
+    message_bus.handle(batch, uow)
+    relay = Relay(uow, retention=0)
+    relay.run_once()
+    assert outbox_rows(sqlite_session_factory, sent=True)
+
+    assert relay.purge() >= 1
+    assert outbox_rows(sqlite_session_factory, sent=True) == []
+
+
+def test_metrics_reuse_the_backlog_queried(client_api, monkeypatch):
+    monkeypatch.setenv("EVENT_PUBLISHING", "outbox")
+    monkeypatch.setattr(app, "queried_metrics", {})
+    queries = []
+
+    def backlog(relay) -> dict:
+        queries.append(relay)
+        return dict(events=0, seconds=0.0)
+
+    monkeypatch.setattr(Relay, "backlog", backlog)
+    for _ in range(3):
+        r = client_api.get("/metrics")
+        assert r.json["outbox_backlog"] == dict(events=0, seconds=0.0)
+    assert len(queries) == 1
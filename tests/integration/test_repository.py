@@ -3,10 +3,13 @@
 # No testing of services' layer abstractions. Only UoW's abstractions
 # Domain's imported to simulate Service Layer behavior
 # Rui Conti, Apr 2020
+import pytest  # type: ignore
+from sqlalchemy import event  # type: ignore
 from sqlalchemy.orm import Session  # type: ignore
 
-from allocation.domain import model  # type: ignore
+from allocation.domain import commands, model  # type: ignore
 from allocation.adapters import repository  # type: ignore
+from allocation.service import handlers, unit_of_work  # type: ignore
 
 
 def test_get_by_batchref(sqlite_session: Session):
@@ -24,3 +27,49 @@ def test_get_by_batchref(sqlite_session: Session):
 
     assert repo.get_by_batchref("b1") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def count_selects_allocating(session_factory, engine, batches: int) -> int:
+    sku = f"SKU-{batches}"
+    session = session_factory()
+    product = model.Product(
+        sku, [model.BatchOrder(f"b{i}", sku, 20) for i in range(batches)]
+    )
+    for i in range(batches):
+        product.allocate(model.OrderLine(f"o{i}", sku, 10))
+    session.add(product)
+    session.commit()
+
+    selects = []
+
+    def count(conn, cursor, statement, *args) -> None:  # type: ignore
+        if statement.startswith("SELECT"):
+            selects.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        handlers.allocate(commands.Allocate("new", sku, 1), uow)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return len(selects)
+
+
+@pytest.mark.parametrize("strategy", ["selectin", "joined"])
+def test_allocate_loads_product_in_constant_queries(
+    sqlite_db, sqlite_session_factory, monkeypatch, strategy
+):
+    monkeypatch.setenv("PRODUCT_LOAD_STRATEGY", strategy)
+    one = count_selects_allocating(sqlite_session_factory, sqlite_db, 1)
+    many = count_selects_allocating(sqlite_session_factory, sqlite_db, 8)
+    assert one == many
+    assert many <= 3
+
+
+def test_lazy_loading_queries_allocations_per_batch(
+    sqlite_db, sqlite_session_factory, monkeypatch
+):
+    monkeypatch.setenv("PRODUCT_LOAD_STRATEGY", "lazy")
+    one = count_selects_allocating(sqlite_session_factory, sqlite_db, 1)
+    many = count_selects_allocating(sqlite_session_factory, sqlite_db, 8)
+    assert many == one + 7
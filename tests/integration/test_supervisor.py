@@ -0,0 +1,117 @@
+import json
+import os
+import signal
+import threading
+
+from tenacity import Retrying, stop_after_delay  # type: ignore
+
+from allocation import views
+from allocation.adapters import codec, redis
+from allocation.domain import commands
+from allocation.entrypoints import consumer, supervisor
+from allocation.service import executor, unit_of_work
+from tests.helpers import random_batchref, random_orderid, random_sku
+
+
+def use_stream(monkeypatch, handler) -> str:
+    stream = f"commands-{random_sku()}"
+    monkeypatch.setattr(
+        consumer, "EXTERNAL_CHANNELS_HANDLERS", {stream: handler}
+    )
+    return stream
+
+
+def send(stream: str, name: str, **fields) -> None:
+    "As an external producer would, in JSON"
+    redis.append_message(stream, json.dumps(dict(fields, name=name)))
+
+
+def test_routes_messages_by_sku(redis_client, monkeypatch):
+    stream = use_stream(monkeypatch, consumer.handle_external_commands)
+    skus = [random_sku() for _ in range(10)]
+    for sku in skus:
+        send(stream, "Allocate", order_id="o1", sku=sku, qty=1)
+        command = commands.Allocate("o2", sku, 1)
+        redis.append_message(stream, codec.encode(command, binary=True))
+
+    assert supervisor.Supervisor(processes=3).route() == 20
+
+    for index in range(3):
+        target = supervisor.partition_stream(stream, index)
+        entries = redis_client.xrange(target)
+        routed = [codec.decode(fields[b"message"]) for _, fields in entries]
+        assert {executor.partition(c.sku, 3) for c in routed} <= {index}
+        assert len(routed) == 2 * sum(
+            executor.partition(sku, 3) == index for sku in skus
+        )
+
+
+def test_routes_batch_quantity_changes_with_their_sku():
+    for sku in [random_sku() for _ in range(10)]:
+        allocate = codec.encode(commands.Allocate("o1", sku, 1))
+        change = commands.ChangeBatchQuantity(random_batchref(), 5, sku)
+        assert supervisor.partition(
+            codec.encode(change), 3
+        ) == supervisor.partition(allocate, 3)
+
+
+def test_consumer_processes_handle_commands(postgres_db, monkeypatch):
+    stream = use_stream(monkeypatch, consumer.handle_external_commands)
+    sku, orderid = random_sku(), random_orderid()
+    batchref = random_batchref()
+    stop = threading.Event()
+    pool = supervisor.Supervisor(processes=2, restart_delay=0)
+    thread = threading.Thread(target=pool.run, args=(stop,))
+    thread.start()
+    try:
+        send(stream, "CreateBatch", ref=batchref, sku=sku, qty=10, eta=None)
+        send(stream, "Allocate", order_id=orderid, sku=sku, qty=3)
+
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+        for attempt in Retrying(stop=stop_after_delay(10), reraise=True):
+            with attempt:
+                [allocation] = views.allocations(orderid, uow)
+                assert allocation["batchref"] == batchref
+
+        crashed = pool._workers[0]
+        os.kill(crashed.pid, signal.SIGKILL)
+        for attempt in Retrying(stop=stop_after_delay(10), reraise=True):
+            with attempt:
+                assert pool.restarts == 1
+    finally:
+        stop.set()
+        thread.join()
+    assert not crashed.is_alive()
+
+
+def run_worker(monkeypatch, fails_on: bytes, failures: int) -> list:
+    "Handles entries a, b and c, with `failures` failures on `fails_on`"
+    monkeypatch.setattr(consumer, "RETRY_DELAY", 0)
+    stream = f"commands-{random_sku()}"
+    for message in ["a", "b", "c"]:
+        redis.append_message(stream, message)
+    handled = []
+    stop = threading.Event()
+
+    def handle(message: bytes) -> None:
+        handled.append(message)
+        if message == fails_on and handled.count(message) <= failures:
+            raise ValueError(message)
+        if message == b"c":
+            stop.set()
+
+    consumer.worker(stop, "test", {stream: handle})
+    pending = redis.get_client().xpending(stream, consumer.CONSUMER_GROUP)
+    assert pending["pending"] == 0
+    return handled
+
+
+def test_worker_retries_failed_entries_before_later_ones(monkeypatch):
+    handled = run_worker(monkeypatch, fails_on=b"b", failures=2)
+    assert handled == [b"a", b"b", b"b", b"b", b"c"]
+
+
+def test_worker_drops_entries_failing_too_many_times(monkeypatch):
+    monkeypatch.setenv("REDIS_STREAM_MAX_DELIVERIES", "2")
+    handled = run_worker(monkeypatch, fails_on=b"b", failures=5)
+    assert handled == [b"a", b"b", b"b", b"c"]
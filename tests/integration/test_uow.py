@@ -8,10 +8,10 @@ import traceback
 import threading
 
 from pytest import raises  # type: ignore
-from sqlalchemy.orm import Session  # type: ignore
+from sqlalchemy.orm import Session, sessionmaker  # type: ignore
 
-from allocation.domain import model  # type: ignore
-from allocation.service import unit_of_work  # type: ignore
+from allocation.domain import commands, model  # type: ignore
+from allocation.service import message_bus, unit_of_work  # type: ignore
 
 
 def insert_batch(session: Session, ref: str, sku: str, qty: int) -> None:
@@ -93,6 +93,65 @@ def test_uow_can_retrieve_batch_and_allocate_it(sqlite_session_factory):
     assert batchref == batchref_dummy
 
 
+def test_uow_loads_running_allocated_quantity(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session=session, ref="b1", sku="ROSEIRA P15", qty=120)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="ROSEIRA P15")
+        product.allocate(model.OrderLine("o1", "ROSEIRA P15", 80))
+        uow.commit()
+
+    with uow:
+        [batch] = uow.products.get(sku="ROSEIRA P15").batches
+        assert batch.available_quantity == 40
+        assert batch.is_consistent()
+
+
+def test_uow_deallocates_order_of_loaded_product(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session=session, ref="b1", sku="ROSEIRA P15", qty=120)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="ROSEIRA P15")
+        product.allocate(model.OrderLine("o1", "ROSEIRA P15", 80))
+        product.allocate(model.OrderLine("o2", "ROSEIRA P15", 20))
+        uow.commit()
+
+    with uow:
+        product = uow.products.get(sku="ROSEIRA P15")
+        product.deallocate("o1")
+        uow.commit()
+
+    rows = list(session.execute("SELECT id_orderline FROM allocations"))
+    assert len(rows) == 1
+    get_allocated_batch_ref(session=session, order_id="o2", sku="ROSEIRA P15")
+
+
+def test_uow_deallocates_any_order_of_loaded_product(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session=session, ref="b1", sku="ROSEIRA P15", qty=120)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="ROSEIRA P15")
+        product.allocate(model.OrderLine("o1", "ROSEIRA P15", 80))
+        uow.commit()
+
+    with uow:
+        product = uow.products.get(sku="ROSEIRA P15")
+        product.deallocate()
+        uow.commit()
+
+    assert product.latest_event.order_id == "o1"
+    assert list(session.execute("SELECT id_orderline FROM allocations")) == []
+
+
 def test_rollsback_uncommited_work_by_default(sqlite_session_factory):
     batchref = "bref-01"
     uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
@@ -182,3 +241,49 @@ def test_allocations_to_same_version_number_fail(postgres_session_factory,):
     )
     print(orders)
     assert orders[0].order_id == "orderid_01"
+
+
+class SlowCommitUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+    def _commit(self) -> None:
+        time.sleep(0.3)  # both threads load the same version
+        super()._commit()
+
+
+def test_conflicting_allocations_are_retried_at_read_committed(
+    postgres_db, postgres_session_factory, monkeypatch
+):
+    monkeypatch.setenv("COMMAND_RETRY_BACKOFF", "0.05")
+    sku, batchref = "LILY-P11", "batchref-lily"
+    session = postgres_session_factory()
+    remove_batch(session, sku)
+    insert_batch(session, batchref, sku, 30)
+    session.commit()
+
+    read_committed = sessionmaker(
+        bind=postgres_db.execution_options(isolation_level="READ COMMITTED"),
+        autoflush=False,
+    )
+    allocations = [
+        threading.Thread(
+            target=message_bus.handle,
+            args=(
+                commands.Allocate(order_id, sku, 10),
+                SlowCommitUnitOfWork(read_committed),
+            ),
+        )
+        for order_id in ["lily-01", "lily-02"]
+    ]
+    [thread.start() for thread in allocations]
+    [thread.join() for thread in allocations]
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku = :sku", dict(sku=sku)
+    )
+    assert version == 2
+    orders = session.execute(
+        "SELECT ol.order_id FROM allocations a "
+        "JOIN order_lines ol ON a.id_orderline = ol.id "
+        "WHERE ol.sku = :sku",
+        dict(sku=sku),
+    )
+    assert sorted(order_id for [order_id] in orders) == ["lily-01", "lily-02"]
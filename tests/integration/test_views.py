@@ -1,3 +1,5 @@
+from collections import deque
+
 from allocation.domain import events, commands
 from allocation.service import unit_of_work, message_bus
 from allocation import views
@@ -30,3 +32,36 @@ def test_view_specific_orderline(sqlite_session_factory):
 
     [orderline] = views.allocations(orderid, uow)
     assert orderline["batchref"] == batchref
+
+
+def test_batched_read_model_writes_every_allocation(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    sku, batchref = helpers.random_sku(), helpers.random_batchref()
+    allocated = [
+        events.Allocated(helpers.random_orderid(), batchref, sku, qty)
+        for qty in range(1, 4)
+    ]
+
+    message_bus.handle_events(allocated, deque(), uow)
+
+    for event in allocated:
+        [orderline] = views.allocations(event.order_id, uow)
+        assert orderline == dict(batchref=batchref, sku=sku, qty=event.qty)
+
+
+def test_pages_through_every_allocation(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    orderids = [create_and_allocate_batch(uow)[1] for _ in range(5)]
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = views.allocations_page(uow, limit=2, after=cursor)
+        pages.append(page)
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    paged = [row["id_orderline"] for page in pages for row in page]
+    assert paged == orderids
+    streamed = views.iter_allocations(uow, chunk_size=2)
+    assert [row["id_orderline"] for row in streamed] == orderids
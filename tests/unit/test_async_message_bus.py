@@ -0,0 +1,38 @@
+import asyncio
+import threading
+
+from allocation.domain import commands, events
+from allocation.service import async_message_bus, message_bus, unit_of_work
+
+
+def test_allocation_reduces_available_qty() -> None:
+    sku = "KALANCHOE-P11"
+    uow = unit_of_work.FakeUnitOfWork()
+    create = commands.CreateBatch("b1", sku, 120, None)
+    asyncio.run(async_message_bus.handle(create, uow))
+    allocate = commands.Allocate("o1", sku, 100)
+    asyncio.run(async_message_bus.handle(allocate, uow))
+
+    with uow:
+        [batch] = uow.products.get(sku).batches
+        assert batch.available_quantity == 20
+
+
+def test_handlers_of_same_event_run_concurrently(monkeypatch) -> None:
+    # each handler waits for the other: would time out if run in sequence
+    barrier = threading.Barrier(2, timeout=5)
+    reached = []
+
+    def handler(event: events.Event, uow) -> None:
+        barrier.wait()
+        reached.append(event)
+
+    monkeypatch.setitem(
+        message_bus.EVENTS_HANDLERS, events.OutOfStock, [handler, handler]
+    )
+    event = events.OutOfStock("KALANCHOE-P11")
+    asyncio.run(
+        async_message_bus.handle(event, unit_of_work.FakeUnitOfWork())
+    )
+
+    assert reached == [event, event]
@@ -85,3 +85,16 @@ def test_allocation_is_idempotent() -> None:
         batch.allocate(order)
 
     assert batch.available_quantity == 3
+
+
+def test_running_allocated_quantity_stays_consistent() -> None:
+    batch = BatchOrder("batch-ref", "SOME-SKU", qty=100, eta=None)
+    for i in range(10):
+        batch.allocate(OrderLine(f"order-{i}", "SOME-SKU", qty=i + 1))
+    assert batch.allocated_quantity == 55
+    assert batch.is_consistent()
+
+    batch.deallocate()
+    batch.deallocate()
+    assert batch.available_quantity == 100 - batch.allocated_quantity
+    assert batch.is_consistent()
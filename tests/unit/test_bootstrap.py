@@ -0,0 +1,27 @@
+from sqlalchemy import inspect
+
+from allocation.adapters import orm
+from allocation.domain import model
+from allocation.entrypoints import app
+from allocation.service import unit_of_work
+
+
+def test_session_factory_creates_engine_on_first_use() -> None:
+    factory = unit_of_work.LazySessionFactory()
+    assert factory._engine is None
+
+    engine = factory.engine
+    assert factory.engine is engine
+    factory._pid = -1  # as seen from a forked process
+    assert factory.engine is not engine
+
+
+def test_mappers_are_started_by_first_request() -> None:
+    orm.clear_mappers()
+    flask_app = app.create_app()
+    assert inspect(model.Product, raiseerr=False) is None
+
+    with flask_app.test_client() as client:
+        assert client.get("/").status_code == 200
+        assert client.get("/").status_code == 200
+    assert inspect(model.Product, raiseerr=False) is not None
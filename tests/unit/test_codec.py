@@ -0,0 +1,73 @@
+import json
+from datetime import date, datetime
+
+from pytest import mark, raises  # type: ignore
+
+from allocation.adapters import codec
+from allocation.domain import commands, events, model
+
+MESSAGES = [
+    commands.Allocate("o1", "LAMP", 10),
+    commands.Deallocate("LAMP"),
+    commands.CreateBatch("b1", "LAMP", 100, date(2020, 4, 1)),
+    commands.CreateBatch("b1", "LAMP", 100, None),
+    events.Allocated("o1", "b1", "LAMP", 10),
+    events.BatchCreated("b1", "LAMP", 100, date(2020, 4, 1)),
+    events.AllocationsEmpty(),
+]
+
+
+@mark.parametrize("message", MESSAGES)
+@mark.parametrize("binary", [True, False])
+def test_round_trips(message, binary) -> None:
+    decoded = codec.decode(codec.encode(message, binary=binary))
+    assert decoded == message
+    assert type(decoded) is type(message)
+
+
+@mark.parametrize("binary", [True, False])
+def test_round_trips_events_as_the_model_raises_them(binary) -> None:
+    product = model.Product("LAMP", [])
+    product.add_batch(model.BatchOrder("b1", "LAMP", 10, date(2020, 4, 1)))
+    event = product.latest_event
+
+    decoded = codec.decode(codec.encode(event, binary=binary))
+    assert decoded == event
+    assert type(decoded.eta) is date
+
+
+@mark.parametrize("binary", [True, False])
+def test_decodes_date_fields_as_their_declared_type(binary) -> None:
+    midnight = datetime(2020, 4, 1)
+    sent = commands.CreateBatch("b1", "LAMP", 1, midnight)  # type: ignore
+    decoded = codec.decode(codec.encode(sent, binary=binary))
+    assert type(decoded.eta) is date
+    assert decoded.eta == date(2020, 4, 1)
+
+
+def test_binary_is_smaller_than_json() -> None:
+    for message in MESSAGES:
+        binary = codec.encode(message, binary=True)
+        assert len(binary) < len(codec.encode(message, binary=False))
+
+
+def test_parses_dates_sent_by_external_producers() -> None:
+    sent = dict(name="CreateBatch", ref="b1", sku="LAMP", qty=1)
+    sent["eta"] = "2020-04-01"
+    decoded = codec.decode(json.dumps(sent).encode())
+    assert decoded == commands.CreateBatch("b1", "LAMP", 1, date(2020, 4, 1))
+
+
+def test_fields_missing_from_older_messages_take_their_defaults() -> None:
+    code = codec.CODES[commands.Deallocate]
+    header = codec.HEADER.pack(codec.MAGIC, 1, code, 1)
+    data = header + codec.ENCODERS[str]("LAMP")
+    assert codec.decode(data) == commands.Deallocate("LAMP", order_id=None)
+
+
+def test_refuses_unknown_and_newer_messages() -> None:
+    encoded = codec.encode(events.AllocationsEmpty(), binary=True)
+    newer = bytes((codec.MAGIC, codec.SCHEMA_VERSION + 1)) + encoded[2:]
+    for data in [newer, b"{'not': 'json'}", b'{"name": "Unknown"}', b""]:
+        with raises(codec.CodecError):
+            codec.decode(data)
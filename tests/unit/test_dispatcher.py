@@ -0,0 +1,63 @@
+import threading
+
+from allocation.domain import commands, events
+from allocation.service import message_bus, unit_of_work
+from allocation.service.dispatcher import EventDispatcher
+
+
+def record_events_handled(monkeypatch, started=None, gate=None) -> list:
+    handled = []
+
+    def handler(event: events.Event, uow) -> None:
+        if event.sku == "SLOW":
+            started.set()
+            gate.wait(timeout=5)
+        handled.append(event)
+
+    monkeypatch.setitem(
+        message_bus.EVENTS_HANDLERS, events.OutOfStock, [handler]
+    )
+    return handled
+
+
+def test_dispatches_events_in_background_and_flushes(monkeypatch) -> None:
+    handled = record_events_handled(monkeypatch)
+    dispatcher = EventDispatcher(unit_of_work.FakeUnitOfWork, workers=2)
+
+    for i in range(10):
+        dispatcher.submit(events.OutOfStock(f"SKU-{i}"))
+    dispatcher.shutdown()
+
+    assert len(handled) == 10
+    stats = dispatcher.stats()
+    assert stats["completed"] == stats["submitted"] == 10
+    assert stats["queue_depth"] == 0
+
+
+def test_handles_inline_when_queue_is_full(monkeypatch) -> None:
+    started, gate = threading.Event(), threading.Event()
+    handled = record_events_handled(monkeypatch, started, gate)
+    dispatcher = EventDispatcher(
+        unit_of_work.FakeUnitOfWork, workers=1, max_queue=1, put_timeout=0.01
+    )
+
+    dispatcher.submit(events.OutOfStock("SLOW"))  # blocks the only worker
+    started.wait(timeout=5)
+    dispatcher.submit(events.OutOfStock("QUEUED"))
+    dispatcher.submit(events.OutOfStock("INLINE"))
+
+    assert [e.sku for e in handled] == ["INLINE"]
+    gate.set()
+    dispatcher.shutdown()
+    assert [e.sku for e in handled] == ["INLINE", "SLOW", "QUEUED"]
+    assert dispatcher.stats()["handled_inline"] == 1
+
+
+def test_commands_hand_their_events_to_dispatch() -> None:
+    dispatched = []
+    uow = unit_of_work.FakeUnitOfWork()
+    create = commands.CreateBatch("b1", "KALANCHOE-P11", 120, None)
+
+    message_bus.handle(create, uow, dispatch=dispatched.append)
+
+    assert [type(event) for event in dispatched] == [events.BatchCreated]
@@ -0,0 +1,82 @@
+import threading
+import time
+
+from pytest import raises  # type: ignore
+
+from allocation.domain import commands
+from allocation.service import handlers, message_bus, unit_of_work
+from allocation.service.executor import PartitionedExecutor
+
+
+def two_skus_in_different_partitions(executor: PartitionedExecutor) -> list:
+    skus = [f"SKU-{i}" for i in range(100)]
+    first = skus[0]
+    second = next(
+        sku
+        for sku in skus
+        if executor.partition(sku) != executor.partition(first)
+    )
+    return [first, second]
+
+
+def test_same_sku_commands_run_one_at_a_time_in_order(monkeypatch) -> None:
+    running, handled = [], []
+
+    def allocate(command: commands.Allocate, uow) -> None:
+        running.append(command)
+        assert len(running) == 1
+        time.sleep(0.01)
+        handled.append(command.order_id)
+        running.remove(command)
+
+    monkeypatch.setitem(
+        message_bus.COMMAND_HANDLERS, commands.Allocate, allocate
+    )
+    executor = PartitionedExecutor(partitions=4)
+    futures = [
+        executor.submit(
+            commands.Allocate(f"o{i}", "SKU", 1),
+            unit_of_work.FakeUnitOfWork(),
+        )
+        for i in range(10)
+    ]
+    [future.result(timeout=5) for future in futures]
+    executor.shutdown()
+
+    assert handled == [f"o{i}" for i in range(10)]
+
+
+def test_different_skus_run_in_parallel(monkeypatch) -> None:
+    executor = PartitionedExecutor(partitions=4)
+    first, second = two_skus_in_different_partitions(executor)
+    second_ran = threading.Event()
+
+    def allocate(command: commands.Allocate, uow) -> None:
+        if command.sku == first:
+            # would time out if both SKUs shared a worker
+            assert second_ran.wait(timeout=5)
+        else:
+            second_ran.set()
+
+    monkeypatch.setitem(
+        message_bus.COMMAND_HANDLERS, commands.Allocate, allocate
+    )
+    blocked = executor.submit(
+        commands.Allocate("o1", first, 1), unit_of_work.FakeUnitOfWork()
+    )
+    executor.handle(
+        commands.Allocate("o2", second, 1), unit_of_work.FakeUnitOfWork()
+    )
+    blocked.result(timeout=5)
+    executor.shutdown()
+
+
+def test_raises_handler_exceptions_to_caller() -> None:
+    executor = PartitionedExecutor(partitions=2)
+    with raises(handlers.InvalidSku):
+        executor.handle(
+            commands.Allocate("o1", "MISSING", 1),
+            unit_of_work.FakeUnitOfWork(),
+        )
+    executor.shutdown()
+    assert sum(executor.stats()["handled"]) == 1
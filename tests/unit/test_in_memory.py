@@ -0,0 +1,127 @@
+import time
+from datetime import date
+
+from allocation.adapters import repository
+from allocation.domain import commands, model
+from allocation.service import message_bus, unit_of_work
+
+
+def test_finds_batches_added_to_stored_products() -> None:
+    uow = unit_of_work.InMemoryUnitOfWork()
+    message_bus.handle(commands.CreateBatch("b1", "LAMP", 10, None), uow)
+    message_bus.handle(commands.CreateBatch("b2", "LAMP", 10, None), uow)
+    message_bus.handle(commands.CreateBatch("b3", "DESK", 10, None), uow)
+
+    with uow:
+        assert uow.products.get_by_batchref("b2").sku == "LAMP"
+        assert uow.products.get_by_batchref("b3").sku == "DESK"
+        uow.products.get("DESK").add_batch(model.BatchOrder("b4", "DESK", 1))
+        assert uow.products.get_by_batchref("b4").sku == "DESK"
+        uow.commit()
+    assert uow.store.get_by_batchref("b4").sku == "DESK"
+
+
+def test_rollback_drops_uncommitted_products() -> None:
+    uow = unit_of_work.InMemoryUnitOfWork()
+    with uow:
+        uow.products.add(model.Product("LAMP", []))
+        assert uow.products.get("LAMP") is not None
+
+    with uow:
+        assert uow.products.get("LAMP") is None
+
+
+def test_rollsback_changes_to_stored_products() -> None:
+    uow = unit_of_work.InMemoryUnitOfWork()
+    message_bus.handle(commands.CreateBatch("b1", "LAMP", 10, None), uow)
+
+    with uow:
+        product = uow.products.get("LAMP")
+        product.allocate(model.OrderLine("o1", "LAMP", 4))
+        assert uow.products.get_by_batchref("b1") is product
+
+    with uow:
+        [batch] = uow.products.get("LAMP").batches
+        assert batch.available_quantity == 10
+        assert uow.products.get("LAMP").version_number == 1
+
+
+def test_rollsback_every_change_since_the_last_commit() -> None:
+    uow = unit_of_work.InMemoryUnitOfWork()
+    message_bus.handle(commands.CreateBatch("b1", "LAMP", 10, None), uow)
+    message_bus.handle(commands.Allocate("o1", "LAMP", 4), uow)
+    message_bus.handle(commands.Allocate("o2", "LAMP", 6), uow)
+
+    with uow:
+        product = uow.products.get("LAMP")
+        product.deallocate("o1")
+        product.add_batch(model.BatchOrder("b2", "LAMP", 10))
+        product.allocate(model.OrderLine("o3", "LAMP", 8))
+        uow.commit()
+        product.deallocate("o2")
+        product.allocate(model.OrderLine("o4", "LAMP", 10))
+        product.add_batch(model.BatchOrder("b3", "LAMP", 10))
+
+    product = uow.store.products["LAMP"]
+    assert [b.reference for b in product.batches] == ["b1", "b2"]
+    assert product.orders["o2"][0].reference == "b1"
+    assert product.orders["o3"][0].reference == "b2"
+    assert "o4" not in product.orders
+    assert [b.available_quantity for b in product.batches] == [4, 2]
+    assert all(batch.is_consistent() for batch in product.batches)
+    assert product.version_number == 6
+    assert [type(e).__name__ for e in product._events] == [
+        "Deallocated",
+        "BatchCreated",
+        "Allocated",
+    ]
+
+
+def test_commits_changes_to_stored_products() -> None:
+    uow = unit_of_work.InMemoryUnitOfWork()
+    message_bus.handle(commands.CreateBatch("b1", "LAMP", 10, None), uow)
+    message_bus.handle(commands.Allocate("o1", "LAMP", 4), uow)
+
+    [batch] = uow.store.products["LAMP"].batches
+    assert batch.available_quantity == 6
+
+
+def test_snapshot_round_trip(tmp_path) -> None:
+    uow = unit_of_work.InMemoryUnitOfWork()
+    tomorrow = date(2020, 4, 2)
+    message_bus.handle(commands.CreateBatch("b1", "LAMP", 10, None), uow)
+    message_bus.handle(commands.CreateBatch("b2", "LAMP", 10, tomorrow), uow)
+    message_bus.handle(commands.Allocate("o1", "LAMP", 4), uow)
+    path = str(tmp_path / "products.pickle")
+    uow.store.save(path)
+
+    store = repository.InMemoryStore.load(path)
+    product = store.products["LAMP"]
+    assert product.version_number == 3
+    assert [b.eta for b in product.batches] == [None, tomorrow]
+    assert product.orders["o1"][0].reference == "b1"
+    assert store.get_by_batchref("b2") is product
+
+
+def test_snapshots_keep_lines_that_would_not_fit(tmp_path) -> None:
+    batch = model.BatchOrder("b1", "LAMP", 10)
+    batch._allocations.update(
+        [model.OrderLine("o1", "LAMP", 8), model.OrderLine("o2", "LAMP", 8)]
+    )
+    path = str(tmp_path / "products.pickle")
+    repository.InMemoryStore([model.Product("LAMP", [batch])]).save(path)
+
+    [loaded] = repository.InMemoryStore.load(path).products["LAMP"].batches
+    assert loaded.available_quantity == -6
+
+
+def test_saves_snapshots_periodically(tmp_path) -> None:
+    store = repository.InMemoryStore([model.Product("LAMP", [])])
+    path = tmp_path / "products.pickle"
+    stop = store.save_every(str(path), interval=0.01)
+    for _ in range(100):
+        if path.exists():
+            break
+        time.sleep(0.01)
+    stop.set()
+    assert list(repository.InMemoryStore.load(str(path)).products) == ["LAMP"]
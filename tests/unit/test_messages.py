@@ -0,0 +1,17 @@
+from allocation.domain import commands, events
+
+
+def test_messages_do_not_carry_an_instance_dict() -> None:
+    event = events.Allocated("o1", "b1", "KALANCHOE-P11", 10)
+    command = commands.CreateBatch("b1", "KALANCHOE-P11", 100, None)
+
+    assert not hasattr(event, "__dict__")
+    assert not hasattr(command, "__dict__")
+    assert event == events.Allocated("o1", "b1", "KALANCHOE-P11", 10)
+
+
+def test_event_str_does_not_mutate_event() -> None:
+    event = events.OutOfStock("KALANCHOE-P11")
+
+    assert str(event) == "{'sku': 'KALANCHOE-P11', 'name': 'OutOfStock'}"
+    assert event == events.OutOfStock("KALANCHOE-P11")
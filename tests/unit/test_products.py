@@ -82,3 +82,128 @@ def test_allocation_emmits_events():
     product.allocate(line)
 
     assert type(product.latest_event) == events.Allocated
+
+
+def test_skips_batches_without_enough_capacity() -> None:
+    sku = "KALANCHOE-P11"
+    batch_in_stock = BatchOrder("in-stock-ref", sku, 10, eta=None)
+    batch_today = BatchOrder("shipment-ref02", sku, 100, eta=date.today())
+    batch_tomorrow = BatchOrder("shipment-ref04", sku, 100, eta=TOMORROW)
+    product = Product(sku, [batch_tomorrow, batch_today, batch_in_stock])
+
+    product.allocate(OrderLine("o1", sku, 8))
+    product.allocate(OrderLine("o2", sku, 5))
+    product.allocate(OrderLine("o3", sku, 2))
+
+    assert batch_in_stock.available_quantity == 0
+    assert batch_today.available_quantity == 95
+    assert batch_tomorrow.available_quantity == 100
+
+
+def test_batches_added_after_allocating_are_prioritized() -> None:
+    sku = "KALANCHOE-P11"
+    batch_tomorrow = BatchOrder("shipment-ref04", sku, 100, eta=TOMORROW)
+    product = Product(sku, [batch_tomorrow])
+    product.allocate(OrderLine("o1", sku, 10))
+
+    batch_yesterday = BatchOrder("shipment-ref03", sku, 100, eta=YESTERDAY)
+    product.add_batch(batch_yesterday)
+    product.allocate(OrderLine("o2", sku, 10))
+
+    assert batch_yesterday.available_quantity == 90
+    assert batch_tomorrow.available_quantity == 90
+
+
+def test_deallocates_from_least_prioritized_batch() -> None:
+    sku = "KALANCHOE-P11"
+    batch_in_stock = BatchOrder("in-stock-ref", sku, 10, eta=None)
+    batch_tomorrow = BatchOrder("shipment-ref04", sku, 100, eta=TOMORROW)
+    product = Product(sku, [batch_in_stock, batch_tomorrow])
+    product.allocate(OrderLine("o1", sku, 10))
+    product.allocate(OrderLine("o2", sku, 10))
+
+    product.deallocate()
+    assert product.latest_event.batch_ref == "shipment-ref04"
+    product.deallocate()
+    assert product.latest_event.batch_ref == "in-stock-ref"
+    product.deallocate()
+    assert product.latest_event == events.AllocationsEmpty()
+
+    product.allocate(OrderLine("o3", sku, 10))
+    assert batch_in_stock.available_quantity == 0
+
+
+def test_records_already_allocated_event_on_repeated_line() -> None:
+    sku = "KALANCHOE-P11"
+    batch_in_stock = BatchOrder("in-stock-ref", sku, 10, eta=None)
+    batch_tomorrow = BatchOrder("shipment-ref04", sku, 100, eta=TOMORROW)
+    product = Product(sku, [batch_in_stock, batch_tomorrow])
+    product.allocate(OrderLine("o1", sku, 10))
+
+    product.allocate(OrderLine("o1", sku, 10))
+    assert product.latest_event == events.OrderAlreadyAllocated("o1")
+    assert batch_tomorrow.available_quantity == 100
+
+
+def test_allocate_many_matches_allocating_line_by_line() -> None:
+    sku = "KALANCHOE-P11"
+    make_batches = lambda: [
+        BatchOrder("shipment-ref04", sku, 30, eta=TOMORROW),
+        BatchOrder("in-stock-ref", sku, 20, eta=None),
+        BatchOrder("shipment-ref03", sku, 10, eta=YESTERDAY),
+    ]
+    lines = [OrderLine(f"o{i}", sku, 7) for i in range(10)]
+    lines.append(OrderLine("o3", sku, 7))
+
+    one_by_one = Product(sku, make_batches())
+    for line in lines:
+        one_by_one.allocate(line)
+    in_bulk = Product(sku, make_batches())
+    in_bulk.allocate_many(lines)
+
+    assert list(in_bulk._events) == list(one_by_one._events)
+    assert in_bulk.version_number == one_by_one.version_number == 7
+    assert type(in_bulk._events[-2]) is events.OutOfStock
+    assert in_bulk.latest_event == events.OrderAlreadyAllocated("o3")
+
+
+def test_deallocates_lines_allocated_before_it_was_built() -> None:
+    sku = "KALANCHOE-P11"
+    batch = BatchOrder("in-stock-ref", sku, 10, eta=None)
+    batch.allocate(OrderLine("o1", sku, 10))
+    product = Product(sku, [batch])
+
+    product.deallocate()
+
+    assert product.latest_event.order_id == "o1"
+    assert batch.available_quantity == 10
+    assert product.orders == {}
+
+
+def test_deallocates_a_specific_order() -> None:
+    sku = "KALANCHOE-P11"
+    batch_in_stock = BatchOrder("in-stock-ref", sku, 10, eta=None)
+    batch_tomorrow = BatchOrder("shipment-ref04", sku, 100, eta=TOMORROW)
+    product = Product(sku, [batch_in_stock, batch_tomorrow])
+    product.allocate(OrderLine("o1", sku, 10))
+    product.allocate(OrderLine("o2", sku, 10))
+
+    product.deallocate("o1")
+
+    assert product.latest_event == events.Deallocated(
+        batch_ref="in-stock-ref", order_id="o1", sku=sku, qty=10
+    )
+    assert batch_in_stock.available_quantity == 10
+    assert "o1" not in product.orders
+    product.allocate(OrderLine("o1", sku, 5))
+    assert product.orders["o1"][0] is batch_in_stock
+
+
+def test_deallocating_unknown_order_records_event() -> None:
+    sku = "KALANCHOE-P11"
+    product = Product(sku, [BatchOrder("in-stock-ref", sku, 10, eta=None)])
+
+    product.deallocate("o1")
+
+    assert product.latest_event == events.OrderNotAllocated("o1")
+    assert product.version_number == 0
@@ -1,3 +1,7 @@
+from collections import deque
+
+from pytest import raises  # type: ignore
+
 from allocation.service import message_bus, unit_of_work  # type: ignore
 from allocation.domain import events, commands  # type: ignore
 
@@ -30,3 +34,65 @@ def test_allocation_reduces_available_qty() -> None:
         assert batch.available_quantity == 20
 
         assert batch.reference == "b1"
+
+
+def test_deallocate_targets_given_order() -> None:
+    sku = "KALANCHOE-P11"
+    uow = unit_of_work.FakeUnitOfWork()
+    message_bus.handle(commands.CreateBatch("b1", sku, 120, None), uow)
+    message_bus.handle(commands.Allocate("o1", sku, 100), uow)
+    message_bus.handle(commands.Allocate("o2", sku, 10), uow)
+
+    message_bus.handle(commands.Deallocate(sku, order_id="o1"), uow)
+
+    with uow:
+        product = uow.products.get(sku)
+        [batch] = product.batches
+        assert batch.available_quantity == 110
+        assert list(product.orders) == ["o2"]
+
+
+def test_coalesces_consecutive_events_of_same_type() -> None:
+    first = events.Allocated("o1", "b1", "KALANCHOE-P11", 10)
+    queue = deque(
+        [
+            events.Allocated("o2", "b1", "KALANCHOE-P11", 10),
+            events.OutOfStock("KALANCHOE-P11"),
+            events.Allocated("o3", "b1", "KALANCHOE-P11", 10),
+        ]
+    )
+
+    batch = message_bus.next_batch(first, queue)
+
+    assert [e.order_id for e in batch] == ["o1", "o2"]
+    assert list(queue) == [
+        events.OutOfStock("KALANCHOE-P11"),
+        events.Allocated("o3", "b1", "KALANCHOE-P11", 10),
+    ]
+
+
+def test_retries_commands_conflicting_with_concurrent_updates(
+    monkeypatch,
+) -> None:
+    monkeypatch.setenv("COMMAND_RETRY_BACKOFF", "0")
+    attempts = []
+
+    def conflicting(command: commands.Allocate, uow) -> str:
+        attempts.append(command)
+        if len(attempts) < 3:
+            raise unit_of_work.ConcurrentUpdate()
+        return "allocated"
+
+    monkeypatch.setitem(
+        message_bus.COMMAND_HANDLERS, commands.Allocate, conflicting
+    )
+    uow = unit_of_work.FakeUnitOfWork()
+    command = commands.Allocate("o1", "SKU", 1)
+    assert message_bus.handle(command, uow) == ["allocated"]
+    assert len(attempts) == 3
+
+    attempts.clear()
+    monkeypatch.setenv("COMMAND_RETRY_ATTEMPTS", "2")
+    with raises(unit_of_work.ConcurrentUpdate):
+        message_bus.handle(command, uow)
+    assert len(attempts) == 2